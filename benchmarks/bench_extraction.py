@@ -0,0 +1,72 @@
+import sys
+sys.path.append('.')
+import argparse
+import torch
+from benchmarks.bench_utils import get_bench_vqgan_hparams, add_bench_args, time_fn, get_environment, save_results, \
+    report_comparison
+from models import VQAutoEncoder, LatentExtractor
+
+CASES = ["autoencoder", "extractor", "extractor_bf16"]
+
+
+@torch.no_grad()
+def autoencoder_latent_ids(H, ae, x):
+    # latent extraction as it was done with the whole VQAutoEncoder
+    latents = ae.encoder(x).permute(0, 2, 3, 1).contiguous().view(-1, H.emb_dim)
+    codebook = ae.quantize.embedding.weight
+    distances = (latents ** 2).sum(dim=1, keepdim=True) + (codebook ** 2).sum(1) - \
+        2 * torch.matmul(latents, codebook.t())
+    return torch.argmin(distances, dim=1).view(x.size(0), -1)
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+
+    H = get_bench_vqgan_hparams(args.preset)
+    ae = VQAutoEncoder(H).to(args.device).eval()
+    state_dict = {k: v for k, v in ae.state_dict().items() if k.startswith(("encoder.", "quantize."))}
+
+    results = []
+    for batch_size in args.batch_sizes:
+        x = torch.rand(batch_size, H.n_channels, H.img_size, H.img_size, device=args.device)
+        reference = autoencoder_latent_ids(H, ae, x)
+        for case in args.cases:
+            if case == "autoencoder":
+                fn = lambda: autoencoder_latent_ids(H, ae, x)
+            else:
+                extractor = LatentExtractor(H, bf16=case == "extractor_bf16")
+                extractor.load_state_dict(state_dict)
+                extractor = extractor.to(args.device).to(memory_format=torch.channels_last).eval()
+                fn = lambda: extractor(x)
+
+            timing = time_fn(fn, args.device, args.warmup, args.repeats)
+            result = {
+                "name": f"extract.{case}/bs{batch_size}",
+                "case": case,
+                "batch_size": batch_size,
+                "images_per_s": batch_size / timing["median_s"],
+                "id_agreement": (fn() == reference).float().mean().item(),
+            }
+            result.update(timing)
+            results.append(result)
+            print(f"{result['name']:32s} {result['images_per_s']:9.1f} img/s {result['peak_memory_mb']:9.1f}MB "
+                  f"ids matching autoencoder {100 * result['id_agreement']:.2f}%")
+
+    config = vars(args).copy()
+    config["environment"] = get_environment(args.device)
+    if args.output:
+        save_results(args.output, results, config)
+        print(f"Saved results to {args.output}")
+
+    if args.compare and not report_comparison(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Throughput of latent extraction with the autoencoder and the latent extractor")
+    add_bench_args(parser)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--cases", type=str, nargs="+", default=CASES, choices=CASES)
+    main(parser.parse_args())
@@ -0,0 +1,86 @@
+import sys
+sys.path.append('.')
+import argparse
+import time
+import tracemalloc
+import numpy as np
+from benchmarks.bench_utils import add_bench_args, get_environment, save_results, report_comparison
+from utils.prdc_utils import compute_prdc
+
+CASES = ["library", "blockwise"]
+
+
+def measure(fn):
+    # numpy allocations are traced, so this is the peak of the metric computation alone
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    metrics = fn()
+    elapsed = time.perf_counter() - start_time
+    peak_memory_mb = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return metrics, elapsed, peak_memory_mb
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    results, mismatched = [], False
+    for n_features in args.n_features:
+        # features on a low dimensional subspace, like inception features, so the metrics aren't degenerate
+        projection = rng.standard_normal((32, args.dims))
+        real_features = (rng.standard_normal((n_features, 32)) @ projection).astype(np.float32)
+        fake_features = ((1.1 * rng.standard_normal((n_features, 32)) + 0.1) @ projection).astype(np.float32)
+
+        reference = None
+        for case in args.cases:
+            if case == "library":
+                from prdc import compute_prdc as library_compute_prdc
+                fn = lambda: library_compute_prdc(real_features, fake_features, args.nearest_k)
+            else:
+                fn = lambda: compute_prdc(
+                    real_features, fake_features, args.nearest_k, args.prdc_max_memory, args.prdc_threads
+                )
+
+            times, peaks = [], []
+            for _ in range(args.repeats):
+                metrics, elapsed, peak_memory_mb = measure(fn)
+                times.append(elapsed)
+                peaks.append(peak_memory_mb)
+            result = {
+                "name": f"prdc.{case}/n{n_features}",
+                "case": case,
+                "n_features": n_features,
+                "median_s": float(np.median(times)),
+                "peak_memory_mb": max(peaks),
+            }
+            result.update({k: float(v) for k, v in metrics.items()})
+            if reference is None:
+                reference = metrics
+            elif any(metrics[k] != reference[k] for k in reference):
+                print(f"{result['name']} differs from {args.cases[0]}: {metrics} against {reference}")
+                mismatched = True
+            results.append(result)
+            print(f"{result['name']:28s} {result['median_s']:8.2f}s {result['peak_memory_mb']:9.1f}MB  " +
+                  " ".join(f"{k} {float(v):.4f}" for k, v in metrics.items()))
+
+    config = vars(args).copy()
+    config["environment"] = get_environment("cpu")
+    if args.output:
+        save_results(args.output, results, config)
+        print(f"Saved results to {args.output}")
+
+    if args.compare and not report_comparison(results, args.compare, args.tolerance):
+        mismatched = True
+    if mismatched:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Speed, memory and parity of block-wise PRDC against the prdc library")
+    add_bench_args(parser)
+    parser.add_argument("--n_features", type=int, nargs="+", default=[2000, 5000])
+    parser.add_argument("--dims", type=int, default=2048)
+    parser.add_argument("--nearest_k", type=int, default=3)
+    parser.add_argument("--prdc_max_memory", type=int, default=64)
+    parser.add_argument("--prdc_threads", type=int, default=4)
+    parser.add_argument("--cases", type=str, nargs="+", default=CASES, choices=CASES)
+    main(parser.parse_args())
@@ -0,0 +1,145 @@
+import sys
+sys.path.append('.')
+import argparse
+import numpy as np
+import torch
+from benchmarks.bench_utils import get_bench_hparams, add_bench_args, time_fn, get_environment, save_results, \
+    report_comparison
+from models import Generator
+from utils.sampler_utils import get_sampler, latent_ids_to_onehot
+
+CASES = ["sample", "sample_mlm", "sample_confidence", "sample_shape", "autoregressive", "decode"]
+
+
+def build_sampler(H, device):
+    # random weights, the timings do not depend on what the model has learnt
+    embedding_weight = torch.randn(H.codebook_size, H.emb_dim)
+    return get_sampler(H, embedding_weight).to(device).eval()
+
+
+def bench_absorbing(args, H, batch_size, sample_steps):
+    H.batch_size = batch_size
+    sampler = build_sampler(H, args.device)
+    seq_len = int(np.prod(H.latent_shape))
+    results = []
+
+    if "sample" in args.cases:
+        timing = time_fn(lambda: sampler.sample(temp=H.temp, sample_steps=sample_steps),
+                         args.device, args.warmup, args.repeats)
+        results.append(make_result("absorbing.sample", batch_size, sample_steps, batch_size * seq_len, timing))
+
+    if "sample_mlm" in args.cases:
+        timing = time_fn(lambda: sampler.sample_mlm(temp=H.temp, sample_steps=sample_steps),
+                         args.device, args.warmup, args.repeats)
+        results.append(make_result("absorbing.sample_mlm", batch_size, sample_steps, batch_size * seq_len, timing))
+
+    if "sample_confidence" in args.cases:
+        timing = time_fn(
+            lambda: sampler.sample_scheduled(
+                temp=H.temp, sample_steps=sample_steps, unmask_schedule="cosine", unmask_order="confidence"
+            ),
+            args.device, args.warmup, args.repeats
+        )
+        results.append(
+            make_result("absorbing.sample_confidence", batch_size, sample_steps, batch_size * seq_len, timing)
+        )
+
+    if "sample_shape" in args.cases:
+        # 1.5x the trained latent grid, denoised as overlapping windows
+        shape = (H.latent_shape[1] * 3 // 2, H.latent_shape[2] * 3 // 2)
+        step = args.shape_step or max(1, H.latent_shape[1] // 4)
+        # sample_shape unmasks one position per step, so it cannot take more steps than there are positions
+        time_steps = min(sample_steps, shape[0] * shape[1])
+        timing = time_fn(
+            lambda: sampler.sample_shape(
+                shape, batch_size, time_steps=time_steps, step=step, temp=H.temp, max_windows=args.shape_max_windows,
+                windows_per_forward=args.shape_windows_per_forward
+            ),
+            args.device, args.warmup, args.repeats
+        )
+        results.append(make_result("absorbing.sample_shape", batch_size, time_steps, batch_size * time_steps, timing))
+
+    return results
+
+
+def bench_autoregressive(args, H, batch_size):
+    H.batch_size = batch_size
+    sampler = build_sampler(H, args.device)
+    seq_len = int(np.prod(H.latent_shape))
+    timing = time_fn(lambda: sampler.sample(temp=H.temp), args.device, args.warmup, args.repeats)
+    return [make_result("autoregressive.sample", batch_size, seq_len, batch_size * seq_len, timing)]
+
+
+def bench_decode(args, H, batch_size):
+    generator = Generator(H).to(args.device).eval()
+    embedding_weight = torch.randn(H.codebook_size, H.emb_dim, device=args.device)
+    latents = torch.randint(0, H.codebook_size, (batch_size, int(np.prod(H.latent_shape))), device=args.device)
+
+    def decode():
+        latents_one_hot = latent_ids_to_onehot(latents, H.latent_shape, H.codebook_size)
+        q = torch.matmul(latents_one_hot, embedding_weight).view(
+            batch_size, H.latent_shape[1], H.latent_shape[2], H.emb_dim
+        ).permute(0, 3, 1, 2).contiguous()
+        return generator(q)
+
+    timing = time_fn(decode, args.device, args.warmup, args.repeats)
+    return [make_result("generator.decode", batch_size, None, latents.numel(), timing)]
+
+
+def make_result(case, batch_size, sample_steps, n_tokens, timing):
+    name = f"{case}/bs{batch_size}" + (f"/steps{sample_steps}" if sample_steps is not None else "")
+    result = {
+        "name": name,
+        "case": case,
+        "batch_size": batch_size,
+        "sample_steps": sample_steps,
+        "tokens_per_s": n_tokens / timing["median_s"],
+        "images_per_s": batch_size / timing["median_s"],
+    }
+    result.update(timing)
+    print(f"{name:48s} {result['median_s']:9.3f}s {result['tokens_per_s']:12.1f} tok/s "
+          f"{result['images_per_s']:9.2f} img/s {result['peak_memory_mb']:9.1f}MB")
+    return result
+
+
+@torch.no_grad()
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+
+    results = []
+    for batch_size in args.batch_sizes:
+        if any(case in args.cases for case in ["sample", "sample_mlm", "sample_confidence", "sample_shape"]):
+            H = get_bench_hparams(args.preset, "absorbing")
+            for sample_steps in args.sample_steps:
+                results += bench_absorbing(args, H, batch_size, sample_steps)
+
+        if "autoregressive" in args.cases:
+            H = get_bench_hparams(args.preset, "autoregressive")
+            results += bench_autoregressive(args, H, batch_size)
+
+        if "decode" in args.cases:
+            H = get_bench_hparams(args.preset, "absorbing")
+            results += bench_decode(args, H, batch_size)
+
+    config = vars(args).copy()
+    config["environment"] = get_environment(args.device)
+    if args.output:
+        save_results(args.output, results, config)
+        print(f"Saved results to {args.output}")
+
+    if args.compare and not report_comparison(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Throughput and memory benchmarks for samplers and the generator")
+    add_bench_args(parser)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--sample_steps", type=int, nargs="+", default=[16, 64])
+    parser.add_argument("--cases", type=str, nargs="+", default=CASES, choices=CASES)
+    parser.add_argument("--shape_step", type=int, help="window stride for sample_shape")
+    parser.add_argument("--shape_max_windows", type=int, help="windows denoised per step by sample_shape")
+    parser.add_argument("--shape_windows_per_forward", type=int, default=1)
+    main(parser.parse_args())
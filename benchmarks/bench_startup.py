@@ -0,0 +1,112 @@
+import sys
+sys.path.append('.')
+import argparse
+import json
+import statistics
+import subprocess
+import time
+from benchmarks.bench_utils import get_environment, save_results, report_comparison
+
+# optional dependencies that must only be imported by the code paths that use them
+HEAVY_MODULES = ["lpips", "visdom", "torch_fidelity", "imageio", "torchvision"]
+
+LIBRARY_MODULES = [
+    "models",
+    "utils.data_utils",
+    "utils.experiment_utils",
+    "utils.log_utils",
+    "utils.sampler_utils",
+    "utils.vqgan_utils",
+    "train_sampler",
+    "train_vqgan",
+]
+
+ENTRY_POINTS = [
+    "train_sampler.py",
+    "train_vqgan.py",
+    "experiments/get_samples.py",
+    "experiments/generate_big_samples.py",
+    "experiments/export_traced_models.py",
+    "experiments/evaluate_int8_sampler.py",
+]
+
+IMPORT_SNIPPET = """
+import json, sys, time
+start_time = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start_time
+print(json.dumps({{"elapsed": elapsed, "heavy": [m for m in {heavy} if m in sys.modules]}}))
+"""
+
+
+def time_import(module, repeats):
+    # each import runs in a fresh interpreter, so nothing is already cached in sys.modules
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET.format(module=module, heavy=HEAVY_MODULES)],
+            check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append(result["elapsed"])
+    return statistics.median(times), result["heavy"]
+
+
+def time_help(script, repeats):
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, script, "--help"], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times)
+
+
+def main(args):
+    results, failures = [], []
+
+    # torch dominates startup and cannot be avoided, so budgets are on top of it
+    torch_time, _ = time_import("torch", args.repeats)
+    print(f"{'import torch':40s} {torch_time:7.3f}s")
+
+    for module in LIBRARY_MODULES:
+        elapsed, heavy = time_import(module, args.repeats)
+        overhead = elapsed - torch_time
+        results.append({"name": f"import/{module}", "median_s": elapsed, "overhead_s": overhead, "heavy": heavy})
+        print(f"{'import ' + module:40s} {elapsed:7.3f}s (+{overhead:.3f}s over torch)"
+              + (f"  loads {', '.join(heavy)}" if heavy else ""))
+        if heavy:
+            failures.append(f"{module} imports {', '.join(heavy)} at load time")
+        if overhead > args.budget:
+            failures.append(f"{module} takes {overhead:.3f}s to import on top of torch, budget is {args.budget:.3f}s")
+
+    for script in ENTRY_POINTS:
+        elapsed = time_help(script, args.repeats)
+        results.append({"name": f"help/{script}", "median_s": elapsed})
+        print(f"{script + ' --help':40s} {elapsed:7.3f}s")
+
+    config = vars(args).copy()
+    config["environment"] = get_environment("cpu")
+    config["torch_import_s"] = torch_time
+    if args.output:
+        save_results(args.output, results, config)
+        print(f"Saved results to {args.output}")
+
+    passed = True
+    if args.compare:
+        passed = report_comparison(results, args.compare, args.tolerance)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures or not passed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Import time and --help latency of the repo's entry points")
+    parser.add_argument("--budget", type=float, default=1.0,
+                        help="maximum seconds any module may take to import on top of torch")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", type=str, help="write results to this JSON file")
+    parser.add_argument("--compare", type=str, help="baseline JSON file to check results against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed fractional regression")
+    main(parser.parse_args())
@@ -0,0 +1,112 @@
+import sys
+sys.path.append('.')
+import argparse
+import torch
+from benchmarks.bench_utils import get_bench_vqgan_hparams, add_bench_args, time_fn, get_environment, save_results, \
+    report_comparison
+from models import Generator
+from utils.sampler_utils import latent_ids_to_onehot, retrieve_autoencoder_components_state_dicts
+
+
+def build_generator(args, H):
+    # random weights unless a trained VQGAN is given, seams are only representative with trained weights
+    generator = Generator(H)
+    embedding_weight = torch.randn(H.codebook_size, H.emb_dim)
+    if args.ae_load_dir:
+        H.ae_load_dir, H.ae_load_step = args.ae_load_dir, args.ae_load_step
+        state_dict = retrieve_autoencoder_components_state_dicts(
+            H, ["quantize", "generator"], remove_component_from_key=True
+        )
+        embedding_weight = state_dict.pop("embedding.weight")
+        generator.load_state_dict(state_dict, strict=False)
+    return generator.to(args.device).eval(), embedding_weight.to(args.device)
+
+
+def get_latents(H, embedding_weight, batch_size, size, device):
+    latent_ids = torch.randint(H.codebook_size, (batch_size, size * size), device=device)
+    one_hot = latent_ids_to_onehot(latent_ids, (1, size, size), H.codebook_size).to(device)
+    return torch.matmul(one_hot, embedding_weight).view(batch_size, size, size, H.emb_dim).permute(0, 3, 1, 2)
+
+
+def psnr(x, y):
+    mse = ((x.clamp(0, 1) - y.clamp(0, 1)) ** 2).mean().item()
+    return float("inf") if mse == 0 else 10 * torch.log10(torch.tensor(1 / mse)).item()
+
+
+@torch.no_grad()
+def bench_size(args, H, generator, embedding_weight, size):
+    torch.manual_seed(args.seed)
+    x = get_latents(H, embedding_weight, args.batch_size, size, args.device)
+    tile_size = args.tile_size or H.latent_shape[1]
+    n_pixels = args.batch_size * (size * 2 ** (len(H.ch_mult) - 1)) ** 2
+
+    def decode_tiled():
+        return generator.decode_tiled(x, tile_size, args.overlap, tiles_per_batch=args.tiles_per_batch)
+
+    results = []
+    timing = time_fn(decode_tiled, args.device, args.warmup, args.repeats)
+    tiled = {"name": f"generator.tiled/size{size}", "size": size}
+    tiled["megapixels_per_s"] = n_pixels / 1e6 / timing["median_s"]
+    tiled.update(timing)
+    results.append(tiled)
+
+    if size <= args.full_max_size:
+        timing = time_fn(lambda: generator(x), args.device, args.warmup, args.repeats)
+        full = {"name": f"generator.full/size{size}", "size": size}
+        full["megapixels_per_s"] = n_pixels / 1e6 / timing["median_s"]
+        full.update(timing)
+        results.append(full)
+        full_images, tiled_images = generator(x).float(), decode_tiled()
+        tiled["psnr_vs_full"] = psnr(full_images, tiled_images)
+        tiled["max_abs_diff_vs_full"] = (full_images.clamp(0, 1) - tiled_images.clamp(0, 1)).abs().max().item()
+
+    for result in results:
+        parity = f"  psnr vs full {result['psnr_vs_full']:.2f}dB" if "psnr_vs_full" in result else ""
+        print(f"{result['name']:32s} {result['median_s']:8.3f}s {result['megapixels_per_s']:8.2f}MP/s "
+              f"{result['peak_memory_mb']:9.1f}MB{parity}")
+    return results
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    H = get_bench_vqgan_hparams(args.preset)
+    generator, embedding_weight = build_generator(args, H)
+
+    results = []
+    for size in args.latent_sizes:
+        results += bench_size(args, H, generator, embedding_weight, size)
+
+    config = vars(args).copy()
+    config["environment"] = get_environment(args.device)
+    if args.output:
+        save_results(args.output, results, config)
+        print(f"Saved results to {args.output}")
+
+    failed = False
+    if args.min_psnr is not None:
+        for result in results:
+            if result.get("psnr_vs_full", float("inf")) < args.min_psnr:
+                print(f"{result['name']} PSNR against full decoding {result['psnr_vs_full']:.2f}dB is below "
+                      f"{args.min_psnr}dB")
+                failed = True
+    if args.compare and not report_comparison(results, args.compare, args.tolerance):
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Speed, memory and parity of tiled against full generator decoding")
+    add_bench_args(parser)
+    parser.add_argument("--latent_sizes", type=int, nargs="+", default=[16, 32])
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--tile_size", type=int, help="tile size in latents, defaults to the trained latent size")
+    parser.add_argument("--overlap", type=int, default=4)
+    parser.add_argument("--tiles_per_batch", type=int, default=8)
+    parser.add_argument("--full_max_size", type=int, default=64, help="largest latent size to decode in full")
+    parser.add_argument("--min_psnr", type=float, help="fail if tiled decoding is further than this from full")
+    parser.add_argument("--ae_load_dir", type=str)
+    parser.add_argument("--ae_load_step", type=int)
+    main(parser.parse_args())
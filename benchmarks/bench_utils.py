@@ -0,0 +1,166 @@
+import json
+import platform
+import resource
+import statistics
+import sys
+import time
+import torch
+from hparams.defaults.sampler_defaults import HparamsAbsorbing, HparamsAutoregressive
+from hparams.defaults.vqgan_defaults import HparamsVQGAN
+
+
+# small enough to run every benchmark in seconds on a laptop CPU
+TINY_PRESET = {
+    "attn_resolutions": [8],
+    "bert_n_emb": 64,
+    "bert_n_head": 4,
+    "bert_n_layers": 2,
+    "ch_mult": [1, 2],
+    "codebook_size": 64,
+    "emb_dim": 32,
+    "img_size": 16,
+    "latent_shape": [1, 8, 8],
+    "nf": 32,
+    "res_blocks": 1,
+    "total_steps": 64,
+}
+
+
+# 32x32 images are the smallest the default discriminator depth and LPIPS VGG features handle
+TINY_VQGAN_PRESET = {
+    "attn_resolutions": [8],
+    "batch_size": 2,
+    "ch_mult": [1, 2, 2],
+    "codebook_size": 64,
+    "disc_layers": 2,
+    "emb_dim": 32,
+    "img_size": 32,
+    "latent_shape": [1, 8, 8],
+    "ndf": 16,
+    "nf": 32,
+    "res_blocks": 1,
+}
+
+
+def get_bench_hparams(preset, sampler, dataset="churches"):
+    # same merge order as get_sampler_H_from_parser, without needing trained checkpoints
+    H = HparamsVQGAN(dataset)
+    if sampler == "absorbing":
+        H.update(HparamsAbsorbing(dataset))
+    elif sampler == "autoregressive":
+        H.update(HparamsAutoregressive(dataset))
+    H.sampler = sampler
+
+    if preset == "tiny":
+        H.update(TINY_PRESET)
+    elif preset != "full":
+        raise ValueError(f"Unknown benchmark preset: {preset}")
+
+    H.block_size = H.latent_shape[1] * H.latent_shape[2]
+    return H
+
+
+def get_bench_vqgan_hparams(preset, dataset="churches"):
+    H = HparamsVQGAN(dataset)
+    if preset == "tiny":
+        H.update(TINY_VQGAN_PRESET)
+    elif preset != "full":
+        raise ValueError(f"Unknown benchmark preset: {preset}")
+    return H
+
+
+def add_bench_args(parser):
+    parser.add_argument("--preset", type=str, default="tiny", choices=["tiny", "full"])
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, help="write results to this JSON file")
+    parser.add_argument("--compare", type=str, help="baseline JSON file to check results against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed fractional regression")
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+def reset_peak_memory(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+
+
+def peak_memory_mb(device):
+    # on CPU this is the high-water mark of the whole process, so only increases between cases are meaningful
+    if torch.device(device).type == "cuda":
+        return torch.cuda.max_memory_allocated() / 2**20
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+
+
+def time_fn(fn, device, warmup=1, repeats=3):
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+
+    reset_peak_memory(device)
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append(time.perf_counter() - start_time)
+
+    return {
+        "median_s": statistics.median(times),
+        "min_s": min(times),
+        "peak_memory_mb": peak_memory_mb(device),
+    }
+
+
+def get_environment(device):
+    return {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "device": torch.cuda.get_device_name() if torch.device(device).type == "cuda" else "cpu",
+        "threads": torch.get_num_threads(),
+    }
+
+
+def save_results(path, results, config):
+    with open(path, "w") as results_file:
+        json.dump({"config": config, "results": results}, results_file, indent=2)
+
+
+def compare_results(results, baseline_path, tolerance, higher_is_better=("tokens_per_s", "images_per_s"),
+                    lower_is_better=("median_s", "ms_per_step", "peak_memory_mb")):
+    # returns a list of regressions of more than tolerance against the baseline, matched by case name
+    with open(baseline_path) as baseline_file:
+        baseline = {result["name"]: result for result in json.load(baseline_file)["results"]}
+
+    regressions = []
+    for result in results:
+        base = baseline.get(result["name"])
+        if base is None:
+            continue
+        for metric in higher_is_better:
+            if metric in result and metric in base and result[metric] < base[metric] * (1 - tolerance):
+                regressions.append((result["name"], metric, base[metric], result[metric]))
+        for metric in lower_is_better:
+            if metric in result and metric in base and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append((result["name"], metric, base[metric], result[metric]))
+    return regressions
+
+
+def report_comparison(results, baseline_path, tolerance):
+    regressions = compare_results(results, baseline_path, tolerance)
+    if not regressions:
+        print(f"No regressions beyond {100 * tolerance:.0f}% against {baseline_path}")
+        return True
+    print(f"Regressions beyond {100 * tolerance:.0f}% against {baseline_path}:")
+    for name, metric, base_value, value in regressions:
+        print(f"  {name} {metric}: {base_value:.4g} -> {value:.4g} ({100 * (value / base_value - 1):+.1f}%)")
+    return False
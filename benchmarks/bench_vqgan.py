@@ -0,0 +1,156 @@
+import sys
+sys.path.append('.')
+import argparse
+import time
+import torch
+import models.vqgan as vqgan_module
+from benchmarks.bench_utils import get_bench_vqgan_hparams, add_bench_args, synchronize, peak_memory_mb, \
+    reset_peak_memory, get_environment, save_results, report_comparison
+from models.vqgan import VQGAN
+from utils.profile_utils import StepProfiler
+
+REGIMES = ["pre_disc", "post_disc"]
+
+
+def time_module(profiler, module, name):
+    # time every forward call of a submodule as a named phase
+    forward = module.forward
+
+    def timed_forward(*args, **kwargs):
+        with profiler.phase(name):
+            return forward(*args, **kwargs)
+
+    module.forward = timed_forward
+
+
+def instrument(profiler, vqgan):
+    time_module(profiler, vqgan.ae.encoder, "encoder")
+    time_module(profiler, vqgan.ae.quantize, "quantizer")
+    time_module(profiler, vqgan.ae.generator, "generator")
+    time_module(profiler, vqgan.perceptual, "lpips")
+    time_module(profiler, vqgan.disc, "discriminator")
+
+    # module level helpers are looked up in models.vqgan at call time, so are swapped there and restored afterwards
+    originals = {}
+    for attr, name in [("calculate_adaptive_weight", "adaptive_weight"), ("DiffAugment", "diff_augment")]:
+        originals[attr] = getattr(vqgan_module, attr)
+        setattr(vqgan_module, attr, timed_function(profiler, originals[attr], name))
+    return originals
+
+
+def timed_function(profiler, fn, name):
+    def timed_fn(*args, **kwargs):
+        with profiler.phase(name):
+            return fn(*args, **kwargs)
+    return timed_fn
+
+
+def train_step(profiler, vqgan, optim, d_optim, x, step):
+    x_hat, stats = vqgan.train_iter(x, step)
+    optim.zero_grad()
+    with profiler.phase("backward"):
+        stats["loss"].backward()
+    with profiler.phase("optimizer"):
+        optim.step()
+
+    if "d_loss" in stats:
+        d_optim.zero_grad()
+        with profiler.phase("disc_backward"):
+            stats["d_loss"].backward()
+        with profiler.phase("disc_optimizer"):
+            d_optim.step()
+
+
+def bench_regime(args, H, regime):
+    torch.manual_seed(args.seed)
+    vqgan = VQGAN(H).to(args.device).train()
+    optim = torch.optim.Adam(vqgan.ae.parameters(), lr=H.base_lr)
+    d_optim = torch.optim.Adam(vqgan.disc.parameters(), lr=H.base_lr)
+    x = torch.rand(H.batch_size, H.n_channels, H.img_size, H.img_size, device=args.device)
+    # the discriminator loss is only computed after disc_start_step
+    step = 0 if regime == "pre_disc" else H.disc_start_step + 1
+
+    # synchronise around every phase so asynchronous GPU work is attributed to the component that launched it
+    profiler = StepProfiler(enabled=False, sync=True, window=args.steps)
+    originals = instrument(profiler, vqgan)
+    try:
+        for _ in range(args.warmup):
+            train_step(profiler, vqgan, optim, d_optim, x, step)
+        synchronize(args.device)
+
+        # whole steps are timed with the profiler disabled so per-phase synchronisation does not inflate them
+        reset_peak_memory(args.device)
+        start_time = time.perf_counter()
+        for _ in range(args.steps):
+            train_step(profiler, vqgan, optim, d_optim, x, step)
+        synchronize(args.device)
+        step_time = (time.perf_counter() - start_time) / args.steps
+
+        profiler.enabled = True
+        for _ in range(args.steps):
+            train_step(profiler, vqgan, optim, d_optim, x, step)
+    finally:
+        for attr, fn in originals.items():
+            setattr(vqgan_module, attr, fn)
+
+    results = [{
+        "name": f"vqgan.train_step/{regime}",
+        "regime": regime,
+        "ms_per_step": 1000 * step_time,
+        "images_per_s": H.batch_size / step_time,
+        "peak_memory_mb": peak_memory_mb(args.device),
+    }]
+    print(f"{regime}: {1000 * step_time:.1f}ms/step, {H.batch_size / step_time:.1f} images/s")
+    for name, stats in profiler.summary().items():
+        ms_per_step = stats["total_ms"] / args.steps
+        results.append({
+            "name": f"vqgan.{name}/{regime}",
+            "regime": regime,
+            "ms_per_step": ms_per_step,
+            "calls_per_step": stats["count"] / args.steps,
+        })
+        print(f"  {name:18s} {ms_per_step:9.2f}ms/step ({100 * ms_per_step / (1000 * step_time):5.1f}%) "
+              f"x{stats['count'] // args.steps}")
+    return results
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    H = get_bench_vqgan_hparams(args.preset)
+    for key in ["batch_size", "img_size", "nf", "ch_mult", "ndf", "disc_layers"]:
+        if getattr(args, key) is not None:
+            H[key] = getattr(args, key)
+    H.diff_aug = args.diff_aug
+    H.lpips_random_init = not args.lpips_pretrained
+
+    results = []
+    for regime in args.regimes:
+        results += bench_regime(args, H, regime)
+
+    config = vars(args).copy()
+    config["environment"] = get_environment(args.device)
+    if args.output:
+        save_results(args.output, results, config)
+        print(f"Saved results to {args.output}")
+
+    if args.compare and not report_comparison(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Per-component timing of VQGAN training steps")
+    add_bench_args(parser)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--regimes", type=str, nargs="+", default=REGIMES, choices=REGIMES)
+    parser.add_argument("--batch_size", type=int)
+    parser.add_argument("--img_size", type=int)
+    parser.add_argument("--nf", type=int)
+    parser.add_argument("--ch_mult", type=int, nargs="+")
+    parser.add_argument("--ndf", type=int)
+    parser.add_argument("--disc_layers", type=int)
+    parser.add_argument("--diff_aug", const=True, action="store_const", default=False)
+    parser.add_argument("--lpips_pretrained", const=True, action="store_const", default=False,
+                        help="load pretrained VGG weights for LPIPS, downloading them if needed")
+    main(parser.parse_args())
@@ -1,15 +1,17 @@
 import sys
 sys.path.append('.')
 import torch_fidelity
-import torch
 from hparams import get_sampler_FID_hparams
 from utils.log_utils import log, config_log, start_training_log
-from utils.experiment_utils import generate_images_from_latents, generate_samples, get_generator_and_embedding_weight
+from utils.experiment_utils import generate_images_from_latents, generate_samples, get_generator_and_embedding_weight, \
+    load_latents
 from utils.data_utils import BigDataset, NoClassDataset, get_datasets
 
 
 def main(H):
-    real_dataset, _ = get_datasets(H.dataset, H.img_size, custom_dataset_path=H.custom_dataset_path)
+    real_dataset, _ = get_datasets(
+        H.dataset, H.img_size, custom_dataset_path=H.custom_dataset_path, cache_dir=H.image_cache_dir
+    )
     real_dataset = NoClassDataset(real_dataset)
 
     if not H.latents_path:
@@ -17,7 +19,7 @@ def main(H):
         generate_samples(H)
     else:
         log(f"Loading latents from {H.latents_path}")
-        latents = torch.load(H.latents_path)
+        latents = load_latents(H.latents_path)
         log("Generating samples from provided latents")
         generator, embedding_weight = get_generator_and_embedding_weight(H)
         generate_images_from_latents(H, latents, embedding_weight, generator)
@@ -5,10 +5,10 @@ import time
 from hparams import get_PRDC_hparams
 from torch_fidelity.utils import create_feature_extractor
 from tqdm import tqdm
-from utils.data_utils import BigDataset, NoClassDataset, get_datasets
+from utils.data_utils import BigDataset, NoClassDataset, get_datasets, get_batch_loader
 from utils.log_utils import log, config_log, start_training_log
 from utils.experiment_utils import generate_samples
-from prdc import compute_prdc
+from utils.prdc_utils import compute_prdc, load_features
 import os
 
 def spatial_average(in_tens, keepdim=True):
@@ -45,16 +45,19 @@ def main(H):
     os.makedirs('_pkl_files', exist_ok=True)
     if not H.real_feats:
         log(f"Generating real features for {H.dataset}")
-        real_dataset, _ = get_datasets(H.dataset, H.img_size, custom_dataset_path=H.custom_dataset_path)
+        real_dataset, _ = get_datasets(
+            H.dataset, H.img_size, custom_dataset_path=H.custom_dataset_path, cache_dir=H.image_cache_dir
+        )
         real_dataset = NoClassDataset(real_dataset, H.n_samples)  # n_images defaults to None
         real_data_loader = torch.utils.data.DataLoader(real_dataset, batch_size=H.batch_size)
         real_features = get_feats_from_loader(real_data_loader)
         timestamp = int(time.time())
         torch.save(real_features, f"_pkl_files/{H.dataset}_real_features_{timestamp}.pkl")
+        real_features = torch.cat(real_features, dim=0).numpy()
 
     else:
         log(f"Loading real features from _pkl_files/{H.real_feats}")
-        real_features = torch.load(f"_pkl_files/{H.real_feats}")
+        real_features = load_features(f"_pkl_files/{H.real_feats}")
 
     # get features from model-generated samples
     if not H.fake_feats:
@@ -66,24 +69,27 @@ def main(H):
             fake_images_path = H.fake_images_path
 
         fake_dataset = BigDataset(fake_images_path)
-        fake_data_loader = torch.utils.data.DataLoader(fake_dataset, batch_size=H.batch_size)
+        fake_data_loader = get_batch_loader(fake_dataset, H.batch_size)
         log("Generating fake samples features")
         fake_features = get_feats_from_loader(fake_data_loader)
         timestamp = int(time.time())
         torch.save(fake_features, f"_pkl_files/{H.dataset}_fake_features_{timestamp}.pkl")
+        fake_features = torch.cat(fake_features, dim=0).numpy()
 
     else:
         log(f"Loading fake features from _pkl_files/{H.fake_feats}")
-        fake_features = torch.load(f"_pkl_files/{H.fake_feats}")
+        fake_features = load_features(f"_pkl_files/{H.fake_feats}")
 
-    real_features = torch.cat(real_features, dim=0)[:H.n_samples].numpy()
-    fake_features = torch.cat(fake_features, dim=0)[:H.n_samples].numpy()
+    real_features = real_features[:H.n_samples]
+    fake_features = fake_features[:H.n_samples]
 
     log("Computing PRDC metrics...")
     metrics = compute_prdc(
         real_features=real_features,
         fake_features=fake_features,
-        nearest_k=3
+        nearest_k=H.nearest_k,
+        max_memory_mb=H.prdc_max_memory,
+        num_threads=H.prdc_threads
     )
     log(metrics)
 
@@ -8,7 +8,7 @@ from models.vqgan import VQGAN
 from tqdm import tqdm
 from hparams import get_sampler_hparams
 from utils.sampler_utils import get_sampler, retrieve_autoencoder_components_state_dicts
-from utils.data_utils import get_data_loaders, cycle
+from utils.data_utils import get_data_loaders, cycle, DevicePrefetcher
 from utils.log_utils import (
     log, log_stats, save_model,
     display_images, set_up_visdom,
@@ -27,8 +27,9 @@ def main(H, vis):
         H.img_size,
         H.batch_size,
         get_val_dataloader=True,
+        cache_dir=H.image_cache_dir
     )
-    train_iterator = cycle(train_loader)
+    train_iterator = DevicePrefetcher(cycle(train_loader), 'cuda')
 
     vqgan = load_model(vqgan, 'vqgan_ema', H.ae_load_step, H.ae_load_dir, strict=False)
 
@@ -41,9 +42,8 @@ def main(H, vis):
         "embedding.weight")
     embedding_weight = embedding_weight.cuda()
 
-    sampler = get_sampler(H, embedding_weight)
-    sampler = load_model(
-        sampler, f"{H.sampler}_ema", H.load_step, H.load_dir).cuda()
+    # quantized to int8 on the CPU if requested
+    sampler = get_sampler(H, embedding_weight, load_ema=True)
 
     sampler = sampler.eval()
     sampler.num_timesteps = 256
@@ -64,8 +64,6 @@ def main(H, vis):
         else:
             x = batch
 
-        x = x.cuda()
-
         optim.zero_grad()
         if H.amp:
             with torch.cuda.amp.autocast():
@@ -89,6 +87,7 @@ def main(H, vis):
             stats['loss'] = mean_loss
             step_time = time.time() - step_start_time
             stats['step_time'] = step_time
+            stats['data_wait_time'] = train_iterator.pop_wait_time()
             mean_losses = np.append(mean_losses, mean_loss)
             losses = np.array([])
             vis.line(
@@ -100,7 +99,8 @@ def main(H, vis):
             log_stats(step, stats)
 
         if step % H.steps_per_eval == 0 and step > 0:
-            sampler = sampler.cuda()
+            if not H.quantize_int8:
+                sampler = sampler.cuda()
             with torch.no_grad():
                 bpds = []
                 for x_val in tqdm(val_loader, total=len(val_loader)):
@@ -112,7 +112,7 @@ def main(H, vis):
                     nl_p_x_z = stats["nll_raw"]
 
                     z = stats["latent_ids"]
-                    nl_p_z = sampler.elbo(z)
+                    nl_p_z = sampler.elbo(z.to(sampler.device)).to(z.device)
 
                     pixels = 256 * 256 * 3
 
@@ -122,7 +122,8 @@ def main(H, vis):
                     break
             log(f"NLL approximation: {torch.tensor(bpds).mean()}")
 
-            sampler = sampler.cpu()
+            if not H.quantize_int8:
+                sampler = sampler.cpu()
 
         if step % H.steps_per_display_output == 0 and step > 0:
             display_images(vis, x, H, 'Original Images')
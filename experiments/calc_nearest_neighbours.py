@@ -5,9 +5,8 @@ import lpips
 import torch
 from models import Generator
 from hparams import get_sampler_hparams
-from utils.sampler_utils import retrieve_autoencoder_components_state_dicts, get_samples
-from utils.log_utils import log, set_up_visdom, config_log, start_training_log, load_model, save_images
-from train_sampler import get_sampler
+from utils.sampler_utils import retrieve_autoencoder_components_state_dicts, get_samples, get_sampler
+from utils.log_utils import log, set_up_visdom, config_log, start_training_log, save_images
 from tqdm import tqdm
 import torchvision
 
@@ -24,13 +23,11 @@ def main(H, vis):
     generator = Generator(H)
 
     data_loader, _ = get_data_loaders(
-        H.dataset, H.img_size, H.batch_size, shuffle=False)
+        H.dataset, H.img_size, H.batch_size, shuffle=False, cache_dir=H.image_cache_dir)
 
     generator.load_state_dict(quanitzer_and_generator_state_dict, strict=False)
     generator = generator.cuda()
-    sampler = get_sampler(H, embedding_weight).cuda()
-    sampler = load_model(
-        sampler, f"{H.sampler}_ema", H.load_step, H.load_dir).cuda()
+    sampler = get_sampler(H, embedding_weight, load_ema=True)
 
     samples = get_samples(H, generator, sampler)
     sampler = None
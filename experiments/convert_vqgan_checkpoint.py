@@ -0,0 +1,35 @@
+import sys
+sys.path.append('.')
+import os
+import torch
+from hparams import get_convert_hparams
+from utils.log_utils import log, config_log, start_training_log, save_model_components
+from utils.sampler_utils import VQGAN_COMPONENT_PREFIXES
+
+
+def main(H):
+    component_prefixes = {component: VQGAN_COMPONENT_PREFIXES[component] for component in H.components}
+    converted = False
+    for model_name in ["vqgan_ema", "vqgan"]:
+        load_path = f"logs/{H.load_dir}/saved_models/{model_name}_{H.load_step}.th"
+        if not os.path.exists(load_path):
+            continue
+        log(f"Converting {load_path}")
+        state_dict = torch.load(load_path, map_location="cpu")
+        save_model_components(state_dict, component_prefixes, model_name, H.load_step, H.load_dir)
+        converted = True
+
+    if not converted:
+        raise FileNotFoundError(f"No VQGAN checkpoints found in logs/{H.load_dir}/saved_models at step {H.load_step}")
+
+
+if __name__ == '__main__':
+    H = get_convert_hparams()
+    config_log(H.log_dir)
+    log('---------------------------------')
+    if H.load_step > 0:
+        log(f'Converting VQGAN checkpoints from {H.load_dir} at step {H.load_step}')
+        start_training_log(H)
+        main(H)
+    else:
+        raise ValueError("No value provided for --load_step, cannot convert checkpoint")
@@ -0,0 +1,103 @@
+import sys
+sys.path.append('.')
+import copy
+import io
+import time
+import torch
+import torch.nn.functional as F
+from hparams import get_quantization_eval_hparams
+from utils.log_utils import log, config_log, start_training_log, load_model
+from utils.sampler_utils import get_sampler, get_latent_loaders, quantize_sampler, \
+    retrieve_autoencoder_components_state_dicts
+
+
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1e6
+
+
+def get_logits(H, sampler, x_in, t):
+    if H.sampler == "absorbing":
+        return sampler._denoise_fn(x_in, t=t)
+    return sampler.net(x_in)
+
+
+@torch.no_grad()
+def compare_logits(H, fp32_sampler, int8_sampler, latent_loader):
+    kls, agreements, fp32_bpds, int8_bpds = [], [], [], []
+    for batch_idx, x in enumerate(latent_loader):
+        if batch_idx == H.eval_batches:
+            break
+
+        if H.sampler == "absorbing":
+            t, _ = fp32_sampler.sample_time(x.size(0), x.device)
+            x_in, _, positions = fp32_sampler.q_sample(x, t)
+        else:
+            t = None
+            x_in = x[:, :-1]
+            positions = torch.ones_like(x).bool()
+
+        fp32_log_probs = F.log_softmax(get_logits(H, fp32_sampler, x_in, t), dim=-1)[positions]
+        int8_log_probs = F.log_softmax(get_logits(H, int8_sampler, x_in, t), dim=-1)[positions]
+        kl = (fp32_log_probs.exp() * (fp32_log_probs - int8_log_probs)).sum(-1)
+        kls.append(kl.mean().item())
+        agreements.append((fp32_log_probs.argmax(-1) == int8_log_probs.argmax(-1)).float().mean().item())
+
+        # sample quality proxy: bits per dim of real latents, using the same noise for both models
+        seed = torch.randint(0, 2**31, (1,)).item()
+        stat = "vb_loss" if H.sampler == "absorbing" else "loss"
+        torch.manual_seed(seed)
+        fp32_bpds.append(fp32_sampler.train_iter(x)[stat].item())
+        torch.manual_seed(seed)
+        int8_bpds.append(int8_sampler.train_iter(x)[stat].item())
+
+    n = len(kls)
+    log(f"Logit KL(fp32 || int8): {sum(kls) / n:.3e}")
+    log(f"Top-1 agreement: {sum(agreements) / n:.4f}")
+    log(f"Bits per dim on training latents - fp32: {sum(fp32_bpds) / n:.4f}  int8: {sum(int8_bpds) / n:.4f}")
+
+
+@torch.no_grad()
+def time_sampling(H, sampler):
+    start_time = time.time()
+    if H.sampler == "absorbing":
+        latents = sampler.sample(sample_steps=H.sample_steps, temp=H.temp)
+    else:
+        latents = sampler.sample(H.temp)
+    return latents.numel() / (time.time() - start_time)
+
+
+def main(H):
+    embedding_weight = retrieve_autoencoder_components_state_dicts(
+        H,
+        ["quantize"],
+        remove_component_from_key=True
+    )["embedding.weight"]
+
+    fp32_sampler = get_sampler(H, embedding_weight)
+    fp32_sampler = load_model(fp32_sampler, f"{H.sampler}_ema", H.load_step, H.load_dir).cpu().eval()
+    int8_sampler = quantize_sampler(H, copy.deepcopy(fp32_sampler))
+
+    log(f"Model size - fp32: {model_size_mb(fp32_sampler):.1f}MB  int8: {model_size_mb(int8_sampler):.1f}MB")
+
+    latent_loader, _ = get_latent_loaders(H, get_validation_loader=False)
+    compare_logits(H, fp32_sampler, int8_sampler, latent_loader)
+
+    log(f"Timing CPU sampling with {torch.get_num_threads()} threads")
+    fp32_throughput = time_sampling(H, fp32_sampler)
+    int8_throughput = time_sampling(H, int8_sampler)
+    log(f"Tokens/s - fp32: {fp32_throughput:.1f}  int8: {int8_throughput:.1f}  "
+        f"speedup: {int8_throughput / fp32_throughput:.2f}x")
+
+
+if __name__ == "__main__":
+    H = get_quantization_eval_hparams()
+    config_log(H.log_dir)
+    log("---------------------------------")
+    if H.load_step > 0:
+        log(f"Comparing int8 and fp32 {H.sampler} samplers loaded from {H.load_dir} at step {H.load_step}")
+        start_training_log(H)
+        main(H)
+    else:
+        raise ValueError("No value provided for --load_step, cannot evaluate sampler")
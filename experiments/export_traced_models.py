@@ -0,0 +1,99 @@
+import sys
+sys.path.append('.')
+import torch
+from hparams import get_export_hparams
+from models import Generator
+from utils.log_utils import log, config_log, start_training_log, load_model, save_traced_model
+from utils.experiment_utils import get_traced_hparams, TRACED_GENERATOR_HPARAMS, TRACED_DENOISER_HPARAMS
+from utils.sampler_utils import get_sampler, retrieve_autoencoder_components_state_dicts
+
+
+def optimize_traced(traced):
+    traced = torch.jit.freeze(traced.eval())
+    # not available in older versions of torch
+    if hasattr(torch.jit, "optimize_for_inference"):
+        traced = torch.jit.optimize_for_inference(traced)
+    return traced
+
+
+def check_parity(name, eager_out, traced_out, tol):
+    max_diff = (eager_out.float() - traced_out.float()).abs().max().item()
+    log(f"{name} parity: max abs difference {max_diff:.3e} (tolerance {tol:.1e})")
+    if max_diff > tol:
+        raise RuntimeError(f"Traced {name} does not match eager model, not saving")
+
+
+@torch.no_grad()
+def export_generator(H, generator, embedding_weight):
+    generator = generator.cuda().eval()
+    # decode random codebook entries, as the generator would see during sampling
+    latent_ids = torch.randint(0, H.codebook_size, (H.batch_size, H.latent_shape[1], H.latent_shape[2])).cuda()
+    q = embedding_weight[latent_ids].permute(0, 3, 1, 2).contiguous()
+
+    traced = optimize_traced(torch.jit.trace(generator, (q,)))
+
+    # check on a different batch size to make sure the batch dimension was not baked in
+    q_check = q[:max(1, H.batch_size // 2)]
+    check_parity("generator", generator(q_check), traced(q_check), H.parity_tol)
+    save_traced_model(
+        traced, "generator_traced", H.ae_load_step, H.ae_load_dir,
+        hparams=get_traced_hparams(H, TRACED_GENERATOR_HPARAMS)
+    )
+
+
+@torch.no_grad()
+def export_denoiser(H, sampler):
+    sampler = sampler.cuda().eval()
+    seq_len = H.latent_shape[1] * H.latent_shape[2]
+    if H.sampler == "absorbing":
+        denoiser = sampler._denoise_fn
+        x = torch.randint(0, H.codebook_size + 1, (H.batch_size, seq_len)).cuda()
+        t = torch.full((H.batch_size,), H.total_steps // 2, dtype=torch.long).cuda()
+        traced = optimize_traced(torch.jit.trace(denoiser, (x, t)))
+        check_parity("denoiser", denoiser(x[:1], t=t[:1]), traced(x[:1], t=t[:1]), H.parity_tol)
+    elif H.sampler == "autoregressive":
+        if H.attn_backend == "chunked":
+            # tracing unrolls the chunk loop for one sequence length, but autoregressive sampling grows it
+            raise ValueError("Cannot export autoregressive sampler with chunked attention")
+        denoiser = sampler.net
+        x = torch.randint(0, H.codebook_size, (H.batch_size, seq_len - 1)).cuda()
+        traced = optimize_traced(torch.jit.trace(denoiser, (x,)))
+        check_parity("denoiser", denoiser(x[:1, :seq_len // 2]), traced(x[:1, :seq_len // 2]), H.parity_tol)
+
+    save_traced_model(
+        traced, f"{H.sampler}_ema_traced", H.load_step, H.load_dir,
+        hparams=get_traced_hparams(H, TRACED_DENOISER_HPARAMS)
+    )
+
+
+def main(H):
+    quanitzer_and_generator_state_dict = retrieve_autoencoder_components_state_dicts(
+        H,
+        ['quantize', 'generator'],
+        remove_component_from_key=True
+    )
+    embedding_weight = quanitzer_and_generator_state_dict.pop('embedding.weight').cuda()
+    generator = Generator(H)
+    generator.load_state_dict(quanitzer_and_generator_state_dict, strict=False)
+
+    log("Exporting generator")
+    export_generator(H, generator, embedding_weight)
+    del generator
+
+    sampler = get_sampler(H, embedding_weight)
+    sampler = load_model(sampler, f'{H.sampler}_ema', H.load_step, H.load_dir)
+
+    log(f"Exporting {H.sampler} denoiser")
+    export_denoiser(H, sampler)
+
+
+if __name__ == '__main__':
+    H = get_export_hparams()
+    config_log(H.log_dir)
+    log('---------------------------------')
+    if H.load_step > 0:
+        log(f'Exporting traced models for {H.sampler} loaded from {H.load_dir} at step {H.load_step}')
+        start_training_log(H)
+        main(H)
+    else:
+        raise ValueError("No value provided for --load_step, cannot export sampler")
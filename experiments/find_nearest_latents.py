@@ -0,0 +1,108 @@
+import sys
+sys.path.append('.')
+import json
+import os
+import time
+import numpy as np
+import torch
+from hparams import get_latent_search_hparams
+from models.sampler import Sampler
+from utils.experiment_utils import get_sampler_and_generator, get_generator_and_embedding_weight, \
+    generate_latents_range, load_latents
+from utils.latent_search_utils import get_codebook_distances, latent_topk
+from utils.log_utils import log, config_log, start_training_log
+from utils.sampler_utils import load_latent_ids, decode_latents, retrieve_autoencoder_components_state_dicts
+
+
+def get_query_latents(H):
+    # returns the generated latents to screen, and a sampler holding the codebook and the generator if a model had
+    # to be loaded
+    if H.latents_path:
+        log(f"Loading latents from {H.latents_path}")
+        latents = load_latents(H.latents_path)
+        return latents.view(latents.size(0), -1).cpu(), None, None
+
+    log(f"Sampling {H.n_samples} latents")
+    sampler, generator = get_sampler_and_generator(H)
+    latents = generate_latents_range(H, sampler, 0, H.n_samples, H.sample_seed)
+    # only the codebook is needed to decode, so the denoiser is freed before searching
+    sampler = Sampler(H, sampler.embedding_weight)
+    return latents.cpu(), sampler, generator
+
+
+@torch.no_grad()
+def save_nearest_images(H, queries, train_latents, indices, flagged, sampler, generator):
+    from torchvision.utils import save_image
+    if generator is None:
+        generator, embedding_weight = get_generator_and_embedding_weight(H)
+        sampler = Sampler(H, embedding_weight)
+    generator = generator.to(sampler.embedding_weight.device).eval()
+    images_dir = f"logs/{H.log_dir}/images"
+    os.makedirs(images_dir, exist_ok=True)
+
+    # one row per flagged sample: the sample followed by its nearest training latents
+    for idx in flagged:
+        neighbours = torch.from_numpy(np.asarray(train_latents[indices[idx].numpy()])).long()
+        images = decode_latents(H, generator, sampler, torch.cat([queries[idx:idx+1], neighbours])).cpu()
+        save_image(images.clamp(0, 1), f"{images_dir}/nearest_{idx}.png", nrow=images.size(0), padding=0)
+    log(f"Saved {len(flagged)} flagged samples and their nearest training latents to {images_dir}")
+
+
+def main(H):
+    latents_fp_suffix = "_flipped" if H.horizontal_flip else ""
+    train_latents_fp = f"latents/{H.dataset}_{H.latent_shape[-1]}_train_latents{latents_fp_suffix}"
+    train_latents = load_latent_ids(train_latents_fp, mmap=True)
+    queries, sampler, generator = get_query_latents(H)
+    seq_len = queries.size(1)
+    log(f"Searching {len(train_latents)} training latents for the {H.n_neighbours} nearest to {len(queries)} samples")
+
+    results = {}
+    for metric in H.search_metrics:
+        codebook_distances = None
+        if metric == "embedding":
+            if sampler is not None:
+                embedding_weight = sampler.embedding_weight
+            else:
+                embedding_weight = retrieve_autoencoder_components_state_dicts(
+                    H, ["quantize"], remove_component_from_key=True
+                )["embedding.weight"]
+            codebook_distances = get_codebook_distances(embedding_weight)
+
+        start_time = time.time()
+        distances, indices = latent_topk(
+            queries,
+            train_latents,
+            k=H.n_neighbours,
+            codebook_distances=codebook_distances,
+            chunk_size=H.search_chunk_size,
+            num_threads=H.search_threads
+        )
+        # per token, so hamming distances are the fraction of tokens that differ
+        distances = distances / seq_len
+        log(f"{metric} search took {time.time() - start_time:.2f}s, mean nearest distance {distances[:, 0].mean():.4f}")
+        results[metric] = {"distances": distances.tolist(), "indices": indices.tolist()}
+
+        if metric == "hamming":
+            flagged = torch.nonzero(distances[:, 0] <= H.copy_threshold).flatten().tolist()
+            log(f"{len(flagged)} of {len(queries)} samples differ from a training latent in at most "
+                f"{100 * H.copy_threshold:.1f}% of tokens")
+            results["flagged"] = flagged
+            if H.save_images and flagged:
+                save_nearest_images(H, queries, train_latents, indices, flagged, sampler, generator)
+
+    results_path = f"logs/{H.log_dir}/nearest_latents.json"
+    with open(results_path, "w") as f:
+        json.dump(results, f)
+    log(f"Saved nearest training latents to {results_path}")
+
+
+if __name__ == '__main__':
+    H = get_latent_search_hparams()
+    config_log(H.log_dir)
+    log('---------------------------------')
+    if H.latents_path or H.load_step > 0:
+        log(f'Finding the nearest {H.dataset} training latents to generated latents')
+        start_training_log(H)
+        main(H)
+    else:
+        raise ValueError("No value provided for --latents_path or --load_step, cannot find samples to search for")
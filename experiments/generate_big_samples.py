@@ -3,9 +3,8 @@ sys.path.append('.')
 import torch
 from hparams import get_big_samples_hparams
 from models import Generator
-from train_sampler import get_sampler
-from utils.log_utils import (config_log, load_model, log, set_up_visdom, start_training_log)
-from utils.sampler_utils import (latent_ids_to_onehot, retrieve_autoencoder_components_state_dicts)
+from utils.log_utils import (config_log, log, set_up_visdom, start_training_log)
+from utils.sampler_utils import (latent_ids_to_onehot, retrieve_autoencoder_components_state_dicts, get_sampler)
 
 
 def main(H, vis):
@@ -21,17 +20,22 @@ def main(H, vis):
     generator.load_state_dict(quanitzer_and_generator_state_dict, strict=False)
     generator = generator.cuda()
 
-    model = get_sampler(H, embedding_weight)
-    model = load_model(model, H.sampler + '_ema', H.load_step, H.load_dir).cuda()
+    model = get_sampler(H, embedding_weight, load_ema=True)
     model = model.eval()
 
     shape = (1, H.shape[0], H.shape[1])
     log(f"Generating latents of shape: {shape}")
-    step = 1
     time_steps = shape[1] * shape[2]
 
     with torch.no_grad():
-        latents = model.sample_shape(shape[1:], H.batch_size, time_steps=time_steps, step=step)
+        latents = model.sample_shape(
+            shape[1:],
+            H.batch_size,
+            time_steps=time_steps,
+            step=H.window_step,
+            max_windows=H.max_windows,
+            windows_per_forward=H.windows_per_forward
+        )
         latents_one_hot = latent_ids_to_onehot(latents, shape, H.codebook_size).cuda()
 
         q = torch.matmul(latents_one_hot, embedding_weight).view(
@@ -40,7 +44,12 @@ def main(H, vis):
         all_images = []
         del model
         for image_latents in torch.split(q, 8):
-            all_images.append(generator(image_latents))
+            if H.decode_tile_size:
+                all_images.append(generator.decode_tiled(
+                    image_latents, H.decode_tile_size, H.decode_overlap, tiles_per_batch=H.decode_tiles_per_batch
+                ))
+            else:
+                all_images.append(generator(image_latents))
         gen_images = torch.cat(all_images, dim=0)
         vis.images(gen_images.clamp(0, 1), win='large_samples', opts=dict(title='large_samples'))
 
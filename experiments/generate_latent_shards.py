@@ -0,0 +1,32 @@
+import sys
+sys.path.append('.')
+from hparams import get_sample_shard_hparams
+from utils.experiment_utils import get_sampler_and_generator, get_shard_range, generate_latents_range, \
+    save_latents_shard, merge_latents_shards
+from utils.log_utils import log, config_log, start_training_log
+
+
+def main(H):
+    if H.merge:
+        merge_latents_shards(H.latents_store, H.n_samples)
+        return
+
+    start, end = get_shard_range(H.n_samples, H.batch_size, H.num_shards, H.shard_index)
+    if start == end:
+        log(f"Shard {H.shard_index} of {H.num_shards} has no samples to generate")
+        return
+    log(f"Generating samples {start}-{end} of {H.n_samples} with seed {H.sample_seed}")
+    sampler, _ = get_sampler_and_generator(H)
+    latents = generate_latents_range(H, sampler, start, end, H.sample_seed)
+    save_latents_shard(latents, H.latents_store, start, end)
+
+
+if __name__ == '__main__':
+    H = get_sample_shard_hparams()
+    config_log(H.log_dir)
+    log('---------------------------------')
+    if H.load_step > 0:
+        start_training_log(H)
+        main(H)
+    else:
+        raise ValueError("No value provided for --load_step, cannot generate samples")
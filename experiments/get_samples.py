@@ -2,7 +2,7 @@ import sys
 sys.path.append('.')
 from models import Generator
 from hparams import get_sampler_hparams
-from utils.log_utils import save_images, set_up_visdom, config_log, log, start_training_log, display_images, load_model
+from utils.log_utils import save_images, set_up_visdom, config_log, log, start_training_log, display_images
 from utils.sampler_utils import get_sampler, get_samples, retrieve_autoencoder_components_state_dicts
 
 def main(H, vis):
@@ -22,9 +22,7 @@ def main(H, vis):
 
     generator.load_state_dict(quanitzer_and_generator_state_dict, strict=False)
     generator = generator.cuda()
-    sampler = get_sampler(H, embedding_weight).cuda()
-
-    sampler = load_model(sampler, f'{H.sampler}_ema', H.load_step, H.load_dir)
+    sampler = get_sampler(H, embedding_weight, load_ema=True)
     sampler.n_samples = 25  # get samples in 5x5 grid
 
     for i in range(100):
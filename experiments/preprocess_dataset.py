@@ -0,0 +1,37 @@
+import sys
+sys.path.append('.')
+from hparams import get_preprocess_hparams
+from utils.data_utils import get_datasets, get_dataset_path, get_shard_cache_dir, has_val_dataset, write_image_shards
+from utils.log_utils import log, config_log, start_training_log
+
+
+def main(H):
+    # every training image is written, datasets without their own validation images are split when loaded, so
+    # the same shards serve runs with and without a validation set
+    train_dataset, val_dataset = get_datasets(
+        H.dataset,
+        H.img_size,
+        get_val_dataset=has_val_dataset(H.dataset),
+        custom_dataset_path=H.custom_dataset_path,
+    )
+    dataset_path = get_dataset_path(H.dataset, H.custom_dataset_path)
+
+    for split, dataset in [("train", train_dataset), ("val", val_dataset)]:
+        if dataset is None:
+            continue
+        folder = get_shard_cache_dir(H.image_cache_dir, H.dataset, H.img_size, split)
+        log(f"Writing {len(dataset)} {split} images to {folder}")
+        write_image_shards(dataset, folder, shard_size=H.shard_size, batch_size=H.batch_size,
+                           num_workers=H.num_workers, dataset_path=dataset_path)
+
+
+if __name__ == '__main__':
+    H = get_preprocess_hparams()
+    config_log(H.log_dir)
+    log('---------------------------------')
+    if H.image_cache_dir:
+        log(f'Preprocessing {H.dataset} images at size {H.img_size}')
+        start_training_log(H)
+        main(H)
+    else:
+        raise ValueError("No value provided for --image_cache_dir, cannot write image shards")
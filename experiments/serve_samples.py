@@ -0,0 +1,370 @@
+import sys
+sys.path.append('.')
+import asyncio
+import io
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import numpy as np
+import torch
+from hparams import get_serve_hparams
+from models import SamplingEngine
+from models.sampling_kernels import get_sample_generators
+from utils.experiment_utils import get_sampler_and_generator
+from utils.log_utils import log, config_log, start_training_log
+from utils.sampler_utils import decode_latents, sample_latents
+
+MAX_BODY_BYTES = 2**16
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class SampleRequest:
+    def __init__(self, count, temp, sample_steps, seed, output_format):
+        self.count = count
+        self.temp = temp
+        self.sample_steps = sample_steps
+        self.seed = seed
+        self.output_format = output_format
+        self.arrival_time = time.perf_counter()
+        # progress when sampled by the continuous batching engine
+        self.admitted = 0
+        self.results = {}
+        self.future = asyncio.get_event_loop().create_future()
+
+    @property
+    def batch_key(self):
+        # requests can only share a static batch if they sample with the same settings
+        return (self.temp, self.sample_steps, self.seed)
+
+
+def parse_sample_request(H, body):
+    try:
+        params = json.loads(body.decode() or "{}")
+        request = SampleRequest(
+            count=int(params.get("count", 1)),
+            temp=float(params.get("temperature", H.temp)),
+            sample_steps=int(params.get("sample_steps", H.sample_steps)),
+            seed=None if params.get("seed") is None else int(params["seed"]),
+            output_format=params.get("format", "png"),
+        )
+    except (ValueError, TypeError, AttributeError) as e:
+        raise HTTPError(400, f"Invalid request: {e}")
+
+    if not 1 <= request.count <= H.max_batch_size:
+        raise HTTPError(400, f"count must be between 1 and {H.max_batch_size}")
+    if request.temp <= 0:
+        raise HTTPError(400, "temperature must be positive")
+    if not 1 <= request.sample_steps <= H.total_steps:
+        raise HTTPError(400, f"sample_steps must be between 1 and {H.total_steps}")
+    if request.output_format not in ["png", "raw"]:
+        raise HTTPError(400, "format must be png or raw")
+    return request
+
+
+def encode_png(images):
+    # PIL is installed with torchvision, only needed when PNGs are requested
+    from PIL import Image
+    n, h, w, c = images.shape
+    ncol = int(np.ceil(np.sqrt(n)))
+    nrow = int(np.ceil(n / ncol))
+    grid = np.zeros((nrow * h, ncol * w, c), dtype=np.uint8)
+    for idx, image in enumerate(images):
+        row, col = divmod(idx, ncol)
+        grid[row*h:(row+1)*h, col*w:(col+1)*w] = image
+    buffer = io.BytesIO()
+    Image.fromarray(grid).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class Metrics:
+    def __init__(self, window=1000):
+        self.start_time = time.time()
+        self.requests = 0
+        self.images = 0
+        self.batches = 0
+        self.batch_images = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=window)
+        self.batch_times = deque(maxlen=window)
+
+    def summary(self, queue_depth, queued_images):
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {
+            "uptime_s": time.time() - self.start_time,
+            "queue_depth": queue_depth,
+            "queued_images": queued_images,
+            "requests_total": self.requests,
+            "images_total": self.images,
+            "errors_total": self.errors,
+            "batches_total": self.batches,
+            "mean_batch_size": self.batch_images / max(1, self.batches),
+            "mean_batch_time_ms": 1000 * float(np.mean(self.batch_times)) if self.batch_times else 0.0,
+            "latency_p50_ms": float(np.percentile(latencies, 50)),
+            "latency_p90_ms": float(np.percentile(latencies, 90)),
+            "latency_p99_ms": float(np.percentile(latencies, 99)),
+        }
+
+
+class SampleServer:
+    def __init__(self, H, sampler, generator):
+        self.H = H
+        self.sampler = sampler
+        self.generator = generator
+        self.pending = []
+        self.new_request = asyncio.Event()
+        self.metrics = Metrics()
+        # the models are not thread safe, so every batch runs on the same single worker thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # continuous batching needs the per-row random unmasking schedule of diffusion sampling
+        self.engine = None
+        if H.sampler == "absorbing" and H.sample_type == "diffusion" and H.unmask_schedule == "random" \
+                and not H.static_batching:
+            self.engine = SamplingEngine(sampler, H.max_batch_size)
+
+    def uses_engine(self, request):
+        # seeded requests are sampled alone so their output does not depend on what else was in the queue
+        return self.engine is not None and request.seed is None
+
+    @torch.no_grad()
+    def sample_batch(self, temp, sample_steps, seed, batch_size):
+        generators = None
+        if seed is not None:
+            # per sample streams leave the global random state of the server untouched. they are created where
+            # sampling runs, the CPU for quantized samplers even while the codebook stays on the GPU
+            generators = get_sample_generators(seed, range(batch_size), self.sampler.device)
+            if self.H.sample_type == "mlm":
+                # mlm sampling has no per sample streams and draws from the global generator
+                torch.manual_seed(seed)
+        self.sampler.n_samples = batch_size
+        latents = sample_latents(self.H, self.sampler, temp=temp, sample_steps=sample_steps, generators=generators)
+        return self.decode(latents)
+
+    @torch.no_grad()
+    def decode(self, latents):
+        images = decode_latents(self.H, self.generator, self.sampler, latents)
+        return (images.clamp(0, 1) * 255).round().to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+
+    def engine_step(self):
+        finished = self.engine.step()
+        if not finished:
+            return [], None
+        row_ids = [row_id for row_id, _ in finished]
+        return row_ids, self.decode(torch.stack([latents for _, latents in finished]))
+
+    def next_batch(self):
+        # serve the oldest request first, then fill the batch with queued requests that share its settings
+        key = next(r.batch_key for r in self.pending if not self.uses_engine(r))
+        batch, batch_size, remaining = [], 0, []
+        for request in self.pending:
+            # seeded requests are never merged, even with identical settings, as the batch size changes the output
+            seeded_batch = bool(batch) and batch[0].seed is not None
+            if not self.uses_engine(request) and request.batch_key == key and not seeded_batch \
+                    and batch_size + request.count <= self.H.max_batch_size:
+                batch.append(request)
+                batch_size += request.count
+            else:
+                remaining.append(request)
+        self.pending = remaining
+        return batch, batch_size
+
+    async def wait_for_batch(self):
+        # give concurrent requests a short window to join the batch
+        deadline = self.pending[0].arrival_time + self.H.max_wait_ms / 1000
+        while sum(r.count for r in self.pending) < self.H.max_batch_size and time.perf_counter() < deadline:
+            self.new_request.clear()
+            try:
+                await asyncio.wait_for(self.new_request.wait(), deadline - time.perf_counter())
+            except asyncio.TimeoutError:
+                break
+
+    async def run_static_batch(self):
+        loop = asyncio.get_event_loop()
+        batch, batch_size = self.next_batch()
+        temp, sample_steps, seed = batch[0].batch_key
+        start_time = time.perf_counter()
+        try:
+            images = await loop.run_in_executor(
+                self.executor, self.sample_batch, temp, sample_steps, seed, batch_size)
+        except Exception as e:
+            log(f"Sampling failed: {e}")
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        self.metrics.batches += 1
+        self.metrics.batch_images += batch_size
+        self.metrics.batch_times.append(time.perf_counter() - start_time)
+        offset = 0
+        for request in batch:
+            request.future.set_result(images[offset:offset + request.count])
+            offset += request.count
+
+    def admit_requests(self):
+        # fill free slots with images from the oldest requests, a request may be spread over several steps
+        remaining = []
+        for request in self.pending:
+            if self.uses_engine(request):
+                while request.admitted < request.count and self.engine.admit(
+                        (request, request.admitted), request.temp, request.sample_steps):
+                    request.admitted += 1
+                if request.admitted < request.count:
+                    remaining.append(request)
+            else:
+                remaining.append(request)
+        self.pending = remaining
+
+    async def run_engine_step(self):
+        loop = asyncio.get_event_loop()
+        batch_size = self.engine.num_active
+        start_time = time.perf_counter()
+        try:
+            row_ids, images = await loop.run_in_executor(self.executor, self.engine_step)
+        except Exception as e:
+            # the engine state can no longer be trusted, so fail everything it holds
+            log(f"Sampling failed: {e}")
+            for row_id in set(self.engine.slot_ids):
+                if row_id is not None and not row_id[0].future.done():
+                    row_id[0].future.set_exception(e)
+            # failed requests that were only partly admitted must not be admitted again
+            self.pending = [request for request in self.pending if not request.future.done()]
+            self.engine = SamplingEngine(self.sampler, self.H.max_batch_size)
+            return
+
+        self.metrics.batches += 1
+        self.metrics.batch_images += batch_size
+        self.metrics.batch_times.append(time.perf_counter() - start_time)
+        for (request, index), image in zip(row_ids, images if images is not None else []):
+            request.results[index] = image
+            if len(request.results) == request.count and not request.future.done():
+                request.future.set_result(np.stack([request.results[i] for i in range(request.count)]))
+
+    async def batch_loop(self):
+        while True:
+            engine_busy = self.engine is not None and self.engine.num_active > 0
+            if not self.pending and not engine_busy:
+                self.new_request.clear()
+                await self.new_request.wait()
+
+            if any(not self.uses_engine(r) for r in self.pending):
+                if self.engine is None:
+                    await self.wait_for_batch()
+                await self.run_static_batch()
+
+            if self.engine is not None:
+                # new requests join between denoising steps rather than waiting for the batch to finish
+                self.admit_requests()
+                if self.engine.num_active > 0:
+                    await self.run_engine_step()
+
+    async def handle_sample(self, body):
+        request = parse_sample_request(self.H, body)
+        self.pending.append(request)
+        self.new_request.set()
+        images = await request.future
+
+        if request.output_format == "png":
+            payload, headers = encode_png(images), {"Content-Type": "image/png"}
+        else:
+            payload = images.tobytes()
+            headers = {"Content-Type": "application/octet-stream", "X-Shape": ",".join(map(str, images.shape))}
+
+        self.metrics.requests += 1
+        self.metrics.images += request.count
+        self.metrics.latencies.append(time.perf_counter() - request.arrival_time)
+        return 200, payload, headers
+
+    def handle_metrics(self):
+        queued_images = sum(r.count - r.admitted for r in self.pending)
+        summary = self.metrics.summary(len(self.pending), queued_images)
+        summary["continuous_batching"] = self.engine is not None
+        summary["active_slots"] = self.engine.num_active if self.engine is not None else 0
+        return 200, json.dumps(summary).encode(), {"Content-Type": "application/json"}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            status, payload, headers = await self.route(reader)
+        except HTTPError as e:
+            status, payload, headers = e.status, json.dumps({"error": str(e)}).encode(), {}
+        except Exception as e:
+            log(f"Error handling request: {e}")
+            self.metrics.errors += 1
+            status, payload, headers = 500, json.dumps({"error": str(e)}).encode(), {}
+        headers.setdefault("Content-Type", "application/json")
+        headers["Content-Length"] = str(len(payload))
+        headers["Connection"] = "close"
+        head = f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        writer.write(head.encode() + b"\r\n" + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def route(self, reader):
+        try:
+            request_line = (await reader.readline()).decode().split()
+            method, path = request_line[0], urlsplit(request_line[1]).path
+        except (UnicodeDecodeError, IndexError):
+            raise HTTPError(400, "Malformed request line")
+
+        content_length = 0
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "content-length":
+                try:
+                    content_length = int(value)
+                except ValueError:
+                    raise HTTPError(400, "Invalid Content-Length")
+        if content_length < 0:
+            raise HTTPError(400, "Invalid Content-Length")
+        if content_length > MAX_BODY_BYTES:
+            raise HTTPError(400, "Request body too large")
+        body = await reader.readexactly(content_length) if content_length else b""
+
+        if path == "/sample":
+            if method != "POST":
+                raise HTTPError(405, "Use POST for /sample")
+            return await self.handle_sample(body)
+        elif path == "/metrics":
+            return self.handle_metrics()
+        raise HTTPError(404, f"Unknown path {path}")
+
+
+async def serve(H, sampler, generator):
+    server = SampleServer(H, sampler, generator)
+    batch_task = asyncio.ensure_future(server.batch_loop())
+    http_server = await asyncio.start_server(server.handle_connection, H.host, H.port)
+    log(f"Serving samples on http://{H.host}:{H.port} (POST /sample, GET /metrics)")
+    try:
+        await http_server.serve_forever()
+    finally:
+        batch_task.cancel()
+
+
+def main(H):
+    sampler, generator = get_sampler_and_generator(H)
+    generator = generator.to(sampler.embedding_weight.device).eval()
+    asyncio.get_event_loop().run_until_complete(serve(H, sampler, generator))
+
+
+if __name__ == '__main__':
+    H = get_serve_hparams()
+    config_log(H.log_dir)
+    log('---------------------------------')
+    if H.load_step > 0:
+        log(f'Serving {H.sampler} sampler loaded from {H.load_dir} at step {H.load_step}')
+        start_training_log(H)
+        main(H)
+    else:
+        raise ValueError("No value provided for --load_step, cannot serve samples")
@@ -0,0 +1,134 @@
+import sys
+sys.path.append('.')
+import json
+import time
+import torch
+from models.sampling_kernels import get_sample_seed
+from hparams import get_sample_sweep_hparams
+from tqdm import tqdm
+from utils.data_utils import BigDataset, NoClassDataset, get_datasets, get_batch_loader
+from utils.experiment_utils import get_sampler_and_generator, generate_latents_range, generate_images_from_latents
+from utils.log_utils import log, config_log, start_training_log
+from utils.prdc_utils import compute_prdc, load_features
+
+
+def parse_schedule(schedule):
+    # "cosine:confidence" -> ("cosine", "confidence")
+    unmask_schedule, _, unmask_order = schedule.partition(":")
+    return unmask_schedule, unmask_order or "random"
+
+
+def count_denoiser_calls(H, sampler, sample_steps):
+    if H.unmask_schedule == "random":
+        return sample_steps
+    counts = sampler.get_unmask_counts(sample_steps, H.unmask_schedule, H.max_tokens_per_step or 0)
+    return sum(n_tokens > 0 for n_tokens in counts)
+
+
+@torch.no_grad()
+def get_inception_features(dataset, batch_size):
+    from torch_fidelity.utils import create_feature_extractor
+    feat_extractor = create_feature_extractor('inception-v3-compat', ['2048']).cuda()
+    features = []
+    for batch in tqdm(get_batch_loader(dataset, batch_size)):
+        features.append(feat_extractor.forward(batch.cuda())[0].cpu())
+    return torch.cat(features, dim=0).numpy()
+
+
+def get_real_features(H, real_dataset):
+    if H.real_feats:
+        log(f"Loading real features from _pkl_files/{H.real_feats}")
+        return load_features(f"_pkl_files/{H.real_feats}")[:H.n_samples]
+    log(f"Generating real features for {H.dataset}")
+    return get_inception_features(NoClassDataset(real_dataset, H.n_samples), H.batch_size)
+
+
+def evaluate_images(H, images_path, real_dataset, real_features=None):
+    import torch_fidelity
+    fake_dataset = BigDataset(images_path)
+    metrics = torch_fidelity.calculate_metrics(
+        input1=fake_dataset,
+        input2=NoClassDataset(real_dataset),
+        cuda=True,
+        fid=True,
+        verbose=False,
+        input2_cache_name=f"{H.dataset}_cache" if H.dataset != "custom" else None,
+    )
+    results = {"fid": metrics["frechet_inception_distance"]}
+
+    if real_features is not None:
+        fake_features = get_inception_features(fake_dataset, H.batch_size)
+        results.update(compute_prdc(
+            real_features=real_features,
+            fake_features=fake_features,
+            nearest_k=3,
+            max_memory_mb=H.prdc_max_memory,
+            num_threads=H.prdc_threads
+        ))
+    return results
+
+
+def main(H):
+    if H.sampler != "absorbing" or H.sample_type != "diffusion":
+        raise ValueError("Unmasking schedules are only supported for absorbing diffusion sampling")
+
+    real_dataset, _ = get_datasets(
+        H.dataset, H.img_size, custom_dataset_path=H.custom_dataset_path, cache_dir=H.image_cache_dir
+    )
+    real_features = get_real_features(H, real_dataset) if H.prdc else None
+    sampler, generator = get_sampler_and_generator(H)
+    embedding_weight = sampler.embedding_weight.cuda().clone()
+
+    # recorded with the images when they are saved to a sample store
+    seeds = [get_sample_seed(H.sample_seed, i) for i in range(H.n_samples)]
+    sweep_log_dir = H.log_dir
+    results = []
+    for schedule in H.sweep_schedules:
+        H.unmask_schedule, H.unmask_order = parse_schedule(schedule)
+        for sample_steps in H.sweep_steps:
+            H.sample_steps = sample_steps
+            name = f"{schedule.replace(':', '_')}_{sample_steps}"
+            log(f"Sampling {H.n_samples} images with the {schedule} schedule and {sample_steps} steps")
+
+            # every setting uses the same per-sample random streams, so differences come from the schedule alone
+            start_time = time.time()
+            latents = generate_latents_range(H, sampler, 0, H.n_samples, H.sample_seed)
+            sampling_time = time.time() - start_time
+
+            H.log_dir = f"{sweep_log_dir}/{name}"
+            generate_images_from_latents(H, latents, embedding_weight, generator, seeds)
+            H.log_dir = sweep_log_dir
+
+            result = {
+                "schedule": schedule,
+                "sample_steps": sample_steps,
+                "denoiser_calls": count_denoiser_calls(H, sampler, sample_steps),
+                "seconds_per_sample": sampling_time / H.n_samples,
+            }
+            result.update(evaluate_images(H, f"logs/{sweep_log_dir}/{name}/images/", real_dataset, real_features))
+            log(result)
+            results.append(result)
+
+    results_path = f"logs/{sweep_log_dir}/sweep_results.json"
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+
+    metric_names = [k for k in results[0] if k not in ["schedule", "sample_steps"]]
+    log(f"{'schedule':<20}{'steps':>8}" + "".join(f"{k:>20}" for k in metric_names))
+    for result in results:
+        log(f"{result['schedule']:<20}{result['sample_steps']:>8}" + "".join(
+            f"{result[k]:>20.4f}" if isinstance(result[k], float) else f"{result[k]:>20}" for k in metric_names
+        ))
+    log(f"Saved sweep results to {results_path}")
+
+
+if __name__ == '__main__':
+    H = get_sample_sweep_hparams()
+    config_log(H.log_dir)
+    log('---------------------------------')
+    if H.load_step > 0:
+        log(f'Sweeping unmasking schedules for sampler in {H.load_dir} at step {H.load_step}')
+        start_training_log(H)
+        main(H)
+    else:
+        raise ValueError("No value provided for --load_step, cannot sample from new model")
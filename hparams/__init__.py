@@ -1,3 +1,6 @@
 from .set_up_hparams import (
-    get_vqgan_hparams, get_sampler_hparams, get_PRDC_hparams, get_sampler_FID_hparams, get_big_samples_hparams
+    get_vqgan_hparams, get_sampler_hparams, get_PRDC_hparams, get_sampler_FID_hparams, get_big_samples_hparams,
+    get_export_hparams, get_quantization_eval_hparams, get_preprocess_hparams, get_convert_hparams,
+    get_serve_hparams, get_sample_shard_hparams, get_sample_sweep_hparams,
+    get_latent_search_hparams
 )
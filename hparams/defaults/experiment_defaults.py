@@ -19,19 +19,162 @@ def add_PRDC_args(parser):
         required=True,
         help="Number of fake images to generate and real images to use for metric calculation"
     )
-    parser.add_argument("--real_feats", type=str, help="Name of (pkl) file containing real features")
+    parser.add_argument(
+        "--real_feats",
+        type=str,
+        help="Name of file containing real features: pkl, torch-fidelity feature cache or memory-mapped npy"
+    )
     parser.add_argument(
         "--fake_feats",
         type=str,
-        help="Name of (pkl) file containing fake features, stored in src/_pkl_files/"
+        help="Name of file containing fake features, stored in src/_pkl_files/"
     )
     parser.add_argument(
         "--fake_images_path",
         type=str,
         help="Path to folder containing sampled images, if not provided, will attempt to generate images instead"
     )
+    parser.add_argument("--nearest_k", type=int, default=3)
+    add_PRDC_compute_args(parser)
+
+
+# PRDC is computed in blocks of pairwise distances, bounded in total by --prdc_max_memory
+def add_PRDC_compute_args(parser):
+    parser.add_argument("--prdc_max_memory", type=int, default=1024, help="Memory for pairwise distances in MB")
+    parser.add_argument("--prdc_threads", type=int, default=4)
 
 
 def add_big_sample_args(parser):
     parser.add_argument("--shape", type=int, nargs=2, help="Shape of latents to generate. Pass as two seperate integers"
                         ", in the form H W", required=True)
+    parser.add_argument("--window_step", type=int, default=1, help="Stride between the windows that are denoised")
+    parser.add_argument(
+        "--max_windows",
+        type=int,
+        help="Denoise a random subset of at most this many windows per step instead of every window"
+    )
+    parser.add_argument("--windows_per_forward", type=int, default=1, help="Windows denoised in one forward pass")
+    parser.add_argument(
+        "--decode_tile_size",
+        type=int,
+        help="Decode the latents in overlapping tiles of this many latents, bounding the generator's memory"
+    )
+    parser.add_argument("--decode_overlap", type=int, default=4, help="Overlap between decoded tiles in latents")
+    parser.add_argument("--decode_tiles_per_batch", type=int, default=8)
+
+
+def add_export_args(parser):
+    parser.add_argument(
+        "--parity_tol",
+        type=float,
+        default=1e-3,
+        help="Maximum absolute difference allowed between exported and eager model outputs"
+    )
+
+
+def add_quantization_eval_args(parser):
+    parser.add_argument(
+        "--eval_batches",
+        type=int,
+        default=10,
+        help="Number of batches of training latents used to compare int8 and fp32 samplers"
+    )
+
+
+def add_preprocess_args(parser):
+    parser.add_argument("--shard_size", type=int, default=10000, help="Number of images stored in each shard")
+    parser.add_argument("--num_workers", type=int, default=8, help="Number of workers used to decode images")
+
+
+def add_convert_args(parser):
+    parser.add_argument(
+        "--components",
+        type=str,
+        nargs="+",
+        default=["encoder", "quantize", "generator", "discriminator"],
+        help="VQGAN components to write, each is stored separately so loaders only read what they need"
+    )
+
+
+def add_serve_args(parser):
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        help="Maximum number of images denoised together, defaults to --batch_size"
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=10.0,
+        help="How long to wait for further requests to join a batch once one has arrived"
+    )
+    parser.add_argument(
+        "--static_batching",
+        const=True,
+        action="store_const",
+        default=False,
+        help="Sample each batch to completion instead of admitting new requests between denoising steps"
+    )
+
+
+def add_sample_shard_args(parser):
+    parser.add_argument("--n_samples", type=int, required=True, help="Total number of samples across all shards")
+    parser.add_argument("--latents_store", type=str, required=True, help="Directory shared by all workers")
+    parser.add_argument("--sample_seed", type=int, default=0, help="Seed that sample i's random stream is derived from")
+    parser.add_argument("--num_shards", type=int, default=1)
+    parser.add_argument("--shard_index", type=int, default=0)
+    parser.add_argument(
+        "--merge",
+        const=True,
+        action="store_const",
+        default=False,
+        help="Check that the shards in --latents_store cover every sample and merge them, instead of sampling"
+    )
+
+
+def add_sample_sweep_args(parser):
+    parser.add_argument("--n_samples", type=int, required=True, help="Number of samples generated for every setting")
+    parser.add_argument(
+        "--sweep_schedules",
+        type=str,
+        nargs="+",
+        default=["random", "linear", "cosine", "cosine:confidence"],
+        help="Unmasking schedules to compare, each as schedule or schedule:order"
+    )
+    parser.add_argument("--sweep_steps", type=int, nargs="+", default=[16, 32, 64, 128, 256])
+    parser.add_argument("--sample_seed", type=int, default=0, help="Every setting samples from the same random streams")
+    parser.add_argument(
+        "--prdc",
+        const=True,
+        action="store_const",
+        default=False,
+        help="Also calculate precision, recall, density and coverage"
+    )
+    parser.add_argument("--real_feats", type=str, help="Name of (pkl) file in _pkl_files/ containing real features")
+    add_PRDC_compute_args(parser)
+
+
+def add_latent_search_args(parser):
+    parser.add_argument("--latents_path", type=str, help="Generated latents (.npy or torch file), sampled if not given")
+    parser.add_argument("--n_samples", type=int, default=1000, help="Number of samples generated without --latents_path")
+    parser.add_argument("--sample_seed", type=int, default=0)
+    parser.add_argument("--search_metrics", type=str, nargs="+", default=["hamming", "embedding"],
+                        choices=["hamming", "embedding"])
+    parser.add_argument("--n_neighbours", type=int, default=5, help="Number of nearest training latents to keep")
+    parser.add_argument("--search_chunk_size", type=int, default=4096, help="Training latents compared at once")
+    parser.add_argument("--search_threads", type=int, default=4)
+    parser.add_argument(
+        "--copy_threshold",
+        type=float,
+        default=0.1,
+        help="Flag samples differing from a training latent in at most this fraction of tokens"
+    )
+    parser.add_argument(
+        "--save_images",
+        const=True,
+        action="store_const",
+        default=False,
+        help="Decode the flagged samples next to their nearest training latents"
+    )
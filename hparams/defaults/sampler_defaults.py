@@ -9,10 +9,21 @@ class HparamsAbsorbing(HparamsBase):
         self.mask_schedule = "random"
         self.total_steps = 256
         self.sample_steps = 256
+        self.unmask_schedule = "random"
+        self.unmask_order = "random"
+        self.max_tokens_per_step = 0
+        self.top_k = 0
+        self.top_p = 1.0
         self.attn_pdrop = 0.
         self.embd_pdrop = 0.
         self.resid_pdrop = 0.
         self.temp = 1.0
+        self.attn_backend = "explicit"
+        self.attn_chunk_size = 64
+        self.attn_window = 0
+        self.attn_block = 8
+        self.attn_global_every = 0
+        self.pos_emb_type = "absolute"
 
         super().__init__(dataset)
         if self.dataset == "churches" or self.dataset == "bedrooms":
@@ -45,6 +56,14 @@ class HparamsAutoregressive(HparamsBase):
         self.embd_pdrop = 0.
         self.resid_pdrop = 0.
         self.temp = 1.0
+        self.top_k = 0
+        self.top_p = 1.0
+        self.attn_backend = "explicit"
+        self.attn_chunk_size = 64
+        self.attn_window = 0
+        self.attn_block = 8
+        self.attn_global_every = 0
+        self.pos_emb_type = "absolute"
 
         if self.dataset == "churches" or "bedrooms":
             self.batch_size = 20
@@ -71,21 +90,60 @@ class HparamsAutoregressive(HparamsBase):
 def add_sampler_args(parser):
     parser.add_argument("--ae_load_dir", type=str, required=True)
     parser.add_argument("--ae_load_step", type=int, required=True)
+    parser.add_argument("--attn_backend", type=str, choices=["explicit", "sdpa", "chunked"])
+    parser.add_argument("--attn_chunk_size", type=int)
+    parser.add_argument("--attn_block", type=int)
+    parser.add_argument("--attn_global_every", type=int)
     parser.add_argument("--attn_pdrop", type=float)
+    parser.add_argument("--attn_window", type=int)
+    parser.add_argument(
+        "--batches_per_flush",
+        type=int,
+        default=10,
+        help="Sampled batches between writes of latents and progress to logs/{log_dir}/latents"
+    )
     parser.add_argument("--bert_n_emb", type=int)
     parser.add_argument("--bert_n_head", type=int)
     parser.add_argument("--bert_n_layers", type=int)
     parser.add_argument("--block_size", type=int)
     parser.add_argument("--embd_pdrop", type=float)
+    parser.add_argument("--extract_batch_size", type=int, help="Batch size for extracting latents, found if not set")
+    parser.add_argument("--extract_bf16", const=True, action="store_const", default=False)
+    parser.add_argument("--extract_max_batch_size", type=int, default=1024)
+    parser.add_argument("--extract_num_workers", type=int, default=4)
     parser.add_argument("--greedy_epochs", type=int)
     parser.add_argument("--greedy", const=True, action="store_const", default=False)
+    parser.add_argument("--latents_mmap", const=True, action="store_const", default=False)
     parser.add_argument("--loss_type", type=str, choices=["reweighted_elbo", "elbo", "mlm"])
     parser.add_argument("--mask_schedule", type=str)
+    parser.add_argument("--max_tokens_per_step", type=int)
+    parser.add_argument("--pos_emb_type", type=str, choices=["absolute", "factorized"])
+    parser.add_argument("--quantize_int8", const=True, action="store_const", default=False)
     parser.add_argument("--resid_pdrop", type=float)
+    parser.add_argument(
+        "--resume",
+        const=True,
+        action="store_const",
+        default=False,
+        help="Continue sampling from the latents and progress flushed to logs/{log_dir}/latents"
+    )
     parser.add_argument("--sample_block_size", type=int)
+    parser.add_argument("--sample_shard_size", type=int, default=1000, help="Samples per shard of a sample store")
+    parser.add_argument(
+        "--sample_store",
+        const=True,
+        action="store_const",
+        default=False,
+        help="Save generated images as a sharded sample store instead of one png per image"
+    )
     parser.add_argument("--sample_type", type=str, choices=["diffusion", "mlm"])
     parser.add_argument("--sampler", type=str, required=True, choices=["absorbing", "autoregressive"])
     parser.add_argument("--total_steps", type=int)
     parser.add_argument("--sample_steps", type=int)
     parser.add_argument("--temp", type=float)
+    parser.add_argument("--temp_end", type=float)
+    parser.add_argument("--top_k", type=int)
+    parser.add_argument("--top_p", type=float)
+    parser.add_argument("--unmask_order", type=str, choices=["random", "confidence"])
+    parser.add_argument("--unmask_schedule", type=str, choices=["random", "linear", "cosine"])
     parser.add_argument("--warmup_iters", type=int)
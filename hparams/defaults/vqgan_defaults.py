@@ -72,3 +72,12 @@ def add_vqgan_args(parser):
     parser.add_argument('--perceptual_weight', type=int)
     parser.add_argument('--quantizer', type=str, choices=["nearest", "gumbel"])
     parser.add_argument('--res_blocks', type=int)
+
+
+# reconstruction FID tracked during training every --steps_per_eval steps
+def add_vqgan_fid_args(parser):
+    parser.add_argument('--eval_fid', const=True, action='store_const', default=False)
+    parser.add_argument('--fid_background', const=True, action='store_const', default=False,
+                        help='Calculate FID in a worker thread while training continues')
+    parser.add_argument('--fid_batch_size', type=int, default=32)
+    parser.add_argument('--fid_n_images', type=int, default=5000, help='Size of the fixed subset reconstructed')
@@ -1,7 +1,10 @@
 import argparse
+import numpy as np
 from .defaults.sampler_defaults import HparamsAbsorbing, HparamsAutoregressive, add_sampler_args
-from .defaults.vqgan_defaults import HparamsVQGAN, add_vqgan_args
-from .defaults.experiment_defaults import add_PRDC_args, add_sampler_FID_args, add_big_sample_args
+from .defaults.vqgan_defaults import HparamsVQGAN, add_vqgan_args, add_vqgan_fid_args
+from .defaults.experiment_defaults import add_PRDC_args, add_sampler_FID_args, add_big_sample_args, add_export_args, \
+    add_quantization_eval_args, add_preprocess_args, add_convert_args, add_serve_args, \
+    add_sample_shard_args, add_sample_sweep_args, add_latent_search_args
 
 
 # args for training of all models: dataset, EMA and loading
@@ -12,6 +15,7 @@ def add_training_args(parser):
     parser.add_argument("--dataset", type=str, required=True)
     parser.add_argument("--ema_beta", type=float, default=0.995)
     parser.add_argument("--ema", const=True, action="store_const", default=False)
+    parser.add_argument("--image_cache_dir", type=str)
     parser.add_argument("--load_dir", type=str, default="test")
     parser.add_argument("--load_optim", const=True, action="store_const", default=False)
     parser.add_argument("--load_step", type=int, default=0)
@@ -23,6 +27,10 @@ def add_training_args(parser):
 # args required for logging
 def add_logging_args(parser):
     parser.add_argument("--log_dir", type=str, default="test")
+    parser.add_argument("--profile", const=True, action="store_const", default=False)
+    parser.add_argument("--profile_sync", const=True, action="store_const", default=False)
+    parser.add_argument("--profile_torch_steps", type=int, nargs=2)
+    parser.add_argument("--profile_window", type=int, default=100)
     parser.add_argument("--save_individually", const=True, action="store_const", default=False)
     parser.add_argument("--steps_per_checkpoint", type=int, default=25000)
     parser.add_argument("--steps_per_display_output", type=int, default=5000)
@@ -52,6 +60,7 @@ def get_vqgan_hparams():
     parser = argparse.ArgumentParser("Parser for setting up VQGAN training :)")
     set_up_base_parser(parser)
     add_vqgan_args(parser)
+    add_vqgan_fid_args(parser)
     parser_args = parser.parse_args()
     H = HparamsVQGAN(parser_args.dataset)
     H = apply_parser_values_to_H(H, parser_args)
@@ -62,6 +71,28 @@ def get_vqgan_hparams():
     return H
 
 
+def get_preprocess_hparams():
+    parser = argparse.ArgumentParser("Script for preprocessing datasets into image shards")
+    set_up_base_parser(parser)
+    add_vqgan_args(parser)
+    add_preprocess_args(parser)
+    parser_args = parser.parse_args()
+    H = HparamsVQGAN(parser_args.dataset)
+    H = apply_parser_values_to_H(H, parser_args)
+    return H
+
+
+def get_convert_hparams():
+    parser = argparse.ArgumentParser("Script for converting VQGAN checkpoints into component checkpoints")
+    set_up_base_parser(parser)
+    add_vqgan_args(parser)
+    add_convert_args(parser)
+    parser_args = parser.parse_args()
+    H = HparamsVQGAN(parser_args.dataset)
+    H = apply_parser_values_to_H(H, parser_args)
+    return H
+
+
 def get_sampler_H_from_parser(parser):
     parser_args = parser.parse_args()
     dataset = parser_args.dataset
@@ -76,6 +107,10 @@ def get_sampler_H_from_parser(parser):
         H_sampler = HparamsAutoregressive(dataset)
     H.update(H_sampler)  # overwrites old (vqgan) H.batch_size
     H = apply_parser_values_to_H(H, parser_args)
+
+    # block size follows the latent grid unless explicitly set, e.g. 1024 tokens for 32x32 latents
+    if parser_args.block_size is None:
+        H.block_size = int(np.prod(H.latent_shape))
     return H
 
 
@@ -115,3 +150,53 @@ def get_big_samples_hparams():
     parser = set_up_sampler_parser(parser)
     H = get_sampler_H_from_parser(parser)
     return H
+
+
+def get_export_hparams():
+    parser = argparse.ArgumentParser("Script for exporting traced inference models")
+    add_export_args(parser)
+    parser = set_up_sampler_parser(parser)
+    H = get_sampler_H_from_parser(parser)
+    return H
+
+
+def get_quantization_eval_hparams():
+    parser = argparse.ArgumentParser("Script for comparing int8 quantized samplers against fp32")
+    add_quantization_eval_args(parser)
+    parser = set_up_sampler_parser(parser)
+    H = get_sampler_H_from_parser(parser)
+    return H
+
+
+def get_serve_hparams():
+    parser = argparse.ArgumentParser("Local HTTP service for sampling images from trained samplers")
+    add_serve_args(parser)
+    parser = set_up_sampler_parser(parser)
+    H = get_sampler_H_from_parser(parser)
+    if H.max_batch_size is None:
+        H.max_batch_size = H.batch_size
+    return H
+
+
+def get_sample_shard_hparams():
+    parser = argparse.ArgumentParser("Script for generating a shard of a deterministic set of samples")
+    add_sample_shard_args(parser)
+    parser = set_up_sampler_parser(parser)
+    H = get_sampler_H_from_parser(parser)
+    return H
+
+
+def get_sample_sweep_hparams():
+    parser = argparse.ArgumentParser("Script for comparing sample quality across unmasking schedules and step counts")
+    add_sample_sweep_args(parser)
+    parser = set_up_sampler_parser(parser)
+    H = get_sampler_H_from_parser(parser)
+    return H
+
+
+def get_latent_search_hparams():
+    parser = argparse.ArgumentParser("Script for finding the training latents nearest to generated latents")
+    add_latent_search_args(parser)
+    parser = set_up_sampler_parser(parser)
+    H = get_sampler_H_from_parser(parser)
+    return H
@@ -2,4 +2,6 @@ from .vqgan import VQGAN, VQAutoEncoder, Generator
 from .absorbing_diffusion import AbsorbingDiffusion
 from .transformer import Transformer
 from .autoregressive import AutoregressiveTransformer
+from .sampling_engine import SamplingEngine
+from .latent_extractor import LatentExtractor
 from .helpers import MyOneHotCategorical
\ No newline at end of file
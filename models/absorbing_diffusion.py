@@ -1,9 +1,9 @@
 import math
 import numpy as np
 import torch
-import torch.distributions as dists
 import torch.nn.functional as F
 from tqdm import tqdm
+from .sampling_kernels import rand_per_row, sample_logits
 from .sampler import Sampler
 
 
@@ -131,8 +131,9 @@ class AbsorbingDiffusion(Sampler):
 
         return loss.mean(), vb_loss.mean()
 
-    def sample(self, temp=1.0, sample_steps=None):
-        b, device = self.n_samples, 'cuda'
+    def sample(self, temp=1.0, sample_steps=None, generators=None):
+        # generators optionally gives each sample its own random stream, see get_sample_generators
+        b, device = self.n_samples, self.device
         x_t = torch.ones((b, np.prod(self.shape)), device=device).long() * self.mask_id
         unmasked = torch.zeros_like(x_t, device=device).bool()
         sample_steps = list(range(1, sample_steps+1))
@@ -142,38 +143,114 @@ class AbsorbingDiffusion(Sampler):
             t = torch.full((b,), t, device=device, dtype=torch.long)
 
             # where to unmask
-            changes = torch.rand(x_t.shape, device=device) < 1/t.float().unsqueeze(-1)
+            if generators is None:
+                u = torch.rand(x_t.shape, device=device)
+            else:
+                u = rand_per_row(x_t.shape, generators, device)
+            changes = u < 1/t.float().unsqueeze(-1)
             # don't unmask somewhere already unmasked
             changes = torch.bitwise_xor(changes, torch.bitwise_and(changes, unmasked))
             # update mask with changes
             unmasked = torch.bitwise_or(unmasked, changes)
 
             x_0_logits = self._denoise_fn(x_t, t=t)
-            # scale by temperature
-            x_0_logits = x_0_logits / temp
-            x_0_dist = dists.Categorical(
-                logits=x_0_logits)
-            x_0_hat = x_0_dist.sample().long()
-            x_t[changes] = x_0_hat[changes]
+            # only sample the positions being unmasked
+            x_t[changes] = sample_logits(
+                x_0_logits, temp, mask=changes, top_k=self.top_k, top_p=self.top_p, generators=generators
+            )
+
+        return x_t
+
+    def get_unmask_counts(self, sample_steps, unmask_schedule='linear', max_tokens_per_step=0):
+        # how many tokens to unmask at each step so the fraction still masked follows the schedule
+        seq_len = int(np.prod(self.shape))
+        if max_tokens_per_step > 0 and sample_steps * max_tokens_per_step < seq_len:
+            raise ValueError(f"{sample_steps} steps of at most {max_tokens_per_step} tokens cannot unmask "
+                             f"all {seq_len} tokens")
+
+        counts, n_masked = [], seq_len
+        for step in range(1, sample_steps+1):
+            if unmask_schedule == 'linear':
+                target = seq_len * (1 - step / sample_steps)
+            elif unmask_schedule == 'cosine':
+                # unmasks few tokens while there is little context and more as the image fills in
+                target = seq_len * math.cos(math.pi / 2 * step / sample_steps)
+            else:
+                raise ValueError(f"Unknown unmasking schedule: {unmask_schedule}")
+            n_tokens = max(n_masked - int(round(target)), 1)
+            if max_tokens_per_step > 0:
+                # respect the budget but leave no more than the remaining steps can unmask
+                n_tokens = min(n_tokens, max_tokens_per_step)
+                n_tokens = max(n_tokens, n_masked - (sample_steps - step) * max_tokens_per_step)
+            n_tokens = min(n_tokens, n_masked)
+            counts.append(n_tokens)
+            n_masked -= n_tokens
+        return counts
+
+    def sample_scheduled(self, temp=1.0, sample_steps=None, unmask_schedule='linear', unmask_order='random',
+                         max_tokens_per_step=0, temp_end=None, generators=None):
+        # unmasks a scheduled number of tokens per step, picked at random or where the denoiser is most confident,
+        # with the temperature optionally annealed linearly from temp to temp_end
+        b, device = self.n_samples, self.device
+        x_t = torch.ones((b, np.prod(self.shape)), device=device).long() * self.mask_id
+        unmasked = torch.zeros_like(x_t, device=device).bool()
+        counts = self.get_unmask_counts(sample_steps, unmask_schedule, max_tokens_per_step)
+        temp_end = temp if temp_end is None else temp_end
+
+        for step, n_tokens in enumerate(counts):
+            if n_tokens == 0:
+                # everything is already unmasked
+                break
+            print(f'Sample step {step+1:4d}', end='\r')
+            t = torch.full((b,), sample_steps - step, device=device, dtype=torch.long)
+            step_temp = temp + (temp_end - temp) * step / max(sample_steps - 1, 1)
+
+            x_0_logits = self._denoise_fn(x_t, t=t)
+            sampling_args = dict(top_k=self.top_k, top_p=self.top_p, generators=generators)
+
+            if unmask_order == 'confidence':
+                # sample every masked position and rank them by the log probability of their sampled token
+                masked = torch.bitwise_not(unmasked)
+                x_0_hat, log_probs = sample_logits(
+                    x_0_logits, step_temp, mask=masked, return_log_probs=True, **sampling_args
+                )
+                scores = torch.full(x_t.shape, -float('inf'), device=device)
+                scores[masked] = log_probs
+                x_0 = x_t.clone()
+                x_0[masked] = x_0_hat
+            elif unmask_order == 'random':
+                if generators is None:
+                    scores = torch.rand(x_t.shape, device=device)
+                else:
+                    scores = rand_per_row(x_t.shape, generators, device)
+                # only ever pick from the positions that are still masked
+                scores = scores.masked_fill(unmasked, -float('inf'))
+            else:
+                raise ValueError(f"Unknown unmasking order: {unmask_order}")
+
+            changes = torch.zeros_like(unmasked)
+            changes.scatter_(1, scores.topk(n_tokens, dim=-1).indices, True)
+            unmasked = torch.bitwise_or(unmasked, changes)
+            if unmask_order == 'confidence':
+                x_t[changes] = x_0[changes]
+            else:
+                # the unmasking positions are known before sampling, so only those are sampled
+                x_t[changes] = sample_logits(x_0_logits, step_temp, mask=changes, **sampling_args)
 
         return x_t
 
     def sample_mlm(self, temp=1.0, sample_steps=None):
-        b, device = self.n_samples, 'cuda'
+        b, device = self.n_samples, self.device
         x_0 = torch.ones((b, np.prod(self.shape)), device=device).long() * self.mask_id
-        sample_steps = np.linspace(1, self.num_timesteps, num=sample_steps).astype(np.long)
+        sample_steps = np.linspace(1, self.num_timesteps, num=sample_steps).astype(np.int64)
 
         for t in reversed(sample_steps):
             print(f'Sample timestep {t:4d}', end='\r')
             t = torch.full((b,), t, device=device, dtype=torch.long)
             x_t, _, _ = self.q_sample(x_0, t)
             x_0_logits = self._denoise_fn(x_t, t=t)
-            # scale by temperature
-            x_0_logits = x_0_logits / temp
-            x_0_dist = dists.Categorical(
-                logits=x_0_logits)
-            x_0_hat = x_0_dist.sample().long()
-            x_0[x_t == self.mask_id] = x_0_hat[x_t == self.mask_id]
+            masked = x_t == self.mask_id
+            x_0[masked] = sample_logits(x_0_logits, temp, mask=masked, top_k=self.top_k, top_p=self.top_p)
 
         return x_0
 
@@ -195,16 +272,53 @@ class AbsorbingDiffusion(Sampler):
         stats = {'loss': loss, 'vb_loss': vb_loss}
         return stats
 
-    def sample_shape(self, shape, num_samples, time_steps=1000, step=1, temp=0.8):
-        device = 'cuda'
+    def get_window_starts(self, length, window, step):
+        # offsets of windows tiling one axis, always including the last so every position is covered
+        starts = list(range(0, length - window + 1, step))
+        if starts[-1] != length - window:
+            starts.append(length - window)
+        return starts
+
+    def select_windows(self, positions, row_starts, col_starts, max_windows=None):
+        # only windows covering a position being unmasked affect the sample, so the rest are skipped
+        h, w = self.shape[1], self.shape[2]
+        covering_windows = []
+        for r, c in positions:
+            covering_windows.append([
+                (i, j) for i in row_starts if i <= r < i + h for j in col_starts if j <= c < j + w
+            ])
+        candidates = sorted(set(window for windows in covering_windows for window in windows))
+        if max_windows is None or len(candidates) <= max_windows:
+            return candidates
+
+        # monte carlo approximation of the mixture: a random covering window for each position that is not
+        # covered yet, then random windows up to the budget
+        selected = set()
+        for windows in covering_windows:
+            if selected.isdisjoint(windows):
+                selected.add(windows[torch.randint(len(windows), (1,)).item()])
+        remaining = [window for window in candidates if window not in selected]
+        n_extra = max(max_windows - len(selected), 0)
+        selected.update(remaining[k] for k in torch.randperm(len(remaining))[:n_extra].tolist())
+        return sorted(selected)
+
+    def sample_shape(self, shape, num_samples, time_steps=1000, step=1, temp=0.8, max_windows=None,
+                     windows_per_forward=1):
+        # max_windows caps the denoised windows per timestep, windows_per_forward are batched into one forward pass
+        device = self.device
+        h, w = self.shape[1], self.shape[2]
         x_t = torch.ones((num_samples,) + shape, device=device).long() * self.mask_id
-        x_lim, y_lim = shape[0] - self.shape[1], shape[1] - self.shape[2]
+        row_starts = self.get_window_starts(shape[0], h, step)
+        col_starts = self.get_window_starts(shape[1], w, step)
 
         unmasked = torch.zeros_like(x_t, device=device).bool()
+        # log of the summed window probabilities, only for the positions unmasked this step; grown if needed
+        # and reused across timesteps
+        log_probs_buffer = torch.empty((num_samples, 1, self.codebook_size), device=device)
 
         autoregressive_step = 0
         for t in tqdm(list(reversed(list(range(1, time_steps+1))))):
-            t = torch.full((num_samples,), t, device='cuda', dtype=torch.long)
+            t = torch.full((num_samples,), t, device=device, dtype=torch.long)
 
             unmasking_method = 'autoregressive'
             if unmasking_method == 'random':
@@ -221,42 +335,40 @@ class AbsorbingDiffusion(Sampler):
                 unmasked = torch.bitwise_or(unmasked, changes)
                 autoregressive_step += 1
 
-            # keep track of PoE probabilities
-            x_0_probs = torch.zeros((num_samples,) + shape + (self.codebook_size,), device='cuda')
-            # keep track of counts
-            count = torch.zeros((num_samples,) + shape, device='cuda')
-
-            # TODO: Monte carlo approximate this instead
-            for i in range(0, x_lim+1, step):
-                for j in range(0, y_lim+1, step):
-                    # collect local noisy area
-                    x_t_part = x_t[:, i:i+self.shape[1], j:j+self.shape[2]]
-
-                    # increment count
-                    count[:, i:i+self.shape[1], j:j+self.shape[2]] += 1.0
-
-                    # flatten
-                    x_t_part = x_t_part.reshape(x_t_part.size(0), -1)
-
-                    # denoise
-                    x_0_logits_part = self._denoise_fn(x_t_part, t=t)
-
-                    # unflatten
-                    x_0_logits_part = x_0_logits_part.reshape(x_t_part.size(0), self.shape[1], self.shape[2], -1)
-
-                    # multiply probabilities
-                    # for mixture
-                    x_0_probs[:, i:i+self.shape[1], j:j+self.shape[2]] += torch.softmax(x_0_logits_part, dim=-1)
-
-            # Mixture with Temperature
-            x_0_probs = x_0_probs / x_0_probs.sum(-1, keepdim=True)
-            C = torch.tensor(x_0_probs.size(-1)).float()
-            x_0_probs = torch.softmax((torch.log(x_0_probs) + torch.log(C)) / temp, dim=-1)
-
-            x_0_dist = dists.Categorical(probs=x_0_probs)
-            x_0_hat = x_0_dist.sample().long()
-
-            # update x_0 where anything has been masked
-            x_t[changes] = x_0_hat[changes]
+            # positions unmasked in any sample, each gets a slot in the buffer
+            positions = [tuple(p) for p in changes.any(0).nonzero(as_tuple=False).tolist()]
+            if not positions:
+                continue
+            if log_probs_buffer.size(1) < len(positions):
+                log_probs_buffer = torch.empty((num_samples, len(positions), self.codebook_size), device=device)
+            log_probs = log_probs_buffer[:, :len(positions)].fill_(-float('inf'))
+
+            windows = self.select_windows(positions, row_starts, col_starts, max_windows)
+            for chunk_start in range(0, len(windows), windows_per_forward):
+                chunk = windows[chunk_start:chunk_start+windows_per_forward]
+                # denoise several windows at once, stacked along the batch
+                x_t_parts = torch.cat([x_t[:, i:i+h, j:j+w].reshape(num_samples, -1) for i, j in chunk])
+                x_0_logits_parts = self._denoise_fn(x_t_parts, t=t.repeat(len(chunk)))
+                x_0_logits_parts = x_0_logits_parts.view(len(chunk), num_samples, h * w, -1)
+
+                for (i, j), x_0_logits_part in zip(chunk, x_0_logits_parts):
+                    slots, local = [], []
+                    for slot, (r, c) in enumerate(positions):
+                        if i <= r < i + h and j <= c < j + w:
+                            slots.append(slot)
+                            local.append((r - i) * w + (c - j))
+                    # mixture of the window distributions, accumulated in log space
+                    part = x_0_logits_part[:, local].float().log_softmax(dim=-1)
+                    log_probs[:, slots] = torch.logaddexp(log_probs[:, slots], part)
+
+            # Mixture with Temperature, the normalisation constant does not change the softmax
+            rows, cols = zip(*positions)
+            rows, cols = list(rows), list(cols)
+            x_t_changed = x_t[:, rows, cols]
+            changed = changes[:, rows, cols]
+            x_t_changed[changed] = sample_logits(
+                log_probs, temp, mask=changed, top_k=self.top_k, top_p=self.top_p
+            )
+            x_t[:, rows, cols] = x_t_changed
 
         return x_t
@@ -1,5 +1,6 @@
 import torch
 import torch.nn.functional as F
+from .sampling_kernels import sample_logits
 from .sampler import Sampler
 from .transformer import Transformer
 import numpy as np
@@ -21,12 +22,12 @@ class AutoregressiveTransformer(Sampler):
         stats = {'loss': loss}
         return stats
 
-    def sample(self, temp=1.0):
-        b, device = self.n_samples, 'cuda'
+    def sample(self, temp=1.0, generators=None):
+        # generators optionally gives each sample its own random stream, see get_sample_generators
+        b, device = self.n_samples, self.device
         x = torch.zeros(b, 0).long().to(device)
         for _ in range(self.seq_len):
             logits = self.net(x)[:, -1]
-            probs = F.softmax(logits / temp, dim=-1)
-            ix = torch.multinomial(probs, num_samples=1)
+            ix = sample_logits(logits, temp, top_k=self.top_k, top_p=self.top_p, generators=generators).unsqueeze(1)
             x = torch.cat((x, ix), dim=1)
         return x
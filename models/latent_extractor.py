@@ -0,0 +1,47 @@
+import contextlib
+import torch
+import torch.nn as nn
+from .vqgan import Encoder, VectorQuantizer, GumbelQuantizer
+
+
+class LatentExtractor(nn.Module):
+    """
+    The encoder and quantizer of a VQAutoEncoder on their own, for turning images into latent ids. Only these
+    two components are built and loaded, and forward runs in inference mode with channels last activations,
+    optionally under bfloat16 autocast. Distances to the codebook are always computed in fp32.
+    """
+    def __init__(self, H, bf16=False):
+        super().__init__()
+        self.emb_dim = H.emb_dim
+        self.quantizer_type = H.quantizer
+        self.bf16 = bf16
+        self.encoder = Encoder(H.n_channels, H.nf, H.emb_dim, H.ch_mult, H.res_blocks, H.img_size, H.attn_resolutions)
+        if self.quantizer_type == "nearest":
+            self.quantize = VectorQuantizer(H.codebook_size, H.emb_dim, H.beta)
+        elif self.quantizer_type == "gumbel":
+            self.quantize = GumbelQuantizer(
+                H.codebook_size, H.emb_dim, H.emb_dim, H.gumbel_straight_through, H.gumbel_kl_weight
+            )
+
+    def autocast(self, device):
+        if not self.bf16:
+            return contextlib.nullcontext()
+        if not hasattr(torch, "autocast"):
+            raise RuntimeError("bfloat16 latent extraction needs torch.autocast (PyTorch 1.10 or later)")
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
+    def forward(self, x):
+        # returns the (b, h*w) latent ids of a batch of images
+        inference_mode = torch.inference_mode if hasattr(torch, "inference_mode") else torch.no_grad
+        with inference_mode():
+            x = x.to(memory_format=torch.channels_last)
+            with self.autocast(x.device):
+                z = self.encoder(x)
+                if self.quantizer_type == "gumbel":
+                    return self.quantize.proj(z).argmax(1).flatten(1)
+
+            z = z.float().permute(0, 2, 3, 1).reshape(-1, self.emb_dim)
+            codebook = self.quantize.embedding.weight.float()
+            # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
+            distances = (z ** 2).sum(dim=1, keepdim=True) + (codebook ** 2).sum(1) - 2 * torch.matmul(z, codebook.t())
+            return torch.argmin(distances, dim=1).view(x.size(0), -1)
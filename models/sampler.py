@@ -1,3 +1,4 @@
+import itertools
 import torch
 import torch.nn as nn
 
@@ -11,6 +12,16 @@ class Sampler(nn.Module):
         self.embedding_weight = embedding_weight
         self.embedding_weight.requires_grad = False
         self.n_samples = H.n_samples
+        # truncation applied to every sampled token distribution, off by default
+        self.top_k = H.top_k or 0
+        self.top_p = H.top_p or 1.0
+
+    @property
+    def device(self):
+        # the network may be traced or quantized, so use whichever tensor the sampler still holds
+        for tensor in itertools.chain(self.parameters(), self.buffers()):
+            return tensor.device
+        return self.embedding_weight.device
 
     def train_iter(self, x, x_target, step):
         raise NotImplementedError()
@@ -0,0 +1,79 @@
+import numpy as np
+import torch
+from .sampling_kernels import sample_logits
+
+
+class SamplingEngine:
+    """
+    Continuous batching for AbsorbingDiffusion. Every row of the batch is an independent sample with its own
+    timestep, temperature and number of sampling steps, so rows can be admitted into free slots and retired as
+    soon as they finish rather than the whole batch running in lockstep. Each row follows the same unmasking
+    schedule as AbsorbingDiffusion.sample, which is possible because the denoiser does not condition on t.
+    """
+    def __init__(self, sampler, max_batch_size):
+        self.sampler = sampler
+        self.max_batch_size = max_batch_size
+        self.mask_id = sampler.mask_id
+        self.seq_len = int(np.prod(sampler.shape))
+        device = sampler.device
+
+        self.x_t = torch.full((max_batch_size, self.seq_len), self.mask_id, dtype=torch.long, device=device)
+        self.unmasked = torch.zeros((max_batch_size, self.seq_len), dtype=torch.bool, device=device)
+        self.t = torch.zeros(max_batch_size, dtype=torch.long, device=device)
+        self.temp = torch.ones(max_batch_size, device=device)
+        self.active = torch.zeros(max_batch_size, dtype=torch.bool, device=device)
+        self.slot_ids = [None] * max_batch_size
+
+    @property
+    def num_active(self):
+        return int(self.active.sum())
+
+    @property
+    def num_free(self):
+        return self.max_batch_size - self.num_active
+
+    def admit(self, row_id, temp=1.0, sample_steps=256):
+        # start a new fully masked sample in a free slot, returns False if the batch is full
+        free_slots = torch.nonzero(~self.active, as_tuple=False)
+        if free_slots.numel() == 0:
+            return False
+        slot = free_slots[0].item()
+        self.x_t[slot] = self.mask_id
+        self.unmasked[slot] = False
+        self.t[slot] = sample_steps
+        self.temp[slot] = temp
+        self.active[slot] = True
+        self.slot_ids[slot] = row_id
+        return True
+
+    @torch.no_grad()
+    def step(self):
+        # one denoising step for every active row, returns the (row_id, latents) of rows that finished
+        if self.num_active == 0:
+            return []
+        # only the occupied slots are passed through the denoiser
+        slots = torch.nonzero(self.active, as_tuple=False).squeeze(1)
+        x_t, unmasked, t, temp = self.x_t[slots], self.unmasked[slots], self.t[slots], self.temp[slots]
+
+        # where to unmask, excluding positions that are already unmasked
+        changes = torch.rand(x_t.shape, device=x_t.device) < 1 / t.float().unsqueeze(-1)
+        changes = torch.bitwise_and(changes, torch.bitwise_not(unmasked))
+        unmasked = torch.bitwise_or(unmasked, changes)
+
+        x_0_logits = self.sampler._denoise_fn(x_t, t=t)
+        x_t[changes] = sample_logits(
+            x_0_logits, temp, mask=changes, top_k=self.sampler.top_k, top_p=self.sampler.top_p
+        )
+        t = t - 1
+
+        self.x_t[slots] = x_t
+        self.unmasked[slots] = unmasked
+        self.t[slots] = t
+
+        finished = []
+        for slot, done in zip(slots.tolist(), (t == 0).tolist()):
+            if done:
+                finished.append((self.slot_ids[slot], self.x_t[slot].clone()))
+                self.active[slot] = False
+                self.slot_ids[slot] = None
+        return finished
@@ -0,0 +1,85 @@
+import numpy as np
+import torch
+
+
+def get_sample_seed(seed, index):
+    return int(np.random.SeedSequence([seed, int(index)]).generate_state(1, dtype=np.uint64)[0]) & (2**63 - 1)
+
+
+def get_sample_generators(seed, indices, device="cpu"):
+    # one random stream per sample, derived from the seed and the sample's global index so that sample i
+    # is the same whichever process, batch or position it is generated in
+    generators = []
+    for index in indices:
+        generator = torch.Generator(device=device)
+        generator.manual_seed(get_sample_seed(seed, index))
+        generators.append(generator)
+    return generators
+
+
+def rand_per_row(shape, generators, device):
+    # uniform noise of shape (b, ...) where row i is drawn from generators[i]
+    return torch.stack([torch.rand(shape[1:], generator=generator, device=device) for generator in generators])
+
+
+def truncate_logits_(logits, top_k=0, top_p=1.0):
+    # in place, sets logits outside the top k tokens and outside the smallest set of tokens with probability
+    # at least top_p to -inf
+    if top_k and top_k < logits.size(-1):
+        kth_largest = logits.topk(top_k, dim=-1).values[..., -1:]
+        logits.masked_fill_(logits < kth_largest, -float('inf'))
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = logits.sort(dim=-1, descending=True)
+        sorted_probs = sorted_logits.softmax(dim=-1)
+        # drop a token once the more likely tokens already cover top_p, so the most likely token is always kept
+        remove = (sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p
+        logits.scatter_(-1, sorted_indices, sorted_logits.masked_fill_(remove, -float('inf')))
+    return logits
+
+
+def gumbel_max_(logits, generators=None, row_counts=None):
+    # in place, samples from softmax(logits) over the last dim as argmax(logits - log(E)) with E ~ Exp(1)
+    # if generators are given, row i of the batch draws its noise from generators[i] and covers row_counts[i]
+    # consecutive rows of logits (one each if row_counts is None)
+    noise = torch.empty_like(logits)
+    if generators is None:
+        noise.exponential_()
+    else:
+        row_counts = [1] * len(generators) if row_counts is None else [int(n) for n in row_counts]
+        for generator, rows in zip(generators, noise.split(row_counts)):
+            rows.exponential_(generator=generator)
+    noise.clamp_(min=torch.finfo(noise.dtype).tiny).log_()
+    return logits.sub_(noise).argmax(-1)
+
+
+@torch.no_grad()
+def sample_logits(logits, temp=1.0, mask=None, top_k=0, top_p=1.0, generators=None, return_log_probs=False):
+    """
+    Draws a token from softmax(logits / temp) for every position of logits (b, ..., codebook_size), or only where
+    the bool mask (b, ...) is True, in which case the tokens come back flattened in the order of logits[mask].
+    temp is a float or a (b,) tensor of per-sample temperatures. Float logits may be overwritten.
+    """
+    # the number of positions sampled from each row, only needed for per-row temperatures and generators
+    per_row = torch.is_tensor(temp) or generators is not None
+    if mask is not None:
+        row_counts = mask.flatten(1).sum(1) if per_row else None
+        logits = logits[mask]
+        out_shape = logits.shape[:-1]
+    else:
+        out_shape = logits.shape[:-1]
+        row_counts = torch.full((logits.size(0),), out_shape[1:].numel(), device=logits.device) if per_row else None
+        logits = logits.reshape(-1, logits.size(-1))
+    logits = logits.float()
+
+    # temperature and truncation are applied in place to only the positions being sampled
+    if torch.is_tensor(temp):
+        logits.div_(temp.float().repeat_interleave(row_counts.to(temp.device)).unsqueeze(-1))
+    elif temp != 1.0:
+        logits.div_(temp)
+    truncate_logits_(logits, top_k, top_p)
+
+    log_probs = logits.log_softmax(dim=-1) if return_log_probs else None
+    tokens = gumbel_max_(logits, generators, row_counts)
+    if return_log_probs:
+        return tokens.view(out_shape), log_probs.gather(-1, tokens.unsqueeze(-1)).view(out_shape)
+    return tokens.view(out_shape)
@@ -5,6 +5,92 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+ATTN_BACKENDS = ['explicit', 'sdpa', 'chunked']
+
+
+def chunked_attention(q, k, v, chunk_size, causal=False, dropout_p=0.0):
+    """
+    Attention computed over blocks of queries and keys with an online softmax, so only
+    (chunk_size x chunk_size) scores are held in memory per head rather than the full (T x T) matrix.
+    """
+    T, S = q.size(-2), k.size(-2)
+    scale = 1.0 / math.sqrt(q.size(-1))
+    out = torch.empty_like(q)
+
+    for i in range(0, T, chunk_size):
+        q_chunk = q[:, :, i:i+chunk_size] * scale
+        # running max, normaliser and weighted sum of values for this block of queries
+        m = torch.full(q_chunk.shape[:-1] + (1,), float('-inf'), device=q.device, dtype=q.dtype)
+        l = torch.zeros_like(m)
+        acc = torch.zeros_like(q_chunk)
+
+        # queries only see keys up to their own position, so later key blocks can be skipped entirely
+        key_end = min(S, i + q_chunk.size(-2)) if causal else S
+        for j in range(0, key_end, chunk_size):
+            att = q_chunk @ k[:, :, j:j+chunk_size].transpose(-2, -1)
+            if causal:
+                q_idx = torch.arange(i, i + att.size(-2), device=q.device).unsqueeze(-1)
+                k_idx = torch.arange(j, j + att.size(-1), device=q.device).unsqueeze(0)
+                att = att.masked_fill(k_idx > q_idx, float('-inf'))
+
+            m_new = torch.maximum(m, att.amax(dim=-1, keepdim=True))
+            p = torch.exp(att - m_new)
+            correction = torch.exp(m - m_new)
+            l = l * correction + p.sum(dim=-1, keepdim=True)
+            if dropout_p > 0:
+                p = F.dropout(p, p=dropout_p)
+            acc = acc * correction + p @ v[:, :, j:j+chunk_size]
+            m = m_new
+
+        out[:, :, i:i+chunk_size] = acc / l
+
+    return out
+
+
+def local_attention(q, k, v, grid_shape, window, block, dropout_p=0.0):
+    """
+    2-D neighbourhood attention: each token attends to the (window x window) tokens centred on it in the
+    latent grid. Queries are processed in (block x block) tiles against their key tile plus a halo, so
+    memory and compute grow linearly with the number of tokens.
+    """
+    B, nh, T, hs = q.shape
+    h, w = grid_shape
+    r = window // 2
+    K = block + 2 * r
+    nh_t, nw_t = h // block, w // block
+    scale = 1.0 / math.sqrt(hs)
+
+    def to_tiles(x):  # (B, nh, T, hs) -> (B*nh, n_tiles, block*block, hs)
+        x = x.reshape(B * nh, nh_t, block, nw_t, block, hs).permute(0, 1, 3, 2, 4, 5)
+        return x.reshape(B * nh, nh_t * nw_t, block * block, hs)
+
+    def to_halo_tiles(x):  # (B, nh, T, hs) -> (B*nh, n_tiles, K*K, hs)
+        x = x.transpose(-2, -1).reshape(B * nh, hs, h, w)
+        x = F.unfold(x, K, padding=r, stride=block)  # (B*nh, hs*K*K, n_tiles)
+        return x.view(B * nh, hs, K * K, -1).permute(0, 3, 2, 1)
+
+    q_tiles = to_tiles(q) * scale
+    k_tiles, v_tiles = to_halo_tiles(k), to_halo_tiles(v)
+
+    # keys must lie within the window of each query and inside the (unpadded) grid
+    q_pos = torch.arange(block, device=q.device)
+    k_pos = torch.arange(K, device=q.device) - r
+    near = (k_pos.view(1, -1) - q_pos.view(-1, 1)).abs() <= r  # (block, K)
+    near = (near.view(block, 1, K, 1) & near.view(1, block, 1, K)).view(block * block, K * K)
+    inside = F.unfold(q.new_ones(1, 1, h, w), K, padding=r, stride=block)  # (1, K*K, n_tiles)
+    mask = near.unsqueeze(0) & (inside.transpose(1, 2).unsqueeze(-2) > 0)  # (n_tiles, block*block, K*K)
+
+    att = q_tiles @ k_tiles.transpose(-2, -1)  # (B*nh, n_tiles, block*block, K*K)
+    att = att.masked_fill(~mask, float('-inf'))
+    att = F.softmax(att, dim=-1)
+    if dropout_p > 0:
+        att = F.dropout(att, p=dropout_p)
+    y = att @ v_tiles  # (B*nh, n_tiles, block*block, hs)
+
+    y = y.view(B, nh, nh_t, nw_t, block, block, hs).permute(0, 1, 2, 4, 3, 5, 6)
+    return y.reshape(B, nh, T, hs)
+
+
 class CausalSelfAttention(nn.Module):
     """
     A vanilla multi-head masked self-attention layer with a projection at the end.
@@ -12,7 +98,7 @@ class CausalSelfAttention(nn.Module):
     explicit implementation here to show that there is nothing too scary here.
     """
 
-    def __init__(self, H):
+    def __init__(self, H, local=False):
         super().__init__()
         assert H.bert_n_emb % H.bert_n_head == 0
         # key, query, value projections for all heads
@@ -31,13 +117,66 @@ class CausalSelfAttention(nn.Module):
             mask = torch.tril(torch.ones(block_size, block_size))
             self.register_buffer("mask", mask.view(1, 1, block_size, block_size))
 
+        self.backend = H.attn_backend if H.attn_backend else 'explicit'
+        self.chunk_size = H.attn_chunk_size if H.attn_chunk_size else 64
+        assert self.backend in ATTN_BACKENDS, f"Unknown attention backend: {self.backend}"
+        if self.backend == 'sdpa' and not hasattr(F, 'scaled_dot_product_attention'):
+            raise ValueError("attn_backend 'sdpa' requires torch>=2.0")
+
+        # local layers attend over a 2-D neighbourhood of the latent grid rather than every token
+        self.local = local
+        if self.local:
+            assert not self.causal, "Local attention is only supported for non-causal samplers"
+            self.grid_shape = tuple(H.latent_shape[1:])
+            self.window = H.attn_window
+            self.block = H.attn_block if H.attn_block else 8
+            assert self.window % 2 == 1, "attn_window must be odd"
+            assert self.grid_shape[0] % self.block == 0 and self.grid_shape[1] % self.block == 0, \
+                f"Latent shape {self.grid_shape} must be divisible by attn_block {self.block}"
+
+        # concatenated key/query/value parameters, reused while no gradients are needed
+        self.qkv_cache = None
+
+    def qkv_params(self):
+        params = (
+            self.key.weight, self.query.weight, self.value.weight, self.key.bias, self.query.bias, self.value.bias
+        )
+        if torch.is_grad_enabled() and any(p.requires_grad for p in params):
+            return torch.cat(params[:3], dim=0), torch.cat(params[3:], dim=0)
+        # rebuilt when the parameters are updated in place (optimiser, load_state_dict) or their storage is replaced
+        # (ema, moves). the cache keeps the storages it was built from alive, so a new one can't reuse their address
+        if self.qkv_cache is not None:
+            sources, versions, weight, bias = self.qkv_cache
+            if all(p.data_ptr() == source.data_ptr() and p._version == version
+                   for p, source, version in zip(params, sources, versions)):
+                return weight, bias
+        with torch.no_grad():
+            self.qkv_cache = (
+                tuple(p.detach() for p in params),
+                tuple(p._version for p in params),
+                torch.cat(params[:3], dim=0),
+                torch.cat(params[3:], dim=0)
+            )
+        return self.qkv_cache[2], self.qkv_cache[3]
+
+    def qkv(self, x):
+        # single fused projection, weights are concatenated so that checkpoints keep separate key/query/value
+        B, T, C = x.size()
+        weight, bias = self.qkv_params()
+        k, q, v = F.linear(x, weight, bias).view(B, T, 3, self.n_head, C // self.n_head).permute(2, 0, 3, 1, 4)
+        return k, q, v  # each (B, nh, T, hs)
+
     def forward(self, x, layer_past=None):
         B, T, C = x.size()
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
-        k = self.key(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
-        q = self.query(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
-        v = self.value(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
+        # quantized linear layers do not expose weight tensors that can be concatenated
+        if self.backend == 'explicit' or not isinstance(self.key, nn.Linear):
+            k = self.key(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
+            q = self.query(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
+            v = self.value(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
+        else:
+            k, q, v = self.qkv(x)
 
         present = torch.stack((k, v))
         if self.causal and layer_past is not None:
@@ -45,15 +184,26 @@ class CausalSelfAttention(nn.Module):
             k = torch.cat((past_key, k), dim=-2)
             v = torch.cat((past_value, v), dim=-2)
 
-        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
-        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+        is_causal = self.causal and layer_past is None
+        dropout_p = self.attn_drop.p if self.training else 0.0
+
+        if self.local:
+            y = local_attention(q, k, v, self.grid_shape, self.window, self.block, dropout_p=dropout_p)
+        elif self.backend == 'sdpa':
+            y = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, is_causal=is_causal)
+        elif self.backend == 'chunked':
+            y = chunked_attention(q, k, v, self.chunk_size, causal=is_causal, dropout_p=dropout_p)
+        else:
+            # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
+            att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
 
-        if self.causal and layer_past is None:
-            att = att.masked_fill(self.mask[:, :, :T, :T] == 0, float('-inf'))
+            if is_causal:
+                att = att.masked_fill(self.mask[:, :, :T, :T] == 0, float('-inf'))
+
+            att = F.softmax(att, dim=-1)
+            att = self.attn_drop(att)
+            y = att @ v  # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
 
-        att = F.softmax(att, dim=-1)
-        att = self.attn_drop(att)
-        y = att @ v  # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
         # re-assemble all head outputs side by side
         y = y.transpose(1, 2).contiguous().view(B, T, C)
 
@@ -65,11 +215,11 @@ class CausalSelfAttention(nn.Module):
 class Block(nn.Module):
     """ an unassuming Transformer block """
 
-    def __init__(self, H):
+    def __init__(self, H, local=False):
         super().__init__()
         self.ln1 = nn.LayerNorm(H.bert_n_emb)
         self.ln2 = nn.LayerNorm(H.bert_n_emb)
-        self.attn = CausalSelfAttention(H)
+        self.attn = CausalSelfAttention(H, local=local)
         self.mlp = nn.Sequential(
             nn.Linear(H.bert_n_emb, 4 * H.bert_n_emb),
             nn.GELU(),  # nice
@@ -104,13 +254,22 @@ class Transformer(nn.Module):
             self.vocab_size = H.codebook_size
 
         self.tok_emb = nn.Embedding(self.vocab_size, self.n_embd)
-        self.pos_emb = nn.Parameter(
-            torch.zeros(1, self.block_size, self.n_embd))
+        # factorized embeddings are sized by the latent grid rather than a fixed block of tokens
+        self.pos_emb_type = H.pos_emb_type if H.pos_emb_type else 'absolute'
+        if self.pos_emb_type == 'factorized':
+            self.row_emb = nn.Parameter(torch.zeros(1, H.latent_shape[1], 1, self.n_embd))
+            self.col_emb = nn.Parameter(torch.zeros(1, 1, H.latent_shape[2], self.n_embd))
+        else:
+            self.pos_emb = nn.Parameter(
+                torch.zeros(1, self.block_size, self.n_embd))
         self.start_tok = nn.Parameter(torch.zeros(1, 1, self.n_embd))
         self.drop = nn.Dropout(H.embd_pdrop)
 
-        # transformer
-        self.blocks = nn.Sequential(*[Block(H) for _ in range(self.n_layers)])
+        # transformer, with every attn_global_every-th layer kept global when using local attention
+        local = [False] * self.n_layers
+        if H.attn_window:
+            local = [not (H.attn_global_every and (i + 1) % H.attn_global_every == 0) for i in range(self.n_layers)]
+        self.blocks = nn.Sequential(*[Block(H, local=local[i]) for i in range(self.n_layers)])
         # decoder head
         self.ln_f = nn.LayerNorm(self.n_embd)
         self.head = nn.Linear(self.n_embd, self.codebook_size, bias=False)
@@ -141,7 +300,10 @@ class Transformer(nn.Module):
         assert t <= self.block_size, "Cannot forward, model block size is exhausted."
         # each position maps to a (learnable) vector
 
-        position_embeddings = self.pos_emb[:, :t, :]
+        if self.pos_emb_type == 'factorized':
+            position_embeddings = (self.row_emb + self.col_emb).view(1, -1, self.n_embd)[:, :t, :]
+        else:
+            position_embeddings = self.pos_emb[:, :t, :]
 
         x = token_embeddings + position_embeddings
         x = self.drop(x)
@@ -4,13 +4,12 @@ https://github.com/CompVis/taming-transformers/blob/master/taming/models/vqgan.p
 
 '''
 
-import lpips
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from .diffaug import DiffAugment
-from utils.vqgan_utils import normalize, swish, adopt_weight, hinge_d_loss, calculate_adaptive_weight
+from utils.vqgan_utils import normalize, norm_swish, adopt_weight, hinge_d_loss, calculate_adaptive_weight
 from utils.log_utils import log
 
 
@@ -140,11 +139,9 @@ class ResBlock(nn.Module):
 
     def forward(self, x_in):
         x = x_in
-        x = self.norm1(x)
-        x = swish(x)
+        x = norm_swish(x, self.norm1.num_groups, self.norm1.weight, self.norm1.bias, self.norm1.eps)
         x = self.conv1(x)
-        x = self.norm2(x)
-        x = swish(x)
+        x = norm_swish(x, self.norm2.num_groups, self.norm2.weight, self.norm2.bias, self.norm2.eps)
         x = self.conv2(x)
         if self.in_channels != self.out_channels:
             x_in = self.conv_out(x_in)
@@ -307,13 +304,54 @@ class Generator(nn.Module):
                             nn.Conv2d(block_in_ch, block_in_ch, kernel_size=3, stride=1, padding=1),
                             nn.ReLU(),
                             nn.Conv2d(block_in_ch, H.n_channels, kernel_size=1, stride=1, padding=0)
-                        ).cuda()
+                        )
 
     def forward(self, x):
         for block in self.blocks:
             x = block(x)
         return x
 
+    @torch.no_grad()
+    def decode_tiled(self, x, tile_size, overlap, tiles_per_batch=8):
+        # decodes (b, emb_dim, h, w) latents as overlapping tile_size tiles, so that memory, which grows
+        # quadratically with the size of the attention map, is bounded by the tile size. tiles overlap by at
+        # least overlap latents and are blended with weights that fall off linearly towards their edges
+        b, _, h, w = x.shape
+        if h <= tile_size and w <= tile_size:
+            return self(x)
+        scale = 2 ** (self.num_resolutions - 1)
+        tile_h, tile_w = min(tile_size, h), min(tile_size, w)
+
+        def tile_starts(length, tile):
+            stride = max(tile - overlap, 1)
+            starts = list(range(0, length - tile + 1, stride))
+            if starts[-1] != length - tile:
+                starts.append(length - tile)
+            return starts
+
+        def ramp(length):
+            # 1 in the middle of the tile, falling to ~0 at its edges over the width of the overlap
+            pos = torch.arange(length, device=x.device, dtype=torch.float32) + 0.5
+            ramp_width = max(overlap * scale, 1)
+            return (torch.min(pos, length - pos) / ramp_width).clamp(max=1.0)
+
+        weight = (ramp(tile_h * scale)[:, None] * ramp(tile_w * scale)[None, :]).view(1, 1, tile_h * scale, -1)
+        out = torch.zeros((b, self.out_channels, h * scale, w * scale), device=x.device)
+        weight_sum = torch.zeros((1, 1, h * scale, w * scale), device=x.device)
+
+        tiles = [(i, j) for i in tile_starts(h, tile_h) for j in tile_starts(w, tile_w)]
+        for chunk_start in range(0, len(tiles), tiles_per_batch):
+            chunk = tiles[chunk_start:chunk_start+tiles_per_batch]
+            # tiles of every image in the chunk are decoded together
+            decoded = self(torch.cat([x[:, :, i:i+tile_h, j:j+tile_w] for i, j in chunk])).float()
+            for (i, j), tile in zip(chunk, decoded.split(b)):
+                rows = slice(i * scale, (i + tile_h) * scale)
+                cols = slice(j * scale, (j + tile_w) * scale)
+                out[:, :, rows, cols] += tile * weight
+                weight_sum[:, :, rows, cols] += weight
+
+        return out / weight_sum
+
     def probabilistic(self, x):
         with torch.no_grad():
             for block in self.blocks[:-1]:
@@ -417,7 +455,10 @@ class VQGAN(nn.Module):
             H.ndf,
             n_layers=H.disc_layers
         )
-        self.perceptual = lpips.LPIPS(net="vgg")
+        # imported here so that scripts only using the autoencoder do not pay for loading lpips
+        import lpips
+        # randomly initialised VGG features avoid downloading weights when only timing the model
+        self.perceptual = lpips.LPIPS(net="vgg", pnet_rand=bool(H.lpips_random_init))
         self.perceptual_weight = H.perceptual_weight
         self.disc_start_step = H.disc_start_step
         self.disc_weight_max = H.disc_weight_max
@@ -1,16 +1,16 @@
-from numpy.core.fromnumeric import mean
 import torch
 import numpy as np
 import copy
 import time
 import os
 from tqdm import tqdm
-from models import VQAutoEncoder, Generator
+from models import Generator
 from hparams import get_sampler_hparams
-from utils.data_utils import get_data_loaders, cycle
+from utils.data_utils import get_datasets, cycle, DevicePrefetcher
 from utils.sampler_utils import generate_latent_ids, get_latent_loaders, retrieve_autoencoder_components_state_dicts,\
-    get_samples, get_sampler
+    get_samples, get_sampler, get_latent_extractor
 from utils.train_utils import EMA, optim_warmup
+from utils.profile_utils import get_profiler
 from utils.log_utils import log, log_stats, set_up_visdom, config_log, start_training_log, \
     save_stats, load_stats, save_model, load_model, save_images, \
     display_images
@@ -27,30 +27,27 @@ def main(H, vis):
         train_with_validation_dataset = True
 
     if not os.path.exists(latents_filepath):
-        ae_state_dict = retrieve_autoencoder_components_state_dicts(
-            H, ['encoder', 'quantize', 'generator']
-        )
-        ae = VQAutoEncoder(H)
-        ae.load_state_dict(ae_state_dict, strict=False)
-        # val_loader will be assigned to None if not training with validation dataest
-        train_loader, val_loader = get_data_loaders(
+        # val_dataset will be assigned to None if not training with validation dataest
+        train_dataset, val_dataset = get_datasets(
             H.dataset,
             H.img_size,
-            H.batch_size,
-            drop_last=False,
-            shuffle=False,
             get_flipped=H.horizontal_flip,
-            get_val_dataloader=train_with_validation_dataset
+            get_val_dataset=train_with_validation_dataset,
+            custom_dataset_path=H.custom_dataset_path,
+            cache_dir=H.image_cache_dir
         )
 
-        log("Transferring autoencoder to GPU to generate latents...")
-        ae = ae.cuda()  # put ae on GPU for generating
-        generate_latent_ids(H, ae, train_loader, val_loader)
-        log("Deleting autoencoder to conserve GPU memory...")
-        ae = ae.cpu()
-        ae = None
+        log("Loading encoder and quantizer to GPU to generate latents...")
+        extractor = get_latent_extractor(H, "cuda")
+        generate_latent_ids(H, extractor, train_dataset, val_dataset)
+        log("Deleting encoder to conserve GPU memory...")
+        extractor = None
 
-    train_latent_loader, val_latent_loader = get_latent_loaders(H, get_validation_loader=train_with_validation_dataset)
+    train_latent_loader, val_latent_loader = get_latent_loaders(
+        H,
+        get_validation_loader=train_with_validation_dataset,
+        pin_memory=True
+    )
 
     quanitzer_and_generator_state_dict = retrieve_autoencoder_components_state_dicts(
         H,
@@ -147,100 +144,114 @@ def main(H, vis):
             log_start_step = start_step
 
     scaler = torch.cuda.amp.GradScaler()
-    train_iterator = cycle(train_latent_loader)
+    train_iterator = DevicePrefetcher(cycle(train_latent_loader), 'cuda')
     # val_iterator = cycle(val_latent_loader)
+    profiler = get_profiler(H)
 
     log(f"Sampler params total: {sum(p.numel() for p in sampler.parameters())}")
 
     for step in range(start_step, H.train_steps):
+        profiler.step(step)
         step_start_time = time.time()
         # lr warmup
         if H.warmup_iters:
             if step <= H.warmup_iters:
                 optim_warmup(H, step, optim)
 
-        x = next(train_iterator)
-        x = x.cuda()
+        with profiler.phase('data'):
+            x = next(train_iterator)
 
         if H.amp:
             optim.zero_grad()
-            with torch.cuda.amp.autocast():
-                stats = sampler.train_iter(x)
-
-            scaler.scale(stats['loss']).backward()
-            scaler.step(optim)
-            scaler.update()
+            with profiler.phase('forward'):
+                with torch.cuda.amp.autocast():
+                    stats = sampler.train_iter(x)
+
+            with profiler.phase('backward'):
+                scaler.scale(stats['loss']).backward()
+            with profiler.phase('optimizer'):
+                scaler.step(optim)
+                scaler.update()
         else:
-            stats = sampler.train_iter(x)
+            with profiler.phase('forward'):
+                stats = sampler.train_iter(x)
 
             if torch.isnan(stats['loss']).any():
                 log(f'Skipping step {step} with NaN loss')
                 continue
             optim.zero_grad()
-            stats['loss'].backward()
-            optim.step()
+            with profiler.phase('backward'):
+                stats['loss'].backward()
+            with profiler.phase('optimizer'):
+                optim.step()
 
         losses = np.append(losses, stats['loss'].item())
 
         if step % H.steps_per_log == 0:
             step_time_taken = time.time() - step_start_time
             stats['step_time'] = step_time_taken
+            stats['data_wait_time'] = train_iterator.pop_wait_time()
             mean_loss = np.mean(losses)
             stats['mean_loss'] = mean_loss
             mean_losses = np.append(mean_losses, mean_loss)
             losses = np.array([])
 
-            vis.line(
-                np.array([mean_loss]),
-                np.array([step]),
-                win='loss',
-                update=('append' if step > 0 else 'replace'),
-                opts=dict(title='Loss')
-            )
-            log_stats(step, stats)
-
-            if H.sampler == 'absorbing':
-                elbo = np.append(elbo, stats['vb_loss'].item())
-                vis.bar(
-                    sampler.loss_history,
-                    list(range(sampler.loss_history.size(0))),
-                    win='loss_bar',
-                    opts=dict(title='loss_bar')
-                )
+            with profiler.phase('logging'):
                 vis.line(
-                    np.array([stats['vb_loss'].item()]),
+                    np.array([mean_loss]),
                     np.array([step]),
-                    win='ELBO',
+                    win='loss',
                     update=('append' if step > 0 else 'replace'),
-                    opts=dict(title='ELBO')
+                    opts=dict(title='Loss')
                 )
+                log_stats(step, stats)
+
+                if H.sampler == 'absorbing':
+                    elbo = np.append(elbo, stats['vb_loss'].item())
+                    vis.bar(
+                        sampler.loss_history,
+                        list(range(sampler.loss_history.size(0))),
+                        win='loss_bar',
+                        opts=dict(title='loss_bar')
+                    )
+                    vis.line(
+                        np.array([stats['vb_loss'].item()]),
+                        np.array([step]),
+                        win='ELBO',
+                        update=('append' if step > 0 else 'replace'),
+                        opts=dict(title='ELBO')
+                    )
 
         if H.ema and step % H.steps_per_update_ema == 0 and step > 0:
-            ema.update_model_average(ema_sampler, sampler)
+            with profiler.phase('ema'):
+                ema.update_model_average(ema_sampler, sampler)
 
         images = None
         if step % H.steps_per_display_output == 0 and step > 0:
-            images = get_samples(H, generator, ema_sampler if H.ema else sampler)
-            display_images(vis, images, H, win_name=f'{H.sampler}_samples')
+            images = get_samples(H, generator, ema_sampler if H.ema else sampler, profiler=profiler)
+            with profiler.phase('logging'):
+                display_images(vis, images, H, win_name=f'{H.sampler}_samples')
 
         if step % H.steps_per_save_output == 0 and step > 0:
             if images is None:
-                images = get_samples(H, generator, ema_sampler if H.ema else sampler)
-            save_images(images, 'samples', step, H.log_dir, H.save_individually)
+                images = get_samples(H, generator, ema_sampler if H.ema else sampler, profiler=profiler)
+            with profiler.phase('checkpoint'):
+                save_images(images, 'samples', step, H.log_dir, H.save_individually)
 
         if H.steps_per_eval and step % H.steps_per_eval == 0 and step > 0:
             # calculate validation loss
             valid_loss, valid_elbo, num_samples = 0.0, 0.0, 0
             eval_repeats = 5
             log("Evaluating")
-            for _ in tqdm(range(eval_repeats)):
-                for x in val_latent_loader:
-                    with torch.no_grad():
-                        stats = sampler.train_iter(x.cuda())
-                        valid_loss += stats['loss'].item()
-                        if H.sampler == 'absorbing':
-                            valid_elbo += stats['vb_loss'].item()
-                        num_samples += x.size(0)
+            with profiler.phase('eval'):
+                for _ in tqdm(range(eval_repeats)):
+                    for x in val_latent_loader:
+                        with torch.no_grad():
+                            stats = sampler.train_iter(x.cuda())
+                            valid_loss += stats['loss'].item()
+                            if H.sampler == 'absorbing':
+                                valid_elbo += stats['vb_loss'].item()
+                            num_samples += x.size(0)
             valid_loss = valid_loss / num_samples
             if H.sampler == 'absorbing':
                 valid_elbo = valid_elbo / num_samples
@@ -264,22 +275,25 @@ def main(H, vis):
                 )
 
         if step % H.steps_per_checkpoint == 0 and step > H.load_step:
-            save_model(sampler, H.sampler, step, H.log_dir)
-            save_model(optim, f'{H.sampler}_optim', step, H.log_dir)
-
-            if H.ema:
-                save_model(ema_sampler, f'{H.sampler}_ema', step, H.log_dir)
-
-            train_stats = {
-                'losses': losses,
-                'mean_losses': mean_losses,
-                'val_losses': val_losses,
-                'elbo': elbo,
-                'val_elbos': val_elbos,
-                'steps_per_log': H.steps_per_log,
-                'steps_per_eval': H.steps_per_eval,
-            }
-            save_stats(H, train_stats, step)
+            with profiler.phase('checkpoint'):
+                save_model(sampler, H.sampler, step, H.log_dir)
+                save_model(optim, f'{H.sampler}_optim', step, H.log_dir)
+
+                if H.ema:
+                    save_model(ema_sampler, f'{H.sampler}_ema', step, H.log_dir)
+
+                train_stats = {
+                    'losses': losses,
+                    'mean_losses': mean_losses,
+                    'val_losses': val_losses,
+                    'elbo': elbo,
+                    'val_elbos': val_elbos,
+                    'steps_per_log': H.steps_per_log,
+                    'steps_per_eval': H.steps_per_eval,
+                }
+                save_stats(H, train_stats, step)
+
+    profiler.close()
 
 
 if __name__ == '__main__':
@@ -3,19 +3,26 @@ import torch
 import numpy as np
 import copy
 import time
-import random
-from torchvision.transforms.functional import hflip
 from models.vqgan import VQGAN
 from hparams import get_vqgan_hparams
-from utils.data_utils import get_data_loaders, cycle
+from utils.data_utils import get_data_loaders, cycle, DevicePrefetcher
 from utils.train_utils import EMA
 from utils.log_utils import log, log_stats, save_model, save_stats, save_images, \
                             display_images, set_up_visdom, config_log, start_training_log
-from utils.vqgan_utils import load_vqgan_from_checkpoint, calc_FID
+from utils.vqgan_utils import load_vqgan_from_checkpoint, ReconstructionFID
+from utils.profile_utils import get_profiler
 
 torch.backends.cudnn.benchmark = True
 
 
+def log_fids(vis, fid_evaluator, fids, fid_steps):
+    for fid_step, fid in fid_evaluator.pop_results():
+        fids, fid_steps = np.append(fids, fid), np.append(fid_steps, fid_step)
+        log(f'Step: {fid_step}  FID: {fid:.4f}')
+        vis.line(fids, fid_steps, win='FID', opts=dict(title='FID'))
+    return fids, fid_steps
+
+
 def main(H, vis):
     vqgan = VQGAN(H).cuda()
     # only load val_loader if running eval
@@ -24,9 +31,10 @@ def main(H, vis):
         H.dataset,
         H.img_size,
         H.batch_size,
-        get_val_dataloader=(H.steps_per_eval != 0)
+        get_val_dataloader=(H.steps_per_eval != 0),
+        cache_dir=H.image_cache_dir
     )
-    train_iterator = cycle(train_loader)
+    train_iterator = DevicePrefetcher(cycle(train_loader), 'cuda', flip_p=0.5 if H.horizontal_flip else 0.0)
     if val_loader is not None:
         val_iterator = cycle(val_loader)
 
@@ -49,6 +57,7 @@ def main(H, vis):
     recon_losses = np.array([])
     latent_ids = []
     fids = np.array([])
+    fid_steps = np.array([])
     best_fid = float('inf')
 
     # NOTE this is getting messy now - easier to just build up a list of steps I think
@@ -66,6 +75,7 @@ def main(H, vis):
             val_losses = train_stats["val_losses"]
             latent_ids = train_stats["latent_ids"]
             fids = train_stats["fids"]
+            fid_steps = train_stats.get("fid_steps", np.array([]))
             best_fid = train_stats["best_fid"]
             H.steps_per_log = train_stats["steps_per_log"]
             H.steps_per_eval = train_stats["steps_per_eval"]
@@ -85,6 +95,16 @@ def main(H, vis):
                     # would have to regenerate steps list again anyway
                     eval_start_step = start_step + H.steps_per_eval - start_step % H.steps_per_eval
 
+    if H.eval_fid:
+        if not H.steps_per_eval:
+            raise ValueError("--eval_fid is calculated every --steps_per_eval steps, which is not set")
+        # held out images where the dataset has a validation split
+        fid_split = "val" if val_loader is not None else "train"
+        fid_dataset = val_loader.dataset if val_loader is not None else train_loader.dataset
+        fid_evaluator = ReconstructionFID(
+            H, vqgan.ae, fid_dataset, fid_split, best_fid, background=H.fid_background
+        )
+
     steps_per_epoch = len(train_loader)
     log(f'Epoch length: {steps_per_epoch}')
 
@@ -92,46 +112,51 @@ def main(H, vis):
     log(f"disc params:{sum(p.numel() for p in vqgan.disc.parameters())}")
     log(f"total params:{sum(p.numel() for p in vqgan.ae.parameters()) + sum(p.numel() for p in vqgan.disc.parameters())}")
 
+    profiler = get_profiler(H)
+
     for step in range(start_step, H.train_steps):
+        profiler.step(step)
         step_start_time = time.time()
-        batch = next(train_iterator)
+        with profiler.phase('data'):
+            batch = next(train_iterator)
 
         if isinstance(batch, list):
             x = batch[0]
         else:
             x = batch
 
-        if H.horizontal_flip:
-            if random.random() <= 0.5:
-                x = hflip(x)
-
-        x = x.cuda()
-
         if H.amp:
             optim.zero_grad()
-            with torch.cuda.amp.autocast():
-                x_hat, stats = vqgan.train_iter(x, step)
-            scaler.scale(stats['loss']).backward()
-            scaler.step(optim)
-            scaler.update()
+            with profiler.phase('forward'):
+                with torch.cuda.amp.autocast():
+                    x_hat, stats = vqgan.train_iter(x, step)
+            with profiler.phase('backward'):
+                scaler.scale(stats['loss']).backward()
+            with profiler.phase('optimizer'):
+                scaler.step(optim)
+                scaler.update()
         else:
-            x_hat, stats = vqgan.train_iter(x, step)
+            with profiler.phase('forward'):
+                x_hat, stats = vqgan.train_iter(x, step)
             optim.zero_grad()
-            stats['loss'].backward()
-            optim.step()
+            with profiler.phase('backward'):
+                stats['loss'].backward()
+            with profiler.phase('optimizer'):
+                optim.step()
 
         losses = np.append(losses, stats['loss'].item())
 
         if step > H.disc_start_step:
-            if H.amp:
-                d_optim.zero_grad()
-                d_scaler.scale(stats['d_loss']).backward()
-                d_scaler.step(d_optim)
-                d_scaler.update()
-            else:
-                d_optim.zero_grad()
-                stats['d_loss'].backward()
-                d_optim.step()
+            with profiler.phase('disc_update'):
+                if H.amp:
+                    d_optim.zero_grad()
+                    d_scaler.scale(stats['d_loss']).backward()
+                    d_scaler.step(d_optim)
+                    d_scaler.update()
+                else:
+                    d_optim.zero_grad()
+                    stats['d_loss'].backward()
+                    d_optim.step()
 
         # collect latent ids
         latent_ids.append(stats['latent_ids'].cpu().contiguous())
@@ -141,49 +166,49 @@ def main(H, vis):
             stats['loss'] = mean_loss
             step_time = time.time() - step_start_time
             stats['step_time'] = step_time
+            stats['data_wait_time'] = train_iterator.pop_wait_time()
             mean_losses = np.append(mean_losses, mean_loss)
             recon_losses = np.append(recon_losses, stats['l1'])
             losses = np.array([])
 
-            vis.line(
-                mean_losses,
-                list(range(log_start_step, step+1, H.steps_per_log)),
-                win='loss',
-                opts=dict(title='Loss')
-            )
-            # vis.line(
-            #     recon_losses,
-            #     list(range(log_start_step, step+1, H.steps_per_log)),
-            #     win='recon_loss',
-            #     opts=dict(title='Train L1 Loss')
-            # )
-            log_stats(step, stats)
+            with profiler.phase('logging'):
+                vis.line(
+                    mean_losses,
+                    list(range(log_start_step, step+1, H.steps_per_log)),
+                    win='loss',
+                    opts=dict(title='Loss')
+                )
+                # vis.line(
+                #     recon_losses,
+                #     list(range(log_start_step, step+1, H.steps_per_log)),
+                #     win='recon_loss',
+                #     opts=dict(title='Train L1 Loss')
+                # )
+                log_stats(step, stats)
 
         # bundled validation loss and FID calculations together
         # NOTE put in seperate function?
         if H.steps_per_eval:
             if step % H.steps_per_eval == 0 and step > 0:
-                # log('Evaluating FIDs and validation loss:')
-                # vqgan.eval()
-                # # Calc FIDs
-                # fid = calc_FID(H, ema_vqgan if H.ema else vqgan)
-                # fids = np.append(fids, fid)
-                # log(f'FID: {fid}')
-                # if fid < best_fid:
-                #     save_model(ema_vqgan if H.ema else vqgan, 'vqgan_bestfid', step, H.log_dir)
+                # FID of reconstructions, in the background the result is logged once it is ready
+                if H.eval_fid:
+                    with profiler.phase('eval'):
+                        fid_evaluator.evaluate(ema_vqgan.ae if H.ema else vqgan.ae, step)
 
                 # Calc validation losses
-                x_val = next(val_iterator)
-                if H.deepspeed:
-                    x_val = x_val.half()
-                _, val_stats = vqgan.val_iter(x, step)
-                val_losses = np.append(val_losses, val_stats['l1'])
+                with profiler.phase('eval'):
+                    x_val = next(val_iterator)
+                    if H.deepspeed:
+                        x_val = x_val.half()
+                    _, val_stats = vqgan.val_iter(x, step)
+                    val_losses = np.append(val_losses, val_stats['l1'])
 
                 steps = [step for step in range(eval_start_step, step+1, H.steps_per_eval)]
-                # vis.line(fids, steps, win='FID',opts=dict(title='FID'))
                 vis.line(val_losses, steps, win='val', opts=dict(title='Validation L1 Loss'))
 
-                # vqgan.train()
+        if H.eval_fid:
+            fids, fid_steps = log_fids(vis, fid_evaluator, fids, fid_steps)
+            best_fid = fid_evaluator.best_fid
 
         # log codebook usage
         if step % steps_per_epoch == 0 and step > 0:
@@ -193,37 +218,62 @@ def main(H, vis):
             latent_ids = []
 
         if H.ema and step % H.steps_per_update_ema == 0 and step > 0:
-            ema.update_model_average(ema_vqgan, vqgan)
+            with profiler.phase('ema'):
+                ema.update_model_average(ema_vqgan, vqgan)
 
         if step % H.steps_per_display_output == 0 and step > 0:
-            display_images(vis, x, H, 'Original Images')
-            # if H.ema:
-            #     x_hat, _ = ema_vqgan.train_iter(x, step)
-            x_hat = x_hat.detach().cpu().to(torch.float32)
-            display_images(vis, x_hat, H, 'VQGAN Recons')
+            with profiler.phase('logging'):
+                display_images(vis, x, H, 'Original Images')
+                # if H.ema:
+                #     x_hat, _ = ema_vqgan.train_iter(x, step)
+                x_hat = x_hat.detach().cpu().to(torch.float32)
+                display_images(vis, x_hat, H, 'VQGAN Recons')
 
         if step % H.steps_per_save_output == 0:
-            save_images(x_hat, 'recons', step, H.log_dir, H.save_individually)
+            with profiler.phase('checkpoint'):
+                save_images(x_hat, 'recons', step, H.log_dir, H.save_individually)
 
         if step % H.steps_per_checkpoint == 0 and step > H.load_step:
-
-            save_model(vqgan, 'vqgan', step, H.log_dir)
-            save_model(optim, 'ae_optim', step, H.log_dir)
-            save_model(d_optim, 'disc_optim', step, H.log_dir)
-            if H.ema:
-                save_model(ema_vqgan, 'vqgan_ema', step, H.log_dir)
-
+            with profiler.phase('checkpoint'):
+                save_model(vqgan, 'vqgan', step, H.log_dir)
+                save_model(optim, 'ae_optim', step, H.log_dir)
+                save_model(d_optim, 'disc_optim', step, H.log_dir)
+                if H.ema:
+                    save_model(ema_vqgan, 'vqgan_ema', step, H.log_dir)
+
+                train_stats = {
+                    'losses': losses,
+                    'mean_losses': mean_losses,
+                    'val_losses': val_losses,
+                    'latent_ids': latent_ids,
+                    'fids': fids,
+                    'fid_steps': fid_steps,
+                    'best_fid': best_fid,
+                    'steps_per_log': H.steps_per_log,
+                    'steps_per_eval': H.steps_per_eval,
+                }
+                save_stats(H, train_stats, step)
+
+    if H.eval_fid:
+        fid_evaluator.close()
+        # fids finished after the last checkpoint are saved with the stats of the final step
+        n_fids = len(fids)
+        fids, fid_steps = log_fids(vis, fid_evaluator, fids, fid_steps)
+        if len(fids) > n_fids:
+            best_fid = fid_evaluator.best_fid
             train_stats = {
                 'losses': losses,
                 'mean_losses': mean_losses,
                 'val_losses': val_losses,
                 'latent_ids': latent_ids,
                 'fids': fids,
+                'fid_steps': fid_steps,
                 'best_fid': best_fid,
                 'steps_per_log': H.steps_per_log,
                 'steps_per_eval': H.steps_per_eval,
             }
             save_stats(H, train_stats, step)
+    profiler.close()
 
 
 if __name__ == '__main__':
@@ -1,26 +1,173 @@
+import json
 import os
+import queue
+import threading
+import time
 
-import imageio
+import numpy as np
 import yaml
 import torch
-import torchvision
 from torch.utils.data.dataset import Subset
-from torchvision.transforms import (CenterCrop, Compose, RandomHorizontalFlip, Resize, ToTensor)
+from tqdm import tqdm
+from .log_utils import log
 
 
 class BigDataset(torch.utils.data.Dataset):
+    """
+    Channels first uint8 images from a folder of image files, or from the sample store in the folder if
+    SampleStoreWriter wrote one. Slices of a store are whole batches, read straight from its memory maps.
+    """
     def __init__(self, folder):
         self.folder = folder
-        self.image_paths = os.listdir(folder)
+        if os.path.exists(os.path.join(folder, "index.json")):
+            self.store = SampleStore(folder)
+        else:
+            self.store = None
+            self.image_paths = os.listdir(folder)
 
     def __getitem__(self, index):
+        if self.store is not None:
+            if isinstance(index, slice):
+                return self.store.get_images(index.start, index.stop)
+            return self.store.get_images(index, index + 1)[0]
         path = self.image_paths[index]
-        img = imageio.imread(self.folder+path)
+        import imageio
+        img = imageio.imread(os.path.join(self.folder, path))
         img = torch.from_numpy(img).permute(2, 0, 1)  # -> channels first
         return img
 
     def __len__(self):
-        return len(self.image_paths)
+        return len(self.store) if self.store is not None else len(self.image_paths)
+
+
+class SampleStore:
+    """
+    Reads the images, and latent ids and seeds if they were stored, of a sample store written by
+    SampleStoreWriter. Shards are memory-mapped copy-on-write, so reads within a shard are zero-copy.
+    """
+    def __init__(self, folder):
+        with open(os.path.join(folder, "index.json")) as index_file:
+            self.index = json.load(index_file)
+        self.arrays = {
+            key: [np.load(os.path.join(folder, shard), mmap_mode="c") for shard in self.index.get(key, [])]
+            for key in ["shards", "latents", "seeds"]
+        }
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.arrays["shards"]])
+
+    def get(self, key, start, end):
+        shards = self.arrays[key]
+        if not shards:
+            raise KeyError(f"No {key} in sample store")
+        if start >= end:
+            return torch.from_numpy(shards[0][:0])
+        first = np.searchsorted(self.offsets, start, side="right") - 1
+        last = np.searchsorted(self.offsets, end - 1, side="right") - 1
+        arrays = [
+            shards[i][max(start - self.offsets[i], 0):end - self.offsets[i]] for i in range(first, last + 1)
+        ]
+        # only batches spanning shards are copied
+        return torch.from_numpy(arrays[0] if len(arrays) == 1 else np.concatenate(arrays))
+
+    def get_images(self, start=0, end=None):
+        return self.get("shards", start, len(self) if end is None else end)
+
+    def get_latents(self, start=0, end=None):
+        return self.get("latents", start, len(self) if end is None else end)
+
+    def get_seeds(self, start=0, end=None):
+        return self.get("seeds", start, len(self) if end is None else end)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+
+class SampleStoreWriter:
+    """
+    Writes batches of generated images as uint8, optionally with their latent ids and seeds, into .npy shards
+    of shard_size samples with an index.json. Images use the layout of write_image_shards, so the store can
+    also be read as a ShardedImageDataset. Shards and the index are written then renamed, so a store is
+    always readable up to the last completed shard.
+    """
+    def __init__(self, folder, shard_size=1000):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.shard_size = shard_size
+        self.index = {"shards": [], "num_images": 0}
+        self.buffers = {}
+
+    def add(self, images, latents=None, seeds=None):
+        if images.dtype != torch.uint8:
+            # rounded like torchvision's save_image
+            images = images.mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8)
+        batch = {"shards": images, "latents": latents, "seeds": seeds}
+        if self.index["num_images"] == 0 and not self.buffers:
+            self.buffers = {key: [] for key, value in batch.items() if value is not None}
+        if set(self.buffers) != {key for key, value in batch.items() if value is not None}:
+            raise ValueError("Every batch in a sample store needs the same latents and seeds")
+        for key in self.buffers:
+            self.buffers[key].append(np.asarray(torch.as_tensor(batch[key]).cpu()))
+        while sum(len(array) for array in self.buffers["shards"]) >= self.shard_size:
+            self.write_shard(self.shard_size)
+
+    def write_shard(self, n):
+        shard_idx = len(self.index["shards"])
+        for key, arrays in self.buffers.items():
+            array = np.concatenate(arrays)
+            self.buffers[key] = [array[n:]]
+            # images are named like write_image_shards' shards
+            name = f"{'shard' if key == 'shards' else key}_{shard_idx:05d}.npy"
+            np.save(os.path.join(self.folder, name + ".tmp.npy"), array[:n])
+            os.replace(os.path.join(self.folder, name + ".tmp.npy"), os.path.join(self.folder, name))
+            self.index.setdefault(key, []).append(name)
+        self.index["num_images"] += n
+
+        index_fp = os.path.join(self.folder, "index.json")
+        with open(index_fp + ".tmp", "w") as index_file:
+            json.dump(self.index, index_file)
+        os.replace(index_fp + ".tmp", index_fp)
+
+    def close(self):
+        remaining = sum(len(array) for array in self.buffers.get("shards", []))
+        if remaining:
+            self.write_shard(remaining)
+        log(f"Saved {self.index['num_images']} samples to {self.folder}")
+
+
+def get_batch_loader(dataset, batch_size):
+    # sample stores are read a whole batch at a time, without collating single images
+    if isinstance(dataset, BigDataset) and dataset.store is not None:
+        batches = [slice(start, min(start + batch_size, len(dataset))) for start in range(0, len(dataset), batch_size)]
+        return torch.utils.data.DataLoader(dataset, batch_size=None, sampler=batches)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size)
+
+
+class ShardedImageDataset(torch.utils.data.Dataset):
+    """
+    Reads preprocessed uint8 images from memory-mapped shards written by write_image_shards, optionally only
+    those from start to end. Items are returned in the same (image, label) format as the torchvision datasets,
+    with flipped copies appended after the originals when flip is set.
+    """
+    def __init__(self, folder, flip=False, start=0, end=None):
+        with open(os.path.join(folder, "index.json")) as index_file:
+            index = json.load(index_file)
+        # copy-on-write mapping gives writable zero-copy views without touching the files
+        self.shards = [np.load(os.path.join(folder, shard), mmap_mode="c") for shard in index["shards"]]
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.start = start
+        self.num_images = int(self.offsets[-1] if end is None else end) - start
+        self.flip = flip
+
+    def __getitem__(self, index):
+        flipped = index >= self.num_images
+        index = index % self.num_images + self.start
+        shard_idx = np.searchsorted(self.offsets, index, side="right") - 1
+        img = torch.from_numpy(self.shards[shard_idx][index - self.offsets[shard_idx]])
+        if flipped:
+            img = img.flip(-1)
+        return img.float().div_(255), 0
+
+    def __len__(self):
+        return self.num_images * 2 if self.flip else self.num_images
 
 
 class NoClassDataset(torch.utils.data.Dataset):
@@ -41,6 +188,88 @@ def cycle(iterable):
             yield x
 
 
+class DevicePrefetcher:
+    """
+    Wraps a batch iterator (e.g. cycle(loader)) and keeps the next num_prefetch batches pinned and copied to
+    the device by a background thread, using a side stream on GPU so copies overlap with compute. Random
+    horizontal flips are applied per image as a single tensor op, and the time spent waiting for data is
+    accumulated in wait_time.
+    """
+    def __init__(self, iterator, device, num_prefetch=2, flip_p=0.0):
+        self.iterator = iterator
+        self.device = torch.device(device)
+        self.flip_p = flip_p
+        self.wait_time = 0.0
+        self.queue = queue.Queue(maxsize=num_prefetch)
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == "cuda" else None
+        self.thread = threading.Thread(target=self._prefetch, daemon=True)
+        self.thread.start()
+
+    def _to_device(self, batch):
+        if isinstance(batch, (list, tuple)):
+            return [self._to_device(x) for x in batch]
+        if not isinstance(batch, torch.Tensor):
+            return batch
+        if self.stream is not None and not batch.is_cuda:
+            batch = batch.pin_memory()
+        return batch.to(self.device, non_blocking=True)
+
+    def _record(self, batch):
+        # tensors created on the side stream must not be freed while the main stream is still using them
+        if isinstance(batch, (list, tuple)):
+            for x in batch:
+                self._record(x)
+        elif isinstance(batch, torch.Tensor) and batch.is_cuda:
+            batch.record_stream(torch.cuda.current_stream(self.device))
+
+    def _prefetch(self):
+        try:
+            for batch in self.iterator:
+                event = None
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        batch = self._to_device(batch)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                else:
+                    batch = self._to_device(batch)
+                self.queue.put((batch, event))
+        except Exception as e:
+            self.queue.put((e, None))
+            return
+        self.queue.put((None, None))
+
+    def _flip(self, x):
+        flip = torch.rand(x.size(0), device=x.device) < self.flip_p
+        return torch.where(flip.view(-1, *([1] * (x.dim() - 1))), x.flip(-1), x)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        wait_start_time = time.time()
+        batch, event = self.queue.get()
+        if batch is None:
+            raise StopIteration
+        if isinstance(batch, Exception):
+            raise batch
+        if event is not None:
+            torch.cuda.current_stream(self.device).wait_event(event)
+            self._record(batch)
+        self.wait_time += time.time() - wait_start_time
+
+        if self.flip_p > 0:
+            if isinstance(batch, list):
+                batch[0] = self._flip(batch[0])
+            else:
+                batch = self._flip(batch)
+        return batch
+
+    def pop_wait_time(self):
+        wait_time, self.wait_time = self.wait_time, 0.0
+        return wait_time
+
+
 def get_default_dataset_paths():
     with open("datasets.yml") as yaml_file:
         read_data = yaml.load(yaml_file, Loader=yaml.FullLoader)
@@ -60,30 +289,110 @@ def train_val_split(dataset, train_val_ratio):
     return train_dataset, val_dataset
 
 
-def get_datasets(
-    dataset_name,
-    img_size,
-    get_val_dataset=False,
-    get_flipped=False,
-    train_val_split_ratio=0.95,
-    custom_dataset_path=None,
-):
-    transform = Compose([Resize(img_size), CenterCrop(img_size), ToTensor()])
-    transform_with_flip = Compose([Resize(img_size), CenterCrop(img_size), RandomHorizontalFlip(p=1.0), ToTensor()])
-
+def get_dataset_path(dataset_name, custom_dataset_path=None):
     default_paths = get_default_dataset_paths()
 
     if dataset_name in default_paths:
-        dataset_path = default_paths[dataset_name]
+        return default_paths[dataset_name]
     elif dataset_name == "custom":
         if custom_dataset_path:
-            dataset_path = custom_dataset_path
+            return custom_dataset_path
         else:
             raise ValueError("Custom dataset selected, but no path provided")
     else:
         raise ValueError(f"Invalid dataset chosen: {dataset_name}. To use a custom dataset, set --dataset \
             flag to 'custom'.")
 
+
+def has_val_dataset(dataset_name):
+    # other datasets are split into training and validation images by train_val_split
+    return dataset_name in ["churches", "bedrooms"]
+
+
+def get_shard_cache_dir(cache_dir, dataset_name, img_size, split):
+    return os.path.join(cache_dir, f"{dataset_name}_{img_size}", split)
+
+
+def write_image_shards(dataset, folder, shard_size=10000, batch_size=64, num_workers=8, dataset_path=None):
+    # decode, resize and crop every image once, storing the results as channels-first uint8 arrays. the path the
+    # images were decoded from is kept in the index, so shards of a different custom dataset aren't used by mistake
+    os.makedirs(folder, exist_ok=True)
+    loader = torch.utils.data.DataLoader(
+        NoClassDataset(dataset),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        shuffle=False
+    )
+    shards, shard, shard_pos = [], None, 0
+    for batch in tqdm(loader):
+        batch = batch.numpy()
+        batch_pos = 0
+        while batch_pos < len(batch):
+            if shard is None:
+                shard_len = min(shard_size, len(dataset) - len(shards) * shard_size)
+                shards.append(f"shard_{len(shards):05d}.npy")
+                shard = np.lib.format.open_memmap(
+                    os.path.join(folder, shards[-1]), mode="w+", dtype=np.uint8, shape=(shard_len,) + batch.shape[1:]
+                )
+                shard_pos = 0
+            n = min(len(batch) - batch_pos, len(shard) - shard_pos)
+            shard[shard_pos:shard_pos+n] = batch[batch_pos:batch_pos+n]
+            shard_pos += n
+            batch_pos += n
+            if shard_pos == len(shard):
+                shard.flush()
+                shard = None
+
+    with open(os.path.join(folder, "index.json"), "w") as index_file:
+        json.dump({"shards": shards, "num_images": len(dataset), "dataset_path": dataset_path}, index_file)
+
+
+def get_datasets(
+    dataset_name,
+    img_size,
+    get_val_dataset=False,
+    get_flipped=False,
+    train_val_split_ratio=0.95,
+    custom_dataset_path=None,
+    cache_dir=None,
+):
+    dataset_path = get_dataset_path(dataset_name, custom_dataset_path)
+
+    # use preprocessed shards if they have been written for this dataset, path and image size
+    if cache_dir is not None:
+        train_cache_dir = get_shard_cache_dir(cache_dir, dataset_name, img_size, "train")
+        val_cache_dir = get_shard_cache_dir(cache_dir, dataset_name, img_size, "val")
+        cache_index_fp = os.path.join(train_cache_dir, "index.json")
+        cache_dataset_path = None
+        if os.path.exists(cache_index_fp):
+            with open(cache_index_fp) as index_file:
+                cache_dataset_path = json.load(index_file).get("dataset_path")
+        if cache_dataset_path == dataset_path:
+            val_dataset = None
+            if not get_val_dataset:
+                train_dataset = ShardedImageDataset(train_cache_dir, flip=get_flipped)
+            elif has_val_dataset(dataset_name):
+                train_dataset = ShardedImageDataset(train_cache_dir, flip=get_flipped)
+                val_dataset = ShardedImageDataset(val_cache_dir)
+            else:
+                # the shards hold every image, split the same way as the decoded dataset
+                num_images = len(ShardedImageDataset(train_cache_dir))
+                split_index = int(num_images * train_val_split_ratio)
+                train_dataset = ShardedImageDataset(train_cache_dir, flip=get_flipped, end=split_index)
+                val_dataset = ShardedImageDataset(train_cache_dir, start=split_index)
+            return train_dataset, val_dataset
+        elif os.path.exists(cache_index_fp):
+            log(f"Image shards in {train_cache_dir} were written from {cache_dataset_path}, not {dataset_path}, "
+                f"decoding images from {dataset_name} dataset")
+        else:
+            log(f"No image shards found in {train_cache_dir}, decoding images from {dataset_name} dataset")
+
+    # torchvision is slow to import and only needed to decode datasets
+    import torchvision
+    from torchvision.transforms import CenterCrop, Compose, RandomHorizontalFlip, Resize, ToTensor
+    transform = Compose([Resize(img_size), CenterCrop(img_size), ToTensor()])
+    transform_with_flip = Compose([Resize(img_size), CenterCrop(img_size), RandomHorizontalFlip(p=1.0), ToTensor()])
+
     if dataset_name == "churches":
         train_dataset = torchvision.datasets.LSUN(
             dataset_path,
@@ -160,6 +469,9 @@ def get_data_loaders(
     drop_last=True,
     shuffle=True,
     get_val_dataloader=False,
+    cache_dir=None,
+    pin_memory=True,
+    prefetch_factor=4,
 ):
 
     train_dataset, val_dataset = get_datasets(
@@ -169,15 +481,24 @@ def get_data_loaders(
         get_val_dataset=get_val_dataloader,
         train_val_split_ratio=train_val_split_ratio,
         custom_dataset_path=custom_dataset_path,
+        cache_dir=cache_dir,
     )
 
+    # keep workers alive between epochs and decoding ahead of the training loop
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = dict(persistent_workers=True, prefetch_factor=prefetch_factor)
+    pin_memory = pin_memory and torch.cuda.is_available()
+
     train_loader = torch.utils.data.DataLoader(
         train_dataset,
         num_workers=num_workers,
         sampler=None,
         shuffle=shuffle,
         batch_size=batch_size,
-        drop_last=drop_last
+        drop_last=drop_last,
+        pin_memory=pin_memory,
+        **worker_kwargs
     )
     if get_val_dataloader:
         val_loader = torch.utils.data.DataLoader(
@@ -185,7 +506,9 @@ def get_data_loaders(
             sampler=None,
             shuffle=shuffle,
             batch_size=batch_size,
-            drop_last=drop_last
+            drop_last=drop_last,
+            pin_memory=pin_memory,
+            **worker_kwargs
         )
     else:
         val_loader = None
@@ -1,16 +1,22 @@
 import torch
-import time
+import numpy as np
 from models import Generator
-from utils.log_utils import log, load_model, save_images
-from utils.sampler_utils import retrieve_autoencoder_components_state_dicts, latent_ids_to_onehot
+from models.sampling_kernels import get_sample_generators
+from utils.data_utils import SampleStore, SampleStoreWriter
+from utils.log_utils import log, load_traced_model, save_images
+from utils.sampler_utils import retrieve_autoencoder_components_state_dicts, latent_ids_to_onehot, sample_latents, \
+    get_sampler
+from utils.profile_utils import get_profiler
 from tqdm import tqdm
-from train_sampler import get_sampler
 import os
+import re
 
 @torch.no_grad()
-def generate_images_from_latents(H, all_latents, embedding_weight, generator):
+def generate_images_from_latents(H, all_latents, embedding_weight, generator, seeds=None):
     all_latents = all_latents.cuda()
     generator = generator.cuda()
+    # a sample store replaces the pngs with shards that BigDataset reads back, keeping the latents and seeds
+    store_writer = SampleStoreWriter(f"logs/{H.log_dir}/images", H.sample_shard_size) if H.sample_store else None
 
     for idx, latents in tqdm(list(enumerate(torch.split(all_latents, H.batch_size)))):
         latents_one_hot = latent_ids_to_onehot(latents, H.latent_shape, H.codebook_size).cuda()
@@ -19,35 +25,140 @@ def generate_images_from_latents(H, all_latents, embedding_weight, generator):
         ).permute(0, 3, 1, 2).contiguous()
         gen_images = generator(q)
         # vis.images(gen_images[:64].clamp(0,1), win="FID_sample_check", opts=dict(title="FID_sample_check"))
-        save_images(gen_images.detach().cpu(), "sample", idx, H.log_dir, save_individually=True)
+        if store_writer is not None:
+            batch_seeds = seeds[idx*H.batch_size:(idx+1)*H.batch_size] if seeds is not None else None
+            store_writer.add(gen_images.detach().cpu(), latents.cpu(), batch_seeds)
+        else:
+            save_images(gen_images.detach().cpu(), "sample", idx, H.log_dir, save_individually=True)
+    if store_writer is not None:
+        store_writer.close()
     # generator = generator.cpu()
     del generator
 
 
+def load_latents(latents_path):
+    # latents saved with torch.save, as .npy (e.g. merged by generate_latent_shards.py) or in a sample store
+    if os.path.isdir(latents_path):
+        return SampleStore(latents_path).get_latents().long()
+    if latents_path.endswith(".npy"):
+        return torch.from_numpy(np.load(latents_path)).long()
+    return torch.load(latents_path)
+
+
 @torch.no_grad()
 def generate_latents(H, sampler):
+    # batches are flushed to logs/{log_dir}/latents with the RNG state after them, so a run that is interrupted
+    # can continue with --resume and still produce the same latents as one that wasn't
+    store_dir = f"logs/{H.log_dir}/latents"
+    n_batches = int(H.n_samples/H.batch_size)
+    n_samples = n_batches * H.batch_size
+    if H.resume:
+        start_batch = load_generation_progress(H, store_dir, n_samples)
+    else:
+        remove_latents_shards(store_dir)
+        # the starting RNG state is recorded too, so a run interrupted before its first flush resumes exactly
+        save_generation_progress(H, store_dir, 0, n_samples)
+        start_batch = 0
+
     log(f"Sampling with temperature {H.temp}")
-    all_latents = []
-    os.makedirs('_pkl_files', exist_ok=True)
-    for _ in tqdm(range(int(H.n_samples/H.batch_size))):
-        if H.sampler == "absorbing":
-            if H.sample_type == "diffusion":
-                latents = sampler.sample(sample_steps=H.sample_steps, temp=H.temp)
-            else:
-                latents = sampler.sample_mlm(temp=H.temp, sample_steps=H.sample_steps)
+    profiler = get_profiler(H)
+    pending_latents = []
+    for batch_idx in tqdm(range(start_batch, n_batches), initial=start_batch, total=n_batches):
+        profiler.step(batch_idx)
+        with profiler.phase("sample"):
+            latents = sample_latents(H, sampler)
 
-        elif H.sampler == "autoregressive":
-            latents = sampler.sample(H.temp)
+        pending_latents.append(latents.cpu())
+        if len(pending_latents) == H.batches_per_flush or batch_idx == n_batches - 1:
+            end = (batch_idx + 1) * H.batch_size
+            start = end - len(pending_latents) * H.batch_size
+            # progress is written after its shard, so it never points past missing samples
+            save_latents_shard(torch.cat(pending_latents, dim=0), store_dir, start, end)
+            save_generation_progress(H, store_dir, end, n_samples)
+            pending_latents = []
+    profiler.close()
+
+    return merge_latents_shards(store_dir, n_samples)
+
+
+def get_rng_state():
+    cuda_state = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+    return {"cpu": torch.get_rng_state(), "cuda": cuda_state}
+
+
+def set_rng_state(rng_state):
+    torch.set_rng_state(rng_state["cpu"])
+    if rng_state["cuda"]:
+        torch.cuda.set_rng_state_all(rng_state["cuda"])
 
-        all_latents.append(latents.cpu())
 
-    # all_latents = [torch.load(f"logs/{image_dir}/latents_backup_{i}.pkl") for i in range(10)]
-    all_latents = torch.cat(all_latents, dim=0)
-    timestamp = int(time.time())
+def save_generation_progress(H, store_dir, completed, n_samples):
+    os.makedirs(store_dir, exist_ok=True)
+    progress = {
+        "completed": completed,
+        "n_samples": n_samples,
+        "batch_size": H.batch_size,
+        "rng_state": get_rng_state(),
+    }
+    progress_path = os.path.join(store_dir, "progress.pt")
+    torch.save(progress, progress_path + ".tmp")
+    os.replace(progress_path + ".tmp", progress_path)
 
-    log(f"Saving latents to _pkl_files/latents_backup_{H.dataset}_{timestamp}.pkl")
-    torch.save(all_latents, f"_pkl_files/latents_backup_{H.dataset}_{timestamp}.pkl")
-    return all_latents
+
+def load_generation_progress(H, store_dir, n_samples):
+    # returns the batch to continue from, with the RNG as it was after the last flushed batch
+    progress_path = os.path.join(store_dir, "progress.pt")
+    if not os.path.exists(progress_path):
+        log(f"No progress found in {store_dir}, sampling from the start")
+        remove_latents_shards(store_dir)
+        save_generation_progress(H, store_dir, 0, n_samples)
+        return 0
+
+    progress = torch.load(progress_path)
+    if (progress["n_samples"], progress["batch_size"]) != (n_samples, H.batch_size):
+        raise ValueError(
+            f"Cannot resume {progress['n_samples']} samples in batches of {progress['batch_size']} from {store_dir} "
+            f"as {n_samples} samples in batches of {H.batch_size}"
+        )
+    # shards written after the last recorded progress are sampled again
+    remove_latents_shards(store_dir, progress["completed"])
+    set_rng_state(progress["rng_state"])
+    log(f"Resuming from sample {progress['completed']} of {n_samples} in {store_dir}")
+    return progress["completed"] // H.batch_size
+
+
+# hparams that are baked into each traced artefact when it is exported
+TRACED_GENERATOR_HPARAMS = ["latent_shape", "emb_dim", "img_size"]
+TRACED_DENOISER_HPARAMS = ["sampler", "attn_backend", "attn_window", "pos_emb_type", "block_size", "latent_shape"]
+
+
+def get_traced_hparams(H, keys):
+    return {key: getattr(H, key) for key in keys}
+
+
+def use_traced_generator(H, generator):
+    # swap in the exported inference artefact for the generator if one exists. frozen constants are not moved by
+    # .to(), so the artefact is loaded straight onto the gpu the generator is run on
+    traced_generator = load_traced_model(
+        "generator_traced", H.ae_load_step, H.ae_load_dir, map_location="cuda",
+        hparams=get_traced_hparams(H, TRACED_GENERATOR_HPARAMS)
+    )
+    return generator if traced_generator is None else traced_generator
+
+
+def use_traced_denoiser(H, sampler):
+    # swap the sampler's network for its exported inference artefact if one exists
+    if H.quantize_int8:
+        return sampler
+    net_name = "_denoise_fn" if H.sampler == "absorbing" else "net"
+    device = next(getattr(sampler, net_name).parameters()).device
+    traced_denoiser = load_traced_model(
+        f"{H.sampler}_ema_traced", H.load_step, H.load_dir, map_location=device,
+        hparams=get_traced_hparams(H, TRACED_DENOISER_HPARAMS)
+    )
+    if traced_denoiser is not None:
+        setattr(sampler, net_name, traced_denoiser)
+    return sampler
 
 
 def get_generator_and_embedding_weight(H):
@@ -60,6 +171,7 @@ def get_generator_and_embedding_weight(H):
     embedding_weight = embedding_weight.cuda()
     generator = Generator(H)
     generator.load_state_dict(quanitzer_and_generator_state_dict, strict=False)
+    generator = use_traced_generator(H, generator)
     return generator, embedding_weight
 
 
@@ -71,13 +183,15 @@ def get_sampler_and_generator(H):
     )
     embedding_weight = quanitzer_and_generator_state_dict.pop("embedding.weight")
     embedding_weight = embedding_weight.cuda()
-    sampler = get_sampler(H, embedding_weight).cuda()
-
     generator = Generator(H)
     generator.load_state_dict(quanitzer_and_generator_state_dict, strict=False)
+    generator = use_traced_generator(H, generator)
 
     if H.load_step > 0:
-        sampler = load_model(sampler, f"{H.sampler}_ema", H.load_step, H.load_dir).cuda()
+        sampler = get_sampler(H, embedding_weight, load_ema=True)
+        sampler = use_traced_denoiser(H, sampler)
+    else:
+        sampler = get_sampler(H, embedding_weight).cuda()
 
     sampler = sampler.eval()
     return sampler, generator
@@ -86,14 +200,89 @@ def get_sampler_and_generator(H):
 @torch.no_grad()
 def generate_samples(H):
     generator, embedding_weight = get_generator_and_embedding_weight(H)
-    sampler = get_sampler(H, embedding_weight).cuda()
     if H.load_step > 0:
-        sampler = load_model(sampler, f"{H.sampler}_ema", H.load_step, H.load_dir).cuda()
+        sampler = get_sampler(H, embedding_weight, load_ema=True)
     else:
         raise ValueError("No load step provided, cannot load sampler")
+    sampler = use_traced_denoiser(H, sampler)
     sampler = sampler.eval()
     all_latents = generate_latents(H, sampler)
     embedding_weight = sampler.embedding_weight.cuda().clone()
     del sampler
 
     generate_images_from_latents(H, all_latents, embedding_weight, generator)
+
+
+def get_shard_range(n_samples, batch_size, num_shards, shard_index):
+    # shards are whole global batches, so every sample is generated in the same batch however the work is split,
+    # which keeps the denoiser's numerics as well as its random streams identical
+    n_batches = -(-n_samples // batch_size)
+    start_batch = shard_index * n_batches // num_shards
+    end_batch = (shard_index + 1) * n_batches // num_shards
+    return min(start_batch * batch_size, n_samples), min(end_batch * batch_size, n_samples)
+
+
+@torch.no_grad()
+def generate_latents_range(H, sampler, start, end, seed):
+    # sample i only depends on the seed and i, given the same batch size
+    if start % H.batch_size != 0:
+        raise ValueError(f"Shard start {start} is not aligned to batch size {H.batch_size}")
+    if H.sampler == "absorbing" and H.sample_type != "diffusion":
+        raise ValueError("Per-sample random streams are only supported for diffusion and autoregressive sampling")
+
+    all_latents = []
+    for batch_start in tqdm(range(start, end, H.batch_size)):
+        batch_end = min(batch_start + H.batch_size, H.n_samples)
+        generators = get_sample_generators(seed, range(batch_start, batch_end), sampler.device)
+        sampler.n_samples = batch_end - batch_start
+        latents = sample_latents(H, sampler, generators=generators)
+        all_latents.append(latents.cpu())
+    return torch.cat(all_latents, dim=0)[:end - start]
+
+
+def save_latents_shard(latents, store_dir, start, end):
+    os.makedirs(store_dir, exist_ok=True)
+    path = os.path.join(store_dir, f"latents_{start}_{end}.npy")
+    # write then rename so a crashed worker never leaves a partial shard behind
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, latents.numpy().astype(np.int32))
+    os.replace(tmp_path, path)
+    log(f"Saved latents {start}-{end} to {path}")
+
+
+def get_latents_shards(store_dir):
+    # (start, end, filename) of the shards in a store, in order
+    shards = []
+    for filename in os.listdir(store_dir) if os.path.exists(store_dir) else []:
+        match = re.fullmatch(r"latents_(\d+)_(\d+)\.npy", filename)
+        if match:
+            shards.append((int(match.group(1)), int(match.group(2)), filename))
+    return sorted(shards)
+
+
+def remove_latents_shards(store_dir, start=0):
+    for shard_start, _, filename in get_latents_shards(store_dir):
+        if shard_start >= start:
+            os.remove(os.path.join(store_dir, filename))
+    if start == 0 and os.path.exists(os.path.join(store_dir, "progress.pt")):
+        os.remove(os.path.join(store_dir, "progress.pt"))
+
+
+def merge_latents_shards(store_dir, n_samples):
+    shards = get_latents_shards(store_dir)
+
+    # every index in [0, n_samples) must be covered exactly once
+    expected_start = 0
+    for start, end, filename in shards:
+        if start != expected_start:
+            problem = "overlaps" if start < expected_start else f"leaves a gap {expected_start}-{start} after"
+            raise ValueError(f"Shard {filename} {problem} the previous shards")
+        expected_start = end
+    if expected_start != n_samples:
+        raise ValueError(f"Shards cover samples 0-{expected_start}, expected {n_samples}")
+
+    latents = np.concatenate([np.load(os.path.join(store_dir, filename)) for _, _, filename in shards])
+    merged_path = os.path.join(store_dir, "latents.npy")
+    np.save(merged_path, latents)
+    log(f"Merged {len(shards)} shards covering {n_samples} samples into {merged_path}")
+    return torch.from_numpy(latents).long()
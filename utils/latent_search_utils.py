@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+
+def get_codebook_distances(embedding_weight):
+    # squared euclidean distance between every pair of codebook vectors, (codebook_size, codebook_size)
+    embedding_weight = torch.as_tensor(embedding_weight).detach().float().cpu()
+    squared_norms = (embedding_weight ** 2).sum(1)
+    distances = squared_norms[:, None] + squared_norms[None, :] - 2 * embedding_weight @ embedding_weight.t()
+    return distances.clamp_(min=0).numpy()
+
+
+def hamming_distances(queries, latents, query_block=8):
+    # (q, n) number of positions whose tokens differ, a few queries at a time so the comparisons stay in cache
+    return np.concatenate([
+        (queries[i:i+query_block, None, :] != latents[None, :, :]).sum(-1, dtype=np.int32)
+        for i in range(0, len(queries), query_block)
+    ]).astype(np.float32)
+
+
+def embedding_distances(queries, latents, codebook_distances):
+    # (q, n) squared euclidean distance between the grids of codebook vectors, accumulated one position at a time
+    distances = np.zeros((len(queries), len(latents)), dtype=np.float32)
+    latents_by_position = np.ascontiguousarray(latents.T)
+    for position in range(queries.shape[1]):
+        distances += np.take(codebook_distances[queries[:, position]], latents_by_position[position], axis=1)
+    return distances
+
+
+def latent_topk(queries, latents, k=10, codebook_distances=None, chunk_size=4096, num_threads=4):
+    """
+    Finds the k latents nearest to each query by Hamming distance, or by codebook embedding distance if
+    codebook_distances is given. queries are (q, seq_len) and latents (n, seq_len) token ids, as tensors or numpy
+    arrays, including memory-mapped ones. latents are read in chunks of chunk_size rows by num_threads threads,
+    so only the chunks being compared are in memory. Returns (distances, indices), both (q, k), nearest first.
+    """
+    queries = np.asarray(queries.cpu() if torch.is_tensor(queries) else queries).astype(np.int32)
+    k = min(k, len(latents))
+
+    def search_chunk(start):
+        chunk = latents[start:start+chunk_size]
+        chunk = np.asarray(chunk.cpu() if torch.is_tensor(chunk) else chunk).astype(np.int32)
+        if codebook_distances is None:
+            distances = hamming_distances(queries, chunk)
+        else:
+            distances = embedding_distances(queries, chunk, codebook_distances)
+        chunk_k = min(k, len(chunk))
+        indices = np.argpartition(distances, chunk_k - 1, axis=1)[:, :chunk_k]
+        return np.take_along_axis(distances, indices, axis=1), indices + start
+
+    # numpy releases the GIL while comparing, so the chunks are searched in parallel
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        results = list(executor.map(search_chunk, range(0, len(latents), chunk_size)))
+
+    # the k nearest overall are among the k nearest of each chunk, ties are broken by the lower index
+    distances = np.concatenate([distances for distances, _ in results], axis=1)
+    indices = np.concatenate([indices for _, indices in results], axis=1)
+    order = np.lexsort((indices, distances), axis=1)[:, :k]
+    return (
+        torch.from_numpy(np.take_along_axis(distances, order, axis=1)),
+        torch.from_numpy(np.take_along_axis(indices, order, axis=1))
+    )
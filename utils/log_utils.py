@@ -1,9 +1,8 @@
+import json
 import logging
 import numpy as np
 import os
 import torch
-import torchvision
-import visdom
 
 
 def config_log(log_dir, filename="log.txt"):
@@ -65,21 +64,107 @@ def load_model(model, model_load_name, step, log_dir, strict=False):
     return model
 
 
+def save_traced_model(model, model_save_name, step, log_dir, hparams=None):
+    log_dir = "logs/" + log_dir + "/saved_models"
+    os.makedirs(log_dir, exist_ok=True)
+    log(f"Saving {model_save_name} to {model_save_name}_{str(step)}.pt")
+    torch.jit.save(model, os.path.join(log_dir, f"{model_save_name}_{step}.pt"))
+    # the hparams baked into the trace are kept alongside it, so loaders can tell if it is still valid
+    if hparams is not None:
+        with open(os.path.join(log_dir, f"{model_save_name}_{step}.json"), "w") as f:
+            json.dump(hparams, f)
+
+
+def load_traced_model(model_load_name, step, log_dir, map_location=None, hparams=None):
+    # returns None when no traced artefact has been exported, or when it was exported with hparams other than the
+    # given ones, so callers can fall back to the eager model
+    load_path = os.path.join("logs/" + log_dir + "/saved_models", f"{model_load_name}_{step}.pt")
+    if not os.path.exists(load_path):
+        return None
+    if hparams is not None:
+        hparams_path = load_path[:-len(".pt")] + ".json"
+        saved_hparams = None
+        if os.path.exists(hparams_path):
+            with open(hparams_path) as f:
+                saved_hparams = json.load(f)
+        # round trip through json so tuples compare equal to the saved lists
+        hparams = json.loads(json.dumps(hparams))
+        if saved_hparams != hparams:
+            log(f"Traced {model_load_name}_{str(step)}.pt was exported with {saved_hparams}, not {hparams}, "
+                "using the eager model")
+            return None
+    log(f"Loading traced {model_load_name}_{str(step)}.pt")
+    return torch.jit.load(load_path, map_location=map_location)
+
+
+def get_components_dir(model_name, step, log_dir):
+    return os.path.join("logs/" + log_dir + "/saved_models", f"{model_name}_{step}_components")
+
+
+def save_model_components(state_dict, component_prefixes, model_name, step, log_dir):
+    # each component is written as one flat binary file of raw tensor data plus a json index of offsets,
+    # so loaders can memory map just the components they need. keys not under any prefix are dropped
+    save_dir = get_components_dir(model_name, step, log_dir)
+    os.makedirs(save_dir, exist_ok=True)
+    for component, prefix in component_prefixes.items():
+        index, offset = {}, 0
+        with open(os.path.join(save_dir, f"{component}.bin"), "wb") as data_file:
+            for key, tensor in state_dict.items():
+                if not key.startswith(prefix):
+                    continue
+                tensor = tensor.detach().cpu().contiguous()
+                dtype = str(tensor.dtype).replace("torch.", "")
+                # numpy has no bfloat16, store the raw bits instead
+                data = (tensor.view(torch.int16) if tensor.dtype == torch.bfloat16 else tensor).numpy().tobytes()
+                index[key] = {"dtype": dtype, "shape": list(tensor.shape), "offset": offset}
+                data_file.write(data)
+                # keep every tensor 64 byte aligned
+                padding = -len(data) % 64
+                data_file.write(b"\0" * padding)
+                offset += len(data) + padding
+        with open(os.path.join(save_dir, f"{component}.json"), "w") as index_file:
+            json.dump(index, index_file)
+        log(f"Saved {len(index)} tensors ({offset / 2**20:.1f}MB) for {component} to {save_dir}")
+
+
+def load_model_components(components, model_name, step, log_dir):
+    # returns a state dict of tensors backed by memory maps, data is only read from disk when first used
+    load_dir = get_components_dir(model_name, step, log_dir)
+    state_dict = {}
+    for component in components:
+        with open(os.path.join(load_dir, f"{component}.json")) as index_file:
+            index = json.load(index_file)
+        if not index:
+            continue
+        # copy on write so the tensors are writable without modifying the file
+        data = np.memmap(os.path.join(load_dir, f"{component}.bin"), dtype=np.uint8, mode="c")
+        for key, entry in index.items():
+            dtype = getattr(torch, entry["dtype"])
+            np_dtype = np.dtype(np.int16) if dtype == torch.bfloat16 else torch.empty(0, dtype=dtype).numpy().dtype
+            numel = int(np.prod(entry["shape"]))
+            array = data[entry["offset"]:entry["offset"] + numel * np_dtype.itemsize].view(np_dtype)
+            tensor = torch.from_numpy(array).view(entry["shape"])
+            state_dict[key] = tensor.view(torch.bfloat16) if dtype == torch.bfloat16 else tensor
+    return state_dict
+
+
 def display_images(vis, images, H, win_name=None):
     if win_name is None:
         win_name = f"{H.model}_images"
-    images = torchvision.utils.make_grid(images.clamp(0, 1), nrow=int(np.sqrt(images.size(0))), padding=0)
+    from torchvision.utils import make_grid
+    images = make_grid(images.clamp(0, 1), nrow=int(np.sqrt(images.size(0))), padding=0)
     vis.image(images, win=win_name, opts=dict(title=win_name))
 
 
 def save_images(images, im_name, step, log_dir, save_individually=False):
+    from torchvision.utils import save_image
     log_dir = "logs/" + log_dir + "/images"
     os.makedirs(log_dir, exist_ok=True)
     if save_individually:
         for idx in range(len(images)):
-            torchvision.utils.save_image(torch.clamp(images[idx], 0, 1), f"{log_dir}/{im_name}_{step}_{idx}.png")
+            save_image(torch.clamp(images[idx], 0, 1), f"{log_dir}/{im_name}_{step}_{idx}.png")
     else:
-        torchvision.utils.save_image(
+        save_image(
             torch.clamp(images, 0, 1),
             f"{log_dir}/{im_name}_{step}.png",
             nrow=int(np.sqrt(images.shape[0])),
@@ -114,6 +199,7 @@ def load_stats(H, step):
 
 
 def set_up_visdom(H):
+    import visdom
     server = H.visdom_server
     try:
         if server:
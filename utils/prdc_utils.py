@@ -0,0 +1,107 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+
+def load_features(features_fp):
+    # .npy features are memory-mapped, so only the rows of the block being compared are read in
+    if features_fp.endswith(".npy"):
+        return np.load(features_fp, mmap_mode="r")
+    features = torch.load(features_fp, map_location="cpu")
+    if isinstance(features, dict):
+        # torch-fidelity feature caches hold a single feature layer
+        features, = features.values()
+    if isinstance(features, (list, tuple)):
+        features = torch.cat(list(features), dim=0)
+    return features.numpy() if torch.is_tensor(features) else np.asarray(features)
+
+
+def get_squared_norms(features, block_size=4096):
+    squared_norms = []
+    for start in range(0, len(features), block_size):
+        block = np.asarray(features[start:start+block_size], dtype=np.float64)
+        squared_norms.append(np.einsum("ij,ij->i", block, block))
+    return np.concatenate(squared_norms)
+
+
+def get_block_sizes(n_columns, n_dims, itemsize, max_memory_mb, num_threads):
+    # each thread holds a block of rows of distances and a boolean mask of the same shape, plus the float64 copies
+    # of the block and of a tile of columns that are being multiplied
+    thread_bytes = max_memory_mb * 2 ** 20 / num_threads
+    tile_size = int(min(n_columns, max(1, thread_bytes / 4 / (8 * n_dims))))
+    bytes_per_row = n_columns * (itemsize + 1) + tile_size * 8 * 2 + n_dims * 8
+    return max(1, int(thread_bytes * 3 / 4 / bytes_per_row)), tile_size
+
+
+def pairwise_distances(x, y, y_squared_norms, tile_size):
+    # euclidean distances as computed by sklearn: squared distances in float64, cast back to the features' dtype
+    x64 = np.asarray(x, dtype=np.float64)
+    x_squared_norms = np.einsum("ij,ij->i", x64, x64)[:, None]
+    distances = np.empty((len(x), len(y)), dtype=x.dtype)
+    for start in range(0, len(y), tile_size):
+        tile = x64 @ np.asarray(y[start:start+tile_size], dtype=np.float64).T
+        tile *= -2
+        tile += x_squared_norms
+        tile += y_squared_norms[None, start:start+tile_size]
+        distances[:, start:start+tile_size] = tile
+    np.maximum(distances, 0, out=distances)
+    return np.sqrt(distances, out=distances)
+
+
+def map_blocks(fn, n_rows, block_size, num_threads):
+    starts = range(0, n_rows, block_size)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(lambda start: fn(start, min(start + block_size, n_rows)), starts))
+
+
+def nearest_neighbour_radii(features, nearest_k, max_memory_mb=1024, num_threads=4):
+    # distance from every row to its nearest_k-th neighbour, not counting itself
+    squared_norms = get_squared_norms(features)
+    block_size, tile_size = get_block_sizes(
+        len(features), features.shape[1], features.dtype.itemsize, max_memory_mb, num_threads
+    )
+
+    def block_radii(start, end):
+        distances = pairwise_distances(np.asarray(features[start:end]), features, squared_norms, tile_size)
+        # copied so the partitioned block isn't kept alive by a view of one of its columns
+        return np.partition(distances, nearest_k, axis=1)[:, nearest_k].copy()
+
+    return np.concatenate(map_blocks(block_radii, len(features), block_size, num_threads))
+
+
+def compute_prdc(real_features, fake_features, nearest_k=3, max_memory_mb=1024, num_threads=4):
+    """
+    Precision, recall, density and coverage as computed by prdc.compute_prdc, without holding any full pairwise
+    distance matrix. Distances are computed in blocks of real rows, sized so that the blocks being worked on by
+    num_threads threads take up about max_memory_mb, and reduced to per-row and per-column counts as they go.
+    """
+    real_radii = nearest_neighbour_radii(real_features, nearest_k, max_memory_mb, num_threads)
+    fake_radii = nearest_neighbour_radii(fake_features, nearest_k, max_memory_mb, num_threads)
+    fake_squared_norms = get_squared_norms(fake_features)
+    block_size, tile_size = get_block_sizes(
+        len(fake_features), fake_features.shape[1], real_features.dtype.itemsize, max_memory_mb, num_threads
+    )
+
+    def block_counts(start, end):
+        distances = pairwise_distances(
+            np.asarray(real_features[start:end]), fake_features, fake_squared_norms, tile_size
+        )
+        # fakes inside each real sample's neighbourhood, for precision and density
+        fake_counts = (distances < real_radii[start:end, None]).sum(axis=0)
+        # reals inside any fake sample's neighbourhood, for recall
+        recalled = (distances < fake_radii[None, :]).any(axis=1)
+        # reals whose nearest fake sample is inside their neighbourhood, for coverage
+        covered = distances.min(axis=1) < real_radii[start:end]
+        return fake_counts, recalled, covered
+
+    results = map_blocks(block_counts, len(real_features), block_size, num_threads)
+    fake_counts = np.sum([counts for counts, _, _ in results], axis=0)
+    recalled = np.concatenate([recalled for _, recalled, _ in results])
+    covered = np.concatenate([covered for _, _, covered in results])
+
+    return dict(
+        precision=(fake_counts > 0).mean(),
+        recall=recalled.mean(),
+        density=(1. / float(nearest_k)) * fake_counts.mean(),
+        coverage=covered.mean()
+    )
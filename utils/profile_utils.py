@@ -0,0 +1,148 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+import numpy as np
+import torch
+from .log_utils import log
+
+
+class StepProfiler:
+    """
+    Times named phases of a training or sampling step. Timings are aggregated into percentiles over a window
+    of steps and exported as Chrome trace events (chrome://tracing or Perfetto) alongside a JSON summary.
+    With sync set, CUDA is synchronised around each phase so GPU work is attributed to the phase that
+    launched it. A torch profiler capture can also be taken over a range of steps.
+    """
+    def __init__(self, enabled=False, sync=False, window=100, torch_steps=None, log_dir="test"):
+        self.enabled = enabled
+        self.sync = sync and torch.cuda.is_available()
+        self.window = window
+        self.torch_steps = torch_steps
+        self.save_dir = f"logs/{log_dir}/profiles"
+        self.current_step = 0
+        self.window_start_step = None
+        self.start_time = time.perf_counter()
+        self.phase_times = defaultdict(list)
+        self.events = []
+        self.torch_profiler = None
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        if self.sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            if self.torch_profiler is not None:
+                with torch.autograd.profiler.record_function(name):
+                    yield
+            else:
+                yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize()
+            end = time.perf_counter()
+            self.phase_times[name].append(end - start)
+            self.events.append({
+                "name": name,
+                "ph": "X",
+                "ts": (start - self.start_time) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {"step": self.current_step},
+            })
+
+    def step(self, step):
+        # call at the start of every step, closes windows and starts/stops torch profiler captures
+        if not self.enabled:
+            return
+        if self.window_start_step is None:
+            self.window_start_step = step
+        elif step - self.window_start_step >= self.window:
+            self.end_window()
+            self.window_start_step = step
+        self.current_step = step
+
+        if self.torch_steps is not None:
+            if step == self.torch_steps[0] and self.torch_profiler is None:
+                self._start_torch_profiler()
+            elif step == self.torch_steps[1] and self.torch_profiler is not None:
+                self._stop_torch_profiler()
+
+    def summary(self):
+        summary = {}
+        for name, times in self.phase_times.items():
+            times = np.array(times) * 1000
+            summary[name] = {
+                "count": len(times),
+                "mean_ms": float(times.mean()),
+                "p50_ms": float(np.percentile(times, 50)),
+                "p90_ms": float(np.percentile(times, 90)),
+                "p99_ms": float(np.percentile(times, 99)),
+                "total_ms": float(times.sum()),
+            }
+        return summary
+
+    def end_window(self):
+        if not self.phase_times:
+            return
+        summary = self.summary()
+        total = sum(stats["total_ms"] for stats in summary.values())
+        log_str = f"Profile steps {self.window_start_step}-{self.current_step}  "
+        for name, stats in summary.items():
+            log_str += f"{name}: {stats['p50_ms']:.1f}/{stats['p90_ms']:.1f}ms ({100 * stats['total_ms'] / total:.0f}%)  "
+        log(log_str)
+
+        os.makedirs(self.save_dir, exist_ok=True)
+        with open(f"{self.save_dir}/summary_{self.current_step}.json", "w") as summary_file:
+            json.dump(summary, summary_file, indent=2)
+        self.export_chrome_trace(f"{self.save_dir}/trace_{self.current_step}.json")
+
+        self.phase_times = defaultdict(list)
+        self.events = []
+
+    def export_chrome_trace(self, path):
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, trace_file)
+
+    def _start_torch_profiler(self):
+        log(f"Starting torch profiler at step {self.current_step}")
+        # torch.profiler is only available in newer versions of torch
+        if hasattr(torch, "profiler"):
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+        else:
+            self.torch_profiler = torch.autograd.profiler.profile(use_cuda=torch.cuda.is_available())
+        self.torch_profiler.__enter__()
+
+    def _stop_torch_profiler(self):
+        self.torch_profiler.__exit__(None, None, None)
+        os.makedirs(self.save_dir, exist_ok=True)
+        trace_path = f"{self.save_dir}/torch_trace_{self.torch_steps[0]}_{self.torch_steps[1]}.json"
+        log(f"Saving torch profiler trace to {trace_path}")
+        self.torch_profiler.export_chrome_trace(trace_path)
+        self.torch_profiler = None
+
+    def close(self):
+        if self.torch_profiler is not None:
+            self._stop_torch_profiler()
+        if self.enabled:
+            self.end_window()
+
+
+def get_profiler(H):
+    return StepProfiler(
+        enabled=H.profile,
+        sync=H.profile_sync,
+        window=H.profile_window,
+        torch_steps=H.profile_torch_steps,
+        log_dir=H.log_dir
+    )
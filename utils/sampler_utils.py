@@ -1,42 +1,94 @@
 import os
+import numpy as np
 import torch
+import torch.nn as nn
 from tqdm import tqdm
-from .log_utils import save_latents, log
-from models import Transformer, AbsorbingDiffusion, AutoregressiveTransformer
+from .data_utils import DevicePrefetcher
+from .log_utils import save_latents, log, load_model, get_components_dir, load_model_components
+from .profile_utils import StepProfiler
+from models import Transformer, AbsorbingDiffusion, AutoregressiveTransformer, LatentExtractor
 
 
-def get_sampler(H, embedding_weight):
+def get_sampler(H, embedding_weight, load_ema=False):
 
     if H.sampler == 'absorbing':
-        denoise_fn = Transformer(H).cuda()
+        denoise_fn = Transformer(H)
         sampler = AbsorbingDiffusion(
             H, denoise_fn, H.codebook_size, embedding_weight)
 
     elif H.sampler == 'autoregressive':
         sampler = AutoregressiveTransformer(H, embedding_weight)
 
+    # load trained EMA weights for sampling, quantized to int8 on the CPU if requested
+    if load_ema:
+        sampler = load_model(sampler, f'{H.sampler}_ema', H.load_step, H.load_dir)
+        if H.quantize_int8:
+            sampler = quantize_sampler(H, sampler)
+        else:
+            sampler = sampler.cuda()
+
     return sampler
 
 
-@torch.no_grad()
-def get_samples(H, generator, sampler):
+def quantize_sampler(H, sampler):
+    # dynamic int8 quantization of all linear layers, only supported by CPU kernels
+    sampler = sampler.cpu().eval()
+    if H.sampler == 'absorbing':
+        sampler._denoise_fn = torch.quantization.quantize_dynamic(sampler._denoise_fn, {nn.Linear}, dtype=torch.qint8)
+    elif H.sampler == 'autoregressive':
+        sampler.net = torch.quantization.quantize_dynamic(sampler.net, {nn.Linear}, dtype=torch.qint8)
+    log(f"Quantized {H.sampler} sampler to int8 for CPU sampling")
+    return sampler
 
+
+def sample_latents(H, sampler, temp=None, sample_steps=None, generators=None):
+    # temp and sample_steps default to the values in H
+    temp = H.temp if temp is None else temp
+    sample_steps = H.sample_steps if sample_steps is None else sample_steps
     if H.sampler == "absorbing":
-        if H.sample_type == "diffusion":
-            latents = sampler.sample(sample_steps=H.sample_steps, temp=H.temp)
+        if H.sample_type == "diffusion" and H.unmask_schedule in [None, "random"]:
+            latents = sampler.sample(sample_steps=sample_steps, temp=temp, generators=generators)
+        elif H.sample_type == "diffusion":
+            latents = sampler.sample_scheduled(
+                temp=temp,
+                sample_steps=sample_steps,
+                unmask_schedule=H.unmask_schedule,
+                unmask_order=H.unmask_order,
+                max_tokens_per_step=H.max_tokens_per_step or 0,
+                temp_end=H.temp_end,
+                generators=generators
+            )
         else:
-            latents = sampler.sample_mlm(temp=H.temp, sample_steps=H.sample_steps)
+            latents = sampler.sample_mlm(temp=temp, sample_steps=sample_steps)
 
     elif H.sampler == "autoregressive":
-        latents = sampler.sample(H.temp)
+        latents = sampler.sample(temp, generators=generators)
 
-    latents_one_hot = latent_ids_to_onehot(latents, H.latent_shape, H.codebook_size)
-    q = sampler.embed(latents_one_hot)
-    images = generator(q.float())
+    return latents
+
+
+@torch.no_grad()
+def get_samples(H, generator, sampler, profiler=None):
+    profiler = profiler if profiler is not None else StepProfiler()
+
+    with profiler.phase("sample"):
+        latents = sample_latents(H, sampler)
+
+    with profiler.phase("decode"):
+        images = decode_latents(H, generator, sampler, latents)
 
     return images
 
 
+@torch.no_grad()
+def decode_latents(H, generator, sampler, latents):
+    # quantized samplers run on the CPU, but the codebook and generator may not
+    latents = latents.to(sampler.embedding_weight.device)
+    latents_one_hot = latent_ids_to_onehot(latents, H.latent_shape, H.codebook_size)
+    q = sampler.embed(latents_one_hot)
+    return generator(q.float())
+
+
 def latent_ids_to_onehot(latent_ids, latent_shape, codebook_size):
     min_encoding_indices = latent_ids.view(-1).unsqueeze(1)
     encodings = torch.zeros(
@@ -53,49 +105,133 @@ def latent_ids_to_onehot(latent_ids, latent_shape, codebook_size):
     return one_hot.reshape(one_hot.shape[0], -1, codebook_size)
 
 
-@torch.no_grad()
-def generate_latent_ids(H, ae, train_loader, val_loader=None):
-    train_latent_ids = generate_latents_from_loader(H, ae, train_loader)
-    if val_loader is not None:
-        val_latent_ids = generate_latents_from_loader(H, ae, val_loader)
+def get_latent_extractor(H, device):
+    # only the encoder and quantizer are loaded, the generator and discriminator are not needed for extraction
+    extractor = LatentExtractor(H, bf16=H.extract_bf16)
+    extractor.load_state_dict(retrieve_autoencoder_components_state_dicts(H, ["encoder", "quantize"]), strict=False)
+    return extractor.to(device).to(memory_format=torch.channels_last).eval()
+
+
+def find_extraction_batch_size(H, extractor, device):
+    # doubles the batch size until the encoder runs out of memory or reaches extract_max_batch_size
+    if H.extract_batch_size:
+        return H.extract_batch_size
+    batch_size = H.vqgan_batch_size
+    if device.type != "cuda":
+        return batch_size
+
+    while batch_size * 2 <= H.extract_max_batch_size:
+        try:
+            extractor(torch.zeros(batch_size * 2, H.n_channels, H.img_size, H.img_size, device=device))
+        except RuntimeError as e:
+            if "out of memory" not in str(e):
+                raise
+            break
+        finally:
+            torch.cuda.empty_cache()
+        batch_size *= 2
+    return batch_size
+
+
+def generate_latents_from_dataset(H, extractor, dataset, batch_size, device):
+    loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=H.extract_num_workers,
+        pin_memory=device.type == "cuda"
+    )
+    # the loader workers decode images and the prefetcher copies them to the device while the encoder runs
+    latent_ids = []
+    for x, _ in tqdm(DevicePrefetcher(iter(loader), device), total=len(loader)):
+        latent_ids.append(extractor(x))
+    return torch.cat(latent_ids, dim=0).cpu()
+
+
+def generate_latent_ids(H, extractor, train_dataset, val_dataset=None, device="cuda"):
+    device = torch.device(device)
+    batch_size = find_extraction_batch_size(H, extractor, device)
+    log(f"Extracting latents in batches of {batch_size}")
+    train_latent_ids = generate_latents_from_dataset(H, extractor, train_dataset, batch_size, device)
+    if val_dataset is not None:
+        val_latent_ids = generate_latents_from_dataset(H, extractor, val_dataset, batch_size, device)
     else:
         val_latent_ids = None
 
     save_latents(H, train_latent_ids, val_latent_ids)
 
 
-def generate_latents_from_loader(H, autoencoder, dataloader):
-    latent_ids = []
-    for x, _ in tqdm(dataloader):
-        x = x.cuda()
-        latents = autoencoder.encoder(x)  # B, emb_dim, H, W
-
-        latents = latents.permute(0, 2, 3, 1).contiguous()  # B, H, W, emb_dim
-        latents_flattened = latents.view(-1, H.emb_dim)  # B*H*W, emb_dim
-
-        # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
-        distances = (latents_flattened ** 2).sum(dim=1, keepdim=True) + \
-            (autoencoder.quantize.embedding.weight**2).sum(1) - \
-            2 * torch.matmul(latents_flattened, autoencoder.quantize.embedding.weight.t())
-
-        min_encoding_indices = torch.argmin(distances, dim=1)
-
-        latent_ids.append(min_encoding_indices.reshape(x.shape[0], -1).cpu().contiguous())
-    return torch.cat(latent_ids, dim=0)
+class LatentBatchLoader:
+    """
+    Iterates over batches of latent ids held in a (N, latent_size) tensor or memory-mapped numpy array,
+    fetching each batch with a single gather instead of indexing and collating one row at a time. Batches
+    can optionally be pinned, so that a DevicePrefetcher copies them to the GPU asynchronously.
+    """
+    def __init__(self, latent_ids, batch_size, shuffle=True, drop_last=False, pin_memory=False):
+        self.latent_ids = latent_ids
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.latent_ids) // self.batch_size
+        return (len(self.latent_ids) + self.batch_size - 1) // self.batch_size
+
+    def _gather(self, indices):
+        if isinstance(self.latent_ids, torch.Tensor):
+            batch = self.latent_ids.index_select(0, indices)
+        else:
+            # sorted reads keep memory-mapped access sequential within a batch
+            batch = torch.from_numpy(self.latent_ids[np.sort(indices.numpy())].astype(np.int64))
+        if self.pin_memory:
+            batch = batch.pin_memory()
+        return batch
+
+    def __iter__(self):
+        n = len(self.latent_ids)
+        order = torch.randperm(n) if self.shuffle else torch.arange(n)
+        batch_indices = list(torch.split(order, self.batch_size))
+        if self.drop_last and len(batch_indices[-1]) < self.batch_size:
+            batch_indices = batch_indices[:-1]
+        for indices in batch_indices:
+            yield self._gather(indices)
+
+
+def load_latent_ids(latents_fp, mmap=False):
+    # memory-mapped latents are stored next to the torch file as .npy, converted on first use
+    if not mmap:
+        return torch.load(latents_fp)
+    mmap_fp = f"{latents_fp}.npy"
+    if not os.path.exists(mmap_fp):
+        log(f"Converting {latents_fp} to memory-mappable {mmap_fp}")
+        np.save(mmap_fp, torch.load(latents_fp).numpy())
+    return np.load(mmap_fp, mmap_mode="r")
 
 
 @torch.no_grad()
-def get_latent_loaders(H, get_validation_loader=True, shuffle=True):
+def get_latent_loaders(H, get_validation_loader=True, shuffle=True, pin_memory=False):
     latents_fp_suffix = "_flipped" if H.horizontal_flip else ""
 
     train_latents_fp = f"latents/{H.dataset}_{H.latent_shape[-1]}_train_latents{latents_fp_suffix}"
-    train_latent_ids = torch.load(train_latents_fp)
-    train_latent_loader = torch.utils.data.DataLoader(train_latent_ids, batch_size=H.batch_size, shuffle=shuffle)
+    train_latent_ids = load_latent_ids(train_latents_fp, mmap=H.latents_mmap)
+    train_latent_loader = LatentBatchLoader(
+        train_latent_ids,
+        H.batch_size,
+        shuffle=shuffle,
+        pin_memory=pin_memory
+    )
 
     if get_validation_loader:
         val_latents_fp = f"latents/{H.dataset}_{H.latent_shape[-1]}_val_latents{latents_fp_suffix}"
-        val_latent_ids = torch.load(val_latents_fp)
-        val_latent_loader = torch.utils.data.DataLoader(val_latent_ids, batch_size=H.batch_size, shuffle=shuffle)
+        val_latent_ids = load_latent_ids(val_latents_fp, mmap=H.latents_mmap)
+        val_latent_loader = LatentBatchLoader(
+            val_latent_ids,
+            H.batch_size,
+            shuffle=shuffle,
+            pin_memory=pin_memory
+        )
     else:
         val_latent_loader = None
 
@@ -103,14 +239,29 @@ def get_latent_loaders(H, get_validation_loader=True, shuffle=True):
 
 
 # TODO: rethink this whole thing - completely unnecessarily complicated
+# state dict prefixes of the VQGAN parts stored separately by convert_vqgan_checkpoint.py, LPIPS weights are not kept
+VQGAN_COMPONENT_PREFIXES = {
+    "encoder": "ae.encoder.",
+    "quantize": "ae.quantize.",
+    "generator": "ae.generator.",
+    "discriminator": "disc.",
+}
+
+
 def retrieve_autoencoder_components_state_dicts(H, components_list, remove_component_from_key=False):
     state_dict = {}
-    # default to loading ema models first
-    ae_load_path = f"logs/{H.ae_load_dir}/saved_models/vqgan_ema_{H.ae_load_step}.th"
-    if not os.path.exists(ae_load_path):
-        ae_load_path = f"logs/{H.ae_load_dir}/saved_models/vqgan_{H.ae_load_step}.th"
-    log(f"Loading VQGAN from {ae_load_path}")
-    full_vqgan_state_dict = torch.load(ae_load_path, map_location="cpu")
+    # default to loading ema models first, preferring converted component checkpoints to full ones
+    for model_name in ["vqgan_ema", "vqgan"]:
+        if os.path.exists(get_components_dir(model_name, H.ae_load_step, H.ae_load_dir)):
+            log(f"Loading {', '.join(components_list)} from {model_name}_{H.ae_load_step} components")
+            full_vqgan_state_dict = load_model_components(
+                components_list, model_name, H.ae_load_step, H.ae_load_dir)
+            break
+        ae_load_path = f"logs/{H.ae_load_dir}/saved_models/{model_name}_{H.ae_load_step}.th"
+        if os.path.exists(ae_load_path) or model_name == "vqgan":
+            log(f"Loading VQGAN from {ae_load_path}")
+            full_vqgan_state_dict = torch.load(ae_load_path, map_location="cpu")
+            break
 
     for key in full_vqgan_state_dict:
         for component in components_list:
@@ -1,10 +1,13 @@
 import copy
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import torch
-import torch_fidelity
 import torch.nn.functional as F
 from tqdm import tqdm
-from .data_utils import get_data_loaders, BigDataset, NoClassDataset, get_datasets
-from .log_utils import load_model, load_stats, log, save_images
+from .data_utils import get_data_loaders, BigDataset, NoClassDataset, get_datasets, get_dataset_path
+from .log_utils import load_model, load_stats, log, save_images, save_model
 
 
 def normalize(in_channels):
@@ -16,6 +19,13 @@ def swish(x):
     return x*torch.sigmoid(x)
 
 
+@torch.jit.script
+def norm_swish(x, num_groups: int, weight, bias, eps: float):
+    # scripted together so the elementwise tail of GroupNorm and swish can be fused in exported models
+    x = F.group_norm(x, num_groups, weight, bias, eps)
+    return x*torch.sigmoid(x)
+
+
 def adopt_weight(weight, global_step, threshold=0, value=0.):
     if global_step < threshold:
         weight = value
@@ -75,9 +85,12 @@ def load_vqgan_from_checkpoint(H, vqgan, optim, disc_optim, ema_vqgan):
 
 def calc_FID(H, model):
     # generate_recons(H, model)
-    real_dataset, _ = get_datasets(H.dataset, H.img_size, custom_dataset_path=H.custom_dataset_path)
+    real_dataset, _ = get_datasets(
+        H.dataset, H.img_size, custom_dataset_path=H.custom_dataset_path, cache_dir=H.image_cache_dir
+    )
     real_dataset = NoClassDataset(real_dataset)
     recons = BigDataset(f"logs/{H.log_dir}/FID_recons/images/")
+    import torch_fidelity
     fid = torch_fidelity.calculate_metrics(
         input1=recons,
         input2=real_dataset,
@@ -90,6 +103,100 @@ def calc_FID(H, model):
     return fid
 
 
+class ReconstructionFID:
+    """
+    FID between autoencoder reconstructions of a fixed subset of a dataset and the subset itself, with the real
+    statistics cached in _pkl_files/. With background set, FIDs are computed on a worker thread and returned by
+    pop_results.
+    """
+    def __init__(self, H, ae, dataset, split="train", best_fid=float("inf"), background=False):
+        self.H = H
+        # keys are prefixed with ae. like VQGAN's, so the best snapshot loads as a VQGAN
+        self.snapshot = torch.nn.ModuleDict({"ae": copy.deepcopy(ae)}).eval().requires_grad_(False)
+        n_images = min(H.fid_n_images, len(dataset))
+        indices = torch.linspace(0, len(dataset) - 1, n_images).long().tolist()
+        self.loader = torch.utils.data.DataLoader(
+            NoClassDataset(torch.utils.data.Subset(dataset, indices)),
+            batch_size=H.fid_batch_size,
+            num_workers=2,
+            pin_memory=True
+        )
+        path_hash = hashlib.md5(get_dataset_path(H.dataset, H.custom_dataset_path).encode()).hexdigest()[:8]
+        self.real_stats_fp = f"_pkl_files/{H.dataset}_{path_hash}_{split}_{H.img_size}_recon_fid_stats_{n_images}.npz"
+        self.real_stats = None
+        self.feat_extractor = None
+        self.best_fid = best_fid
+        self.results = []
+        self.pending = None
+        self.executor = ThreadPoolExecutor(max_workers=1) if background else None
+        self.stream = torch.cuda.Stream() if background else None
+
+    def get_features(self, reconstruct):
+        from torch_fidelity.utils import create_feature_extractor
+        if self.feat_extractor is None:
+            self.feat_extractor = create_feature_extractor("inception-v3-compat", ["2048"]).cuda()
+        features = []
+        for x in self.loader:
+            x = x.cuda(non_blocking=True)
+            if reconstruct:
+                x_hat, *_ = self.snapshot.ae(x.float() / 255)
+                # rounded like torchvision's save_image, as calc_FID's reconstructions were
+                x = x_hat.clamp(0, 1).mul(255).add(0.5).to(torch.uint8)
+            features.append(self.feat_extractor.forward(x)[0].cpu())
+        return torch.cat(features, dim=0)
+
+    def get_real_stats(self):
+        from torch_fidelity.metric_fid import fid_features_to_statistics
+        if os.path.exists(self.real_stats_fp):
+            return dict(np.load(self.real_stats_fp))
+        log(f"Computing real Inception statistics of {len(self.loader.dataset)} images for reconstruction FID")
+        real_stats = fid_features_to_statistics(self.get_features(reconstruct=False))
+        os.makedirs("_pkl_files", exist_ok=True)
+        np.savez(self.real_stats_fp, **real_stats)
+        return real_stats
+
+    @torch.no_grad()
+    def calc_FID(self, step):
+        from torch_fidelity.metric_fid import fid_features_to_statistics, fid_statistics_to_metric, KEY_METRIC_FID
+        with torch.cuda.stream(self.stream):
+            if self.real_stats is None:
+                self.real_stats = self.get_real_stats()
+            recon_stats = fid_features_to_statistics(self.get_features(reconstruct=True))
+            fid = fid_statistics_to_metric(recon_stats, self.real_stats, verbose=False)[KEY_METRIC_FID]
+        # saved before returning, as the snapshot is only overwritten by the next evaluation
+        if fid < self.best_fid:
+            self.best_fid = fid
+            save_model(self.snapshot, "vqgan_bestfid", step, self.H.log_dir)
+        return step, fid
+
+    def evaluate(self, ae, step):
+        # one evaluation at a time, so this waits for the previous one in the background
+        self.wait()
+        self.snapshot.ae.load_state_dict(ae.state_dict())
+        if self.executor is None:
+            self.results.append(self.calc_FID(step))
+        else:
+            self.stream.wait_stream(torch.cuda.current_stream())
+            self.pending = self.executor.submit(self.calc_FID, step)
+
+    def wait(self):
+        if self.pending is not None:
+            self.results.append(self.pending.result())
+            self.pending = None
+
+    def pop_results(self):
+        # (step, fid) of finished evaluations, in order
+        if self.pending is not None and self.pending.done():
+            self.wait()
+        results, self.results = self.results, []
+        return results
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
 @torch.no_grad()
 def generate_recons(H, model):
     # if using validation on FFHQ, don't want to include validation set images in FID calc
@@ -102,6 +209,7 @@ def generate_recons(H, model):
         get_val_dataloader=training_with_validation,
         drop_last=False,
         shuffle=False,
+        cache_dir=H.image_cache_dir,
     )
     log("Generating recons for FID calculation")
 